@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AnalyticsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'analytics'
+
+    def ready(self):
+        # Keep ChannelMetrics counters current as messages and conversations change
+        from analytics import signals  # noqa: F401
@@ -0,0 +1,264 @@
+# analytics/archive.py
+import gzip
+import json
+from datetime import date, datetime, timedelta
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F, Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from communications.models import Channel, Message, ConversationMessage, Suppression
+from communications.suppression import normalize_recipient, suppression_sources
+from chatbot.models import ChatbotInteraction
+from analytics.models import ArchiveSegment
+
+# Rows older than this many days move out of the hot tables
+ARCHIVE_HORIZON_DAYS = getattr(settings, 'ARCHIVE_HORIZON_DAYS', 365)
+
+# Rows moved per transaction; each batch becomes one segment file per month it spans
+ARCHIVE_BATCH_SIZE = getattr(settings, 'ARCHIVE_BATCH_SIZE', 5000)
+
+# Storage prefix of the segment files
+ARCHIVE_PREFIX = 'archive'
+
+
+def _archived_tables():
+    # Imported here: the channel apps import communications, not the other way round
+    from email_service.models import EmailMessage, EmailClick
+    from whatsapp_service.models import WhatsAppMessage
+
+    # Per table: model, the columns deciding age and month as (column, filters
+    # of the rows it applies to), which scans filter on too, extra filters on
+    # archivable rows, child rows stored inside each record as (key, model,
+    # lookup of the parent id, many), and a hook run on each batch before it
+    # is deleted
+    return {
+        'messages': {
+            'model': Message,
+            # Messages that failed before sending have no sent_at
+            'ages': [('sent_at', {}), ('created_at', {'sent_at__isnull': True})],
+            'filters': {'status__in': ['sent', 'delivered', 'read', 'failed']},
+            'before_delete': _keep_bounces,
+            'related': [
+                ('email_details', EmailMessage, 'message_id', False),
+                ('email_clicks', EmailClick, 'email__message_id', True),
+                ('whatsapp_details', WhatsAppMessage, 'message_id', False),
+            ],
+        },
+        'conversation_messages': {
+            'model': ConversationMessage,
+            'ages': [('created_at', {})],
+            'filters': {},
+            'before_delete': None,
+            'related': [],
+        },
+        'interactions': {
+            'model': ChatbotInteraction,
+            'ages': [('timestamp', {})],
+            'filters': {},
+            'before_delete': None,
+            'related': [],
+        },
+    }
+
+
+def _keep_bounces(rows):
+    """Suppress the hard-bounced recipients of a batch before their failed messages leave the hot table
+
+    Suppression counts failed rows in the hot table, so recipients already at
+    the threshold get a lasting 'bounce' entry. Failures of recipients below
+    it stop counting once archived.
+    """
+    failed = {}
+    for row in rows:
+        if row['status'] == 'failed':
+            failed.setdefault(row['channel_id'], set()).add(row['recipient'])
+    if not failed:
+        return
+
+    recipients_by_type = {}
+    for channel_id, channel_type in Channel.objects.filter(id__in=failed).values_list('id', 'type'):
+        recipients_by_type.setdefault(channel_type, set()).update(failed[channel_id])
+
+    suppressions = []
+    for channel_type, recipients in recipients_by_type.items():
+        # The second source lists recipients at the hard-bounce threshold
+        bounced = suppression_sources(channel_type, list(recipients))[1]
+        suppressions.extend(
+            Suppression(recipient=normalize_recipient(recipient), channel_type=channel_type, reason='bounce')
+            for recipient in set(bounced)
+        )
+    Suppression.objects.bulk_create(suppressions, ignore_conflicts=True)
+
+
+def _aware(value):
+    """A timezone-aware datetime for a date, naive or aware datetime"""
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, datetime.min.time())
+    return timezone.make_aware(value) if timezone.is_naive(value) else value
+
+
+def _json_default(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def _fields(model):
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def _month(value):
+    return date(value.year, value.month, 1)
+
+
+class ArchiveService:
+    """Moves cold rows into append-only, per-month gzipped NDJSON segments and reads them back
+
+    Archiving never touches the rollup tables, which keep serving analytics for
+    archived days. Each segment is listed in ArchiveSegment with its id and time
+    range, so a lookup opens only the segments that can hold the rows it wants.
+    """
+
+    @staticmethod
+    def archive(table, cutoff=None, batch_size=ARCHIVE_BATCH_SIZE):
+        """Move rows of a table older than cutoff into archive segments; returns rows moved"""
+        spec = _archived_tables()[table]
+        model = spec['model']
+        cutoff = _aware(cutoff) if cutoff else timezone.now() - timedelta(days=ARCHIVE_HORIZON_DAYS)
+        moved = 0
+
+        for age_field, age_filters in spec['ages']:
+            while True:
+                with transaction.atomic():
+                    rows = list(model.objects.filter(
+                        **{f'{age_field}__lt': cutoff}, **age_filters, **spec['filters']
+                    ).order_by(age_field, 'id').values(*_fields(model))[:batch_size])
+                    if not rows:
+                        break
+
+                    ids = [row['id'] for row in rows]
+                    for key, related_model, lookup, many in spec['related']:
+                        children = related_model.objects.filter(**{f'{lookup}__in': ids}).values(*_fields(related_model), parent_id=F(lookup))
+                        by_parent = {}
+                        for child in children:
+                            parent_id = child.pop('parent_id')
+                            if many:
+                                by_parent.setdefault(parent_id, []).append(child)
+                            else:
+                                by_parent[parent_id] = child
+                        for row in rows:
+                            row[key] = by_parent.get(row['id'], [] if many else None)
+
+                    months = {}
+                    for row in rows:
+                        months.setdefault(_month(row[age_field]), []).append(row)
+                    for month, month_rows in months.items():
+                        ArchiveService._write_segment(table, month, month_rows, age_field, cutoff)
+
+                    if spec['before_delete']:
+                        spec['before_delete'](rows)
+
+                    # Child rows go with their parent through the cascade
+                    model.objects.filter(id__in=ids).delete()
+                    moved += len(rows)
+
+        return moved
+
+    @staticmethod
+    def _write_segment(table, month, rows, time_field, cutoff):
+        ids = [row['id'] for row in rows]
+        times = [row[time_field] for row in rows]
+        content = gzip.compress(b''.join(
+            json.dumps(row, default=_json_default, separators=(',', ':')).encode('utf-8') + b'\n' for row in rows
+        ))
+        # Segments are only ever added; a name clash gets a fresh name from the storage
+        path = default_storage.save(
+            f'{ARCHIVE_PREFIX}/{table}/{month:%Y-%m}/{min(ids)}-{max(ids)}.ndjson.gz',
+            ContentFile(content)
+        )
+        return ArchiveSegment.objects.create(
+            table=table,
+            month=month,
+            path=path,
+            first_id=min(ids),
+            last_id=max(ids),
+            time_field=time_field,
+            start_at=min(times),
+            end_at=max(times),
+            row_count=len(rows),
+            cutoff=cutoff
+        )
+
+    @staticmethod
+    def archive_all(cutoff=None):
+        """Archive every table up to the same cutoff"""
+        cutoff = _aware(cutoff) if cutoff else timezone.now() - timedelta(days=ARCHIVE_HORIZON_DAYS)
+        return {table: ArchiveService.archive(table, cutoff) for table in _archived_tables()}
+
+    @staticmethod
+    def hot_since():
+        """First day whose rows are all still in the hot tables, or None if nothing was archived"""
+        cutoff = ArchiveSegment.objects.aggregate(cutoff=Max('cutoff'))['cutoff']
+        if cutoff is None:
+            return None
+        return cutoff.date() + timedelta(days=1) if cutoff.time() != datetime.min.time() else cutoff.date()
+
+    @staticmethod
+    def read_segment(segment):
+        """Rows of one segment, with datetime columns parsed back"""
+        model = _archived_tables()[segment.table]['model']
+        datetime_fields = [field.attname for field in model._meta.concrete_fields if field.get_internal_type() == 'DateTimeField']
+        with default_storage.open(segment.path, 'rb') as file:
+            for line in gzip.decompress(file.read()).splitlines():
+                row = json.loads(line)
+                for field in datetime_fields:
+                    if row[field] is not None:
+                        row[field] = parse_datetime(row[field])
+                yield row
+
+    @staticmethod
+    def get(table, pk):
+        """One row by id from the hot table or, failing that, the archive"""
+        model = _archived_tables()[table]['model']
+        row = model.objects.filter(pk=pk).values(*_fields(model)).first()
+        if row is not None:
+            return row
+
+        segments = ArchiveSegment.objects.filter(table=table, first_id__lte=pk, last_id__gte=pk)
+        for segment in segments:
+            for archived in ArchiveService.read_segment(segment):
+                if archived['id'] == pk:
+                    return archived
+        return None
+
+    @staticmethod
+    def scan(table, start, end, **filters):
+        """Rows with start <= time < end and equal to every filter, from hot rows and archive alike
+
+        A row's time is the column it ages by, e.g. created_at for messages
+        never sent. Filters are plain column equalities, e.g. conversation_id=42.
+        Archived rows come first, oldest segment first, followed by the hot
+        rows of each age column in turn. Dates and naive datetimes are taken in
+        the current time zone.
+        """
+        spec = _archived_tables()[table]
+        model = spec['model']
+        start, end = _aware(start), _aware(end)
+
+        segments = ArchiveSegment.objects.filter(
+            table=table,
+            start_at__lt=end,
+            end_at__gte=start
+        ).order_by('start_at', 'first_id')
+        for segment in segments:
+            # The segment's range is of the column its rows were archived by
+            time_field = segment.time_field
+            for row in ArchiveService.read_segment(segment):
+                if row[time_field] is not None and start <= row[time_field] < end and all(row[key] == value for key, value in filters.items()):
+                    yield row
+
+        for age_field, age_filters in spec['ages']:
+            yield from model.objects.filter(
+                **{f'{age_field}__gte': start, f'{age_field}__lt': end}, **age_filters
+            ).filter(**filters).order_by(age_field, 'id').values(*_fields(model)).iterator()
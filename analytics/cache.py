@@ -0,0 +1,132 @@
+# analytics/cache.py
+import functools
+import hashlib
+import inspect
+import json
+import threading
+from datetime import date, datetime, timedelta
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import F, Sum
+from analytics.models import AnalyticsDataVersion
+
+# Django cache alias shared by all workers (e.g. a Redis cache); None keeps results per process
+ANALYTICS_CACHE = getattr(settings, 'ANALYTICS_CACHE', None)
+
+# Ranges ending within this many days of today still receive writes, so their
+# results are only kept for ANALYTICS_CACHE_LIVE_SECONDS
+ANALYTICS_CACHE_SETTLE_DAYS = getattr(settings, 'ANALYTICS_CACHE_SETTLE_DAYS', 1)
+ANALYTICS_CACHE_LIVE_SECONDS = getattr(settings, 'ANALYTICS_CACHE_LIVE_SECONDS', 60)
+
+# Settled ranges only change through a version bump, but are still dropped
+# after this long in case a write went unrecorded
+ANALYTICS_CACHE_SETTLED_SECONDS = getattr(settings, 'ANALYTICS_CACHE_SETTLED_SECONDS', 24 * 3600)
+
+KEY_PREFIX = 'analytics'
+
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+class AnalyticsCache:
+    """Caches analytics query results keyed by arguments and the data version of the days they cover
+
+    Every day has a version counter that is incremented whenever rows feeding
+    that day are rewritten. A result's key includes the sum of the counters
+    in its date range, so rewriting one day only invalidates the ranges that
+    contain it, while closed historical ranges stay cached for
+    ANALYTICS_CACHE_SETTLED_SECONDS. Results are kept in local memory per
+    process, or in the Django cache named by ANALYTICS_CACHE.
+    """
+
+    def __init__(self, alias=ANALYTICS_CACHE):
+        self.alias = alias
+        self._local = None
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @property
+    def backend(self):
+        if self.alias:
+            return caches[self.alias]
+        if self._local is None:
+            self._local = LocMemCache('analytics-results', {'OPTIONS': {'MAX_ENTRIES': 5000}})
+        return self._local
+
+    @staticmethod
+    def range_version(start, end):
+        """Sum of the version counters of the days in [start, end]"""
+        # Counters live in the database so every process sees every rewrite,
+        # whichever backend holds the results, and can never be evicted. They
+        # only ever grow, so any rewrite in the range changes the sum
+        return AnalyticsDataVersion.objects.filter(
+            date__gte=_as_date(start),
+            date__lte=_as_date(end)
+        ).aggregate(version=Sum('version'))['version'] or 0
+
+    @staticmethod
+    def mark_rewritten(days):
+        """Invalidate cached results covering any of these days"""
+        days = {_as_date(day) for day in days if day}
+        if not days:
+            return
+        
+        # Incremented in the database rather than stamped with a clock, so
+        # concurrent writers on different hosts can never move a day backwards
+        AnalyticsDataVersion.objects.bulk_create(
+            [AnalyticsDataVersion(date=day) for day in days],
+            ignore_conflicts=True
+        )
+        AnalyticsDataVersion.objects.filter(date__in=days).update(version=F('version') + 1)
+
+    def clear(self):
+        """Drop all cached results held by this process's backend"""
+        self.backend.clear()
+
+    def _record(self, name, hit):
+        with self._lock:
+            stats = self._stats.setdefault(name, {'hits': 0, 'misses': 0})
+            stats['hits' if hit else 'misses'] += 1
+
+    def stats(self):
+        """Hit and miss counts with hit rate per cached method, for this process"""
+        with self._lock:
+            return {
+                name: dict(counts, hit_rate=counts['hits'] / (counts['hits'] + counts['misses']))
+                for name, counts in self._stats.items()
+            }
+
+    def cached(self, func):
+        """Decorate a query taking start/end (or start_date/end_date) arguments"""
+        signature = inspect.signature(func)
+        name = func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not getattr(settings, 'ANALYTICS_CACHE_ENABLED', True):
+                return func(*args, **kwargs)
+
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            params = arguments.arguments
+            start = params.get('start_date', params.get('start'))
+            end = params.get('end_date', params.get('end'))
+
+            version = self.range_version(start, end)
+            digest = hashlib.sha1(json.dumps(params, default=str, sort_keys=True).encode()).hexdigest()
+            key = f'{KEY_PREFIX}:result:{name}:{digest}:{version}'
+
+            result = self.backend.get(key)
+            self._record(name, result is not None)
+            if result is None:
+                result = func(*args, **kwargs)
+                settled = _as_date(end) < date.today() - timedelta(days=ANALYTICS_CACHE_SETTLE_DAYS)
+                self.backend.set(key, result, timeout=ANALYTICS_CACHE_SETTLED_SECONDS if settled else ANALYTICS_CACHE_LIVE_SECONDS)
+            return result
+
+        return wrapper
+
+
+analytics_cache = AnalyticsCache()
@@ -0,0 +1,326 @@
+# analytics/eventstore.py
+import json
+import operator
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import islice
+import numpy as np
+from django.conf import settings
+from communications.models import Message, ConversationMessage
+from chatbot.models import ChatbotInteraction
+
+# Directory holding <table>/<YYYY-MM-DD>/<column>.npy snapshots
+EVENT_STORE_ROOT = getattr(settings, 'EVENT_STORE_ROOT', os.path.join(settings.BASE_DIR, 'eventstore'))
+
+# Rows pulled from the database per round trip while exporting
+EXPORT_CHUNK_SIZE = 20000
+
+# Per table: source model, the datetime column that decides the day partition,
+# and (column, ORM lookup, kind) for every exported column. Strings are
+# dictionary encoded as int32 codes with -1 for NULL; ints use INT_NULL for
+# NULL, floats NaN and datetimes NaT.
+TABLES = {
+    'messages': {
+        'model': Message,
+        'partition': 'sent_at',
+        'columns': [
+            ('id', 'id', 'int'),
+            ('channel_id', 'channel_id', 'int'),
+            ('channel_type', 'channel__type', 'str'),
+            ('template_id', 'template_id', 'int'),
+            ('status', 'status', 'str'),
+            ('sent_at', 'sent_at', 'datetime'),
+            ('delivered_at', 'delivered_at', 'datetime'),
+            ('read_at', 'read_at', 'datetime'),
+        ],
+    },
+    'conversation_messages': {
+        'model': ConversationMessage,
+        'partition': 'created_at',
+        'columns': [
+            ('id', 'id', 'int'),
+            ('conversation_id', 'conversation_id', 'int'),
+            ('channel_id', 'conversation__channel_id', 'int'),
+            ('channel_type', 'conversation__channel__type', 'str'),
+            ('is_from_user', 'is_from_user', 'bool'),
+            ('created_at', 'created_at', 'datetime'),
+        ],
+    },
+    'interactions': {
+        'model': ChatbotInteraction,
+        'partition': 'timestamp',
+        'columns': [
+            ('id', 'id', 'int'),
+            ('conversation_id', 'conversation_id', 'int'),
+            ('channel_id', 'conversation__channel_id', 'int'),
+            ('intent', 'detected_intent__name', 'str'),
+            ('confidence_score', 'confidence_score', 'float'),
+            ('feedback_rating', 'feedback_rating', 'float'),
+            ('needs_handoff', 'needs_handoff', 'bool'),
+            ('timestamp', 'timestamp', 'datetime'),
+        ],
+    },
+}
+
+FILTER_OPS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+AGGREGATES = ('count', 'sum', 'mean', 'min', 'max')
+
+# Stored for NULL in int columns, which only hold ids; never a real value
+INT_NULL = -1
+
+
+def _naive_utc(value):
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(dt_timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _is_int(data, name, dictionaries):
+    return data.dtype.kind == 'i' and name not in dictionaries
+
+
+def _encode(kind, values, dictionary):
+    if kind == 'str':
+        return np.array([-1 if v is None else dictionary.setdefault(v, len(dictionary)) for v in values], dtype=np.int32)
+    if kind == 'int':
+        return np.array([INT_NULL if v is None else v for v in values], dtype=np.int64)
+    if kind == 'float':
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    if kind == 'bool':
+        return np.array(values, dtype=bool)
+    return np.array([_naive_utc(v) for v in values], dtype='datetime64[us]')
+
+
+class EventStore:
+    """Per-day columnar snapshots of message and interaction tables, queried through memory maps"""
+
+    @staticmethod
+    def partition_path(table, day):
+        return os.path.join(EVENT_STORE_ROOT, table, day.isoformat())
+
+    @staticmethod
+    def export_day(table, day):
+        """Snapshot one day of a table to .npy columns, replacing any earlier snapshot"""
+        spec = TABLES[table]
+        start_of_day = datetime.combine(day, datetime.min.time())
+        lookups = [lookup for _, lookup, _ in spec['columns']]
+
+        rows = spec['model'].objects.filter(**{
+            f"{spec['partition']}__gte": start_of_day,
+            f"{spec['partition']}__lt": start_of_day + timedelta(days=1)
+        }).order_by('id').values_list(*lookups).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+        dictionaries = {name: {} for name, _, kind in spec['columns'] if kind == 'str'}
+        parts = {name: [] for name, _, _ in spec['columns']}
+        while True:
+            chunk = list(islice(rows, EXPORT_CHUNK_SIZE))
+            if not chunk:
+                break
+            for (name, _, kind), values in zip(spec['columns'], zip(*chunk)):
+                parts[name].append(_encode(kind, values, dictionaries.get(name)))
+
+        # Written beside the target, which is a link switched to it in one rename,
+        # so readers never see a partial or missing day
+        target = EventStore.partition_path(table, day)
+        parent = os.path.dirname(target)
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=parent, prefix=f'.{day.isoformat()}-')
+        row_count = 0
+        for name, _, kind in spec['columns']:
+            empty = _encode(kind, [], {})
+            column = np.concatenate(parts[name]) if parts[name] else empty
+            row_count = len(column)
+            np.save(os.path.join(staging, f'{name}.npy'), column)
+            if kind == 'str':
+                with open(os.path.join(staging, f'{name}.dict.json'), 'w') as file:
+                    json.dump(list(dictionaries[name]), file)
+
+        previous = os.path.realpath(target) if os.path.islink(target) else None
+        if os.path.isdir(target) and not os.path.islink(target):
+            # A day exported as a plain directory can only be moved aside first
+            previous = f'{staging}-previous'
+            os.replace(target, previous)
+
+        link = f'{staging}.link'
+        os.symlink(os.path.basename(staging), link)
+        os.replace(link, target)
+
+        # Readers holding memory maps of the old files keep them until they let go
+        if previous:
+            shutil.rmtree(previous, ignore_errors=True)
+
+        return row_count
+
+    @staticmethod
+    def load_day(table, day):
+        """Memory-map one day of a table; returns (columns, dictionaries) or None if not exported"""
+        path = EventStore.partition_path(table, day)
+        for attempt in range(2):
+            # Resolved once, so every column comes from the same snapshot
+            snapshot = os.path.realpath(path)
+            if not os.path.isdir(snapshot):
+                return None
+
+            try:
+                columns, dictionaries = {}, {}
+                for name, _, kind in TABLES[table]['columns']:
+                    columns[name] = np.load(os.path.join(snapshot, f'{name}.npy'), mmap_mode='r')
+                    if kind == 'str':
+                        with open(os.path.join(snapshot, f'{name}.dict.json')) as file:
+                            dictionaries[name] = json.load(file)
+                return columns, dictionaries
+            except FileNotFoundError:
+                # Replaced by a new export while loading; load that one instead
+                if attempt:
+                    raise
+
+    @staticmethod
+    def _mask(columns, dictionaries, filters):
+        size = len(next(iter(columns.values())))
+        mask = np.ones(size, dtype=bool)
+
+        for name, op, value in filters:
+            data = columns[name]
+            if name in dictionaries:
+                # Compare codes; values absent from the day's dictionary match nothing
+                codes = {v: i for i, v in enumerate(dictionaries[name])}
+                if op == 'in':
+                    mask &= np.isin(data, [codes[v] for v in value if v in codes])
+                elif op in ('==', '!='):
+                    mask &= FILTER_OPS[op](data, codes.get(value, -2))
+                else:
+                    raise ValueError(f"Operator {op} is not supported on text column {name}")
+                continue
+
+            if _is_int(data, name, dictionaries):
+                # NULL is matched by None, and like in SQL by no other comparison
+                if op == 'in':
+                    value = [INT_NULL if v is None else v for v in value]
+                elif value is None:
+                    value = INT_NULL
+                else:
+                    mask &= data != INT_NULL
+            if data.dtype.kind == 'M':
+                value = [np.datetime64(_naive_utc(v), 'us') for v in value] if op == 'in' else np.datetime64(_naive_utc(value), 'us')
+            if op == 'in':
+                mask &= np.isin(data, value)
+            else:
+                mask &= FILTER_OPS[op](data, value)
+
+        return mask
+
+    @staticmethod
+    def query(table, start_date, end_date, filters=None, group_by=None, aggregates=None):
+        """Filter, group and aggregate a table over a range of days
+
+        filters is a list of (column, op, value) with op one of ==, !=, <, <=,
+        >, >=, in. group_by lists int, bool or text columns, or 'day' for the
+        partition day. aggregates maps output names to (function, column) with
+        function one of count, sum, mean, min, max; count takes no column and
+        the others skip NaN values. Returns one dict per group.
+        """
+        filters = filters or []
+        group_by = group_by or []
+        aggregates = aggregates or {'count': ('count', None)}
+        for function, _ in aggregates.values():
+            if function not in AGGREGATES:
+                raise ValueError(f"Unknown aggregate {function}")
+
+        # group key -> aggregate name -> running partial
+        groups = {}
+        day = start_date
+        while day <= end_date:
+            loaded = EventStore.load_day(table, day)
+            if loaded:
+                EventStore._aggregate_day(day, *loaded, filters, group_by, aggregates, groups)
+            day += timedelta(days=1)
+
+        # Like SQL, an ungrouped query always yields one row
+        if not group_by:
+            groups.setdefault((), {})
+
+        rows = []
+        for key in sorted(groups, key=lambda k: tuple((v is None, v) for v in k)):
+            row = dict(zip(group_by, key))
+            for name, (function, _) in aggregates.items():
+                partial = groups[key].get(name, 0 if function in ('count', 'sum') else None)
+                if function == 'mean':
+                    row[name] = partial[0] / partial[1] if partial and partial[1] else None
+                else:
+                    row[name] = partial
+            rows.append(row)
+        return rows
+
+    @staticmethod
+    def _aggregate_day(day, columns, dictionaries, filters, group_by, aggregates, groups):
+        mask = EventStore._mask(columns, dictionaries, filters)
+        selected = int(mask.sum())
+        if not selected:
+            return
+
+        # Group on the raw codes of the day, then decode only the distinct keys
+        if group_by:
+            keys = np.stack([
+                np.zeros(selected, dtype=np.int64) if name == 'day' else np.asarray(columns[name][mask]).astype(np.int64)
+                for name in group_by
+            ], axis=1)
+            unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+        else:
+            unique_keys, inverse = np.zeros((1, 0), dtype=np.int64), np.zeros(selected, dtype=np.int64)
+        group_count = len(unique_keys)
+
+        partials = {}
+        for name, (function, column) in aggregates.items():
+            if function == 'count':
+                partials[name] = np.bincount(inverse, minlength=group_count)
+                continue
+
+            values = np.asarray(columns[column][mask], dtype=np.float64)
+            if _is_int(columns[column], column, dictionaries):
+                values[values == INT_NULL] = np.nan
+            present = ~np.isnan(values)
+            if function in ('sum', 'mean'):
+                sums = np.bincount(inverse[present], weights=values[present], minlength=group_count)
+                counts = np.bincount(inverse[present], minlength=group_count)
+                partials[name] = sums if function == 'sum' else list(zip(sums, counts))
+            else:
+                extreme = np.full(group_count, np.inf if function == 'min' else -np.inf)
+                (np.minimum if function == 'min' else np.maximum).at(extreme, inverse[present], values[present])
+                partials[name] = np.where(np.isinf(extreme), np.nan, extreme)
+
+        for index, raw_key in enumerate(unique_keys):
+            key = []
+            for name, code in zip(group_by, raw_key):
+                if name == 'day':
+                    key.append(day.isoformat())
+                elif name in dictionaries:
+                    key.append(dictionaries[name][code] if code >= 0 else None)
+                elif columns[name].dtype == bool:
+                    key.append(bool(code))
+                else:
+                    key.append(None if code == INT_NULL else int(code))
+            group = groups.setdefault(tuple(key), {})
+
+            for name, (function, _) in aggregates.items():
+                value = partials[name][index]
+                if function == 'mean':
+                    total, count = group.get(name, (0.0, 0))
+                    group[name] = (total + float(value[0]), count + int(value[1]))
+                elif function in ('count', 'sum'):
+                    group[name] = group.get(name, 0) + (int(value) if function == 'count' else float(value))
+                elif not np.isnan(value):
+                    current = group.get(name)
+                    group[name] = float(value) if current is None else (min if function == 'min' else max)(current, float(value))
+                else:
+                    group.setdefault(name, None)
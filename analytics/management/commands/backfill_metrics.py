@@ -0,0 +1,54 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+from analytics.services import BACKFILL_CHUNK_SIZE, AnalyticsService, backfill_metrics
+
+
+def run_chunk(units, name):
+    # Spawned workers start without Django configured; forked ones already are
+    django.setup()
+    return AnalyticsService.run_backfill_units(units, name)
+
+
+class Command(BaseCommand):
+    help = 'Rebuild ChannelMetrics and ChatbotMetrics for a range of days'
+
+    def add_arguments(self, parser):
+        parser.add_argument('start_date', type=date.fromisoformat, help='First day to rebuild (YYYY-MM-DD)')
+        parser.add_argument('end_date', type=date.fromisoformat, help='Last day to rebuild (YYYY-MM-DD)')
+        parser.add_argument('--channel', type=int, action='append', dest='channel_ids', help='Only rebuild this channel id (repeatable)')
+        parser.add_argument('--name', help='Checkpoint name; rerun with the same name to resume')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes')
+        parser.add_argument('--chunk-size', type=int, default=BACKFILL_CHUNK_SIZE, help='(day, channel) units per worker job')
+        parser.add_argument('--celery', action='store_true', help='Fan out as Celery tasks instead of a local process pool')
+
+    def handle(self, *args, **options):
+        start_date, end_date = options['start_date'], options['end_date']
+        name = options['name'] or f"{start_date.isoformat()}:{end_date.isoformat()}"
+        chunk_size = options['chunk_size']
+
+        if options['celery']:
+            queued = backfill_metrics.delay(
+                start_date.isoformat(), end_date.isoformat(), name, options['channel_ids'], chunk_size
+            )
+            self.stdout.write(f"Queued backfill '{name}' as task {queued.id}")
+            return
+
+        units = AnalyticsService.backfill_units(start_date, end_date, name, options['channel_ids'])
+        chunks = [units[i:i + chunk_size] for i in range(0, len(units), chunk_size)]
+        self.stdout.write(f"Backfill '{name}': {len(units)} units in {len(chunks)} chunks")
+
+        # Workers must open their own connections rather than share the parent's
+        connections.close_all()
+
+        done = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            futures = [pool.submit(run_chunk, chunk, name) for chunk in chunks]
+            for future in as_completed(futures):
+                done += future.result()
+                self.stdout.write(f"  {done}/{len(units)} units done")
+
+        self.stdout.write(self.style.SUCCESS(f"Backfill '{name}' complete"))
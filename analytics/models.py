@@ -1,7 +1,7 @@
 # analytics/models.py
 from django.db import models
 from communications.models import Channel, Message, Conversation
-from chatbot.models import ChatbotInteraction
+from chatbot.models import ChatbotInteraction, Intent
 
 class ChannelMetrics(models.Model):
     channel = models.ForeignKey(Channel, on_delete=models.CASCADE)
@@ -12,6 +12,10 @@ class ChannelMetrics(models.Model):
     conversations_started = models.IntegerField(default=0)
     conversations_completed = models.IntegerField(default=0)
     average_response_time = models.FloatField(default=0)
+    response_time_p50 = models.FloatField(default=0)
+    response_time_p90 = models.FloatField(default=0)
+    response_time_p99 = models.FloatField(default=0)
+    response_time_sketch = models.BinaryField(default=b'')  # Serialized LatencySketch
     
     class Meta:
         unique_together = ('channel', 'date')
@@ -31,4 +35,106 @@ class ChatbotMetrics(models.Model):
         ordering = ['-date']
     
     def __str__(self):
-        return f"Chatbot Metrics - {self.date}"
\ No newline at end of file
+        return f"Chatbot Metrics - {self.date}"
+
+class ChannelHourlyMetrics(models.Model):
+    channel = models.ForeignKey(Channel, on_delete=models.CASCADE)
+    hour = models.DateTimeField()  # Start of the hour
+    messages_sent = models.IntegerField(default=0)
+    messages_delivered = models.IntegerField(default=0)
+    messages_read = models.IntegerField(default=0)
+    conversations_started = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('channel', 'hour')
+    
+    def __str__(self):
+        return f"{self.channel.name} - {self.hour:%Y-%m-%d %H:00}"
+
+class AccountHourlyMetrics(models.Model):
+    account = models.ForeignKey('whatsapp_service.WhatsAppAccount', on_delete=models.CASCADE)
+    hour = models.DateTimeField()  # Start of the hour
+    messages_sent = models.IntegerField(default=0)
+    messages_delivered = models.IntegerField(default=0)
+    messages_read = models.IntegerField(default=0)
+    messages_failed = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('account', 'hour')
+        indexes = [
+            models.Index(fields=['hour'], name='account_hourly_hour_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.account.name} - {self.hour:%Y-%m-%d %H:00}"
+
+class EmailHourlyMetrics(models.Model):
+    hour = models.DateTimeField(unique=True)  # Start of the hour the emails were sent in
+    messages_sent = models.IntegerField(default=0)
+    messages_opened = models.IntegerField(default=0)
+    messages_clicked = models.IntegerField(default=0)
+    
+    def __str__(self):
+        return f"Email - {self.hour:%Y-%m-%d %H:00}"
+
+class IntentHourlyMetrics(models.Model):
+    intent = models.ForeignKey(Intent, on_delete=models.CASCADE, null=True, blank=True)  # Null for interactions without a detected intent
+    hour = models.DateTimeField()  # Start of the hour
+    interactions_count = models.IntegerField(default=0)
+    successful_interactions = models.IntegerField(default=0)
+    handoffs_count = models.IntegerField(default=0)
+    confidence_sum = models.FloatField(default=0)
+    feedback_sum = models.IntegerField(default=0)
+    feedback_count = models.IntegerField(default=0)  # Rated interactions only
+    
+    class Meta:
+        unique_together = ('intent', 'hour')
+        indexes = [
+            models.Index(fields=['hour'], name='intent_hourly_hour_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.intent.name if self.intent else 'No intent'} - {self.hour:%Y-%m-%d %H:00}"
+
+class MetricsBackfillCheckpoint(models.Model):
+    name = models.CharField(max_length=100)
+    date = models.DateField()
+    channel = models.ForeignKey(Channel, on_delete=models.CASCADE, null=True, blank=True)  # Null for chatbot metrics
+    completed_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        unique_together = ('name', 'date', 'channel')
+    
+    def __str__(self):
+        return f"{self.name} - {self.date} - {self.channel_id or 'chatbot'}"
+
+
+class AnalyticsDataVersion(models.Model):
+    date = models.DateField(unique=True)
+    version = models.BigIntegerField(default=0)  # Bumped whenever data for the day is rewritten
+    
+    def __str__(self):
+        return f"{self.date} - v{self.version}"
+
+class ArchiveSegment(models.Model):
+    table = models.CharField(max_length=50)
+    month = models.DateField()  # First day of the month the rows belong to
+    path = models.CharField(max_length=255)  # Gzipped NDJSON file in default storage
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    time_field = models.CharField(max_length=50)  # Age column the rows were archived by; start_at and end_at are its range
+    start_at = models.DateTimeField()
+    end_at = models.DateTimeField()
+    row_count = models.IntegerField()
+    cutoff = models.DateTimeField()  # Rows older than this had been archived when the segment was written
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['table', 'month'], name='archive_table_month_idx'),
+            models.Index(fields=['table', 'first_id', 'last_id'], name='archive_table_ids_idx'),
+            models.Index(fields=['table', 'start_at', 'end_at'], name='archive_table_time_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.table} - {self.month:%Y-%m} - {self.path}"
@@ -0,0 +1,189 @@
+# analytics/realtime.py
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+from celery.signals import worker_process_shutdown
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F
+from communications.models import Channel
+from analytics.cache import analytics_cache
+from analytics.models import ChannelMetrics
+
+logger = logging.getLogger(__name__)
+
+# Flush once this many counter changes are pending, or once the oldest is this old;
+# a timer flushes an idle process's buffer after the interval too
+FLUSH_THRESHOLD = getattr(settings, 'REALTIME_METRICS_FLUSH_THRESHOLD', 500)
+FLUSH_INTERVAL = getattr(settings, 'REALTIME_METRICS_FLUSH_SECONDS', 10)
+
+
+def message_contribution(status, sent_at):
+    """ChannelMetrics counters a message in this state adds to its sent_at day"""
+    if not sent_at:
+        return {}
+    return {
+        'messages_sent': 1,
+        'messages_delivered': int(status == 'delivered'),
+        'messages_read': int(status == 'read'),
+    }
+
+
+class ChannelMetricsAccumulator:
+    """Buffers ChannelMetrics counter deltas in memory and flushes them as atomic increments
+
+    Deltas come from Message and Conversation post_save signals, so writes
+    that bypass save() - queryset update(), bulk_create(), bulk_update() -
+    are not counted. Code changing a message's status or sent_at that way
+    must report it through message_changed(); whatever still slips through
+    is corrected, and logged, by the nightly reconciliation in
+    generate_daily_metrics.
+
+    Every process buffers its own deltas. A timer flushes them at most
+    FLUSH_INTERVAL seconds after they were buffered, even if the process goes
+    idle, and the buffer is flushed when the process exits.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._touched = set()
+        self._pending_count = 0
+        self._oldest = None
+        self._timer = None
+
+    def _buffered(self):
+        # Called with the lock held; True once the buffer is due for a flush
+        self._pending_count += 1
+        self._oldest = self._oldest or time.monotonic()
+        self._schedule()
+        return self._pending_count >= FLUSH_THRESHOLD or time.monotonic() - self._oldest >= FLUSH_INTERVAL
+
+    def _schedule(self):
+        # Called with the lock held; makes sure a timer will flush what is buffered
+        if self._timer is None or not self._timer.is_alive():
+            self._timer = threading.Timer(FLUSH_INTERVAL, self._flush_on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_on_timer(self):
+        try:
+            self._flush_if_due(True)
+        finally:
+            # The timer thread's connections would otherwise stay open
+            connections.close_all()
+
+    def _flush_if_due(self, due):
+        if due:
+            # Runs inside the on_commit callback of whichever save filled the
+            # buffer; a failed flush keeps its deltas for the next one
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Flushing real-time channel metrics failed')
+
+    def add(self, channel_id, day, deltas):
+        """Record counter deltas for (channel, day), flushing if the buffer is full or old"""
+        deltas = {field: delta for field, delta in deltas.items() if delta}
+        if not deltas:
+            return
+
+        with self._lock:
+            self._pending.setdefault((channel_id, day), Counter()).update(deltas)
+            due = self._buffered()
+        self._flush_if_due(due)
+
+    def touch(self, day):
+        """Record a raw write that changes no counter, so the next flush still bumps the day's data version"""
+        with self._lock:
+            self._touched.add(day)
+            due = self._buffered()
+        self._flush_if_due(due)
+
+    def message_changed(self, channel_id, old_state, new_state):
+        """Record a message moving from one (status, sent_at) state to another"""
+        old_status, old_sent_at = old_state
+        new_status, new_sent_at = new_state
+        if old_state == new_state:
+            return
+
+        if old_sent_at:
+            removed = message_contribution(old_status, old_sent_at)
+            self.add(channel_id, old_sent_at.date(), {field: -count for field, count in removed.items()})
+        if new_sent_at:
+            self.add(channel_id, new_sent_at.date(), message_contribution(new_status, new_sent_at))
+
+    def conversation_started(self, channel_id, started_at):
+        """Record a new conversation"""
+        self.add(channel_id, started_at.date(), {'conversations_started': 1})
+
+    def _restore(self, pending, touched):
+        # Merged under deltas buffered since the swap, which are no older
+        with self._lock:
+            for key, deltas in pending.items():
+                self._pending.setdefault(key, Counter()).update(deltas)
+            self._touched |= touched
+            self._pending_count += len(pending) + len(touched)
+            self._oldest = self._oldest or time.monotonic()
+            self._schedule()
+
+    def flush(self):
+        """Apply all pending deltas as upserts on (channel, date) and bump the touched days' versions
+
+        If the write fails the deltas go back into the buffer and the error is
+        raised; nothing is lost.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            touched, self._touched = self._touched, set()
+            self._pending_count = 0
+            self._oldest = None
+            # Nothing is left for the timer; the next buffered delta starts a new one
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        if not pending and not touched:
+            return 0
+
+        try:
+            # Deltas of channels deleted since they were buffered have no row to land in
+            channel_ids = set(Channel.objects.filter(
+                id__in={channel_id for channel_id, _ in pending}
+            ).values_list('id', flat=True))
+            pending = {key: deltas for key, deltas in pending.items() if key[0] in channel_ids}
+
+            with transaction.atomic():
+                ChannelMetrics.objects.bulk_create(
+                    [ChannelMetrics(channel_id=channel_id, date=day) for channel_id, day in pending],
+                    ignore_conflicts=True
+                )
+                # Increments rather than writes, so concurrent flushes never lose counts
+                for (channel_id, day), deltas in pending.items():
+                    changes = {field: F(field) + delta for field, delta in deltas.items() if delta}
+                    if changes:
+                        ChannelMetrics.objects.filter(channel_id=channel_id, date=day).update(**changes)
+
+                analytics_cache.mark_rewritten({day for _, day in pending} | touched)
+        except Exception:
+            self._restore(pending, touched)
+            raise
+
+        return len(pending)
+
+
+accumulator = ChannelMetricsAccumulator()
+
+
+@atexit.register
+def flush_at_exit():
+    """Flush what this process still buffers as it exits"""
+    accumulator._flush_if_due(True)
+
+
+@worker_process_shutdown.connect
+def flush_worker_process(**kwargs):
+    """Flush a Celery worker process's buffer; pool processes exit without running atexit handlers"""
+    accumulator._flush_if_due(True)
@@ -1,71 +1,727 @@
-from datetime import datetime, timedelta
-from django.db.models import Avg, Count, Sum, F, ExpressionWrapper, fields
-from django.db.models.functions import TruncDate
-from celery import shared_task
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta
+from itertools import islice
+import numpy as np
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Avg, Count, Sum, Q, OuterRef, Subquery
+from django.db.models.functions import TruncDate, TruncHour
+from django.utils import timezone
+from celery import group, shared_task
 from communications.models import Channel, Message, Conversation, ConversationMessage
 from chatbot.models import ChatbotInteraction
-from analytics.models import ChannelMetrics, ChatbotMetrics
+from analytics.models import (
+    ChannelMetrics, ChatbotMetrics, ChannelHourlyMetrics, AccountHourlyMetrics, EmailHourlyMetrics,
+    IntentHourlyMetrics, MetricsBackfillCheckpoint
+)
+from analytics.archive import ArchiveService
+from analytics.cache import analytics_cache
+from analytics.eventstore import EventStore, TABLES as EVENT_STORE_TABLES
+from analytics.realtime import accumulator
+from analytics.sketches import LatencySketch
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_METRIC_FIELDS = [
+    'messages_sent',
+    'messages_delivered',
+    'messages_read',
+    'conversations_started',
+    'conversations_completed',
+    'average_response_time',
+    'response_time_p50',
+    'response_time_p90',
+    'response_time_p99',
+    'response_time_sketch',
+]
+
+# Daily ChannelMetrics columns returned as per-day series by get_channels_metrics
+CHANNEL_METRIC_SERIES = [
+    'messages_sent',
+    'messages_delivered',
+    'messages_read',
+    'conversations_started',
+    'conversations_completed',
+    'average_response_time',
+    'response_time_p50',
+    'response_time_p90',
+    'response_time_p99',
+]
+
+# Conversation messages held in memory at once while computing response times
+RESPONSE_TIME_CHUNK_SIZE = 50000
+
+# (day, channel) units recomputed and upserted together by one backfill worker
+BACKFILL_CHUNK_SIZE = 50
+
+# Additive counters, kept live in ChannelMetrics by analytics.realtime and
+# rebuilt per hour in ChannelHourlyMetrics by compute_hourly_rollups
+ROLLUP_FIELDS = [
+    'messages_sent',
+    'messages_delivered',
+    'messages_read',
+    'conversations_started',
+]
+
+# ChannelMetrics fields only computed once a day has closed
+CHANNEL_CLOSING_FIELDS = [field for field in CHANNEL_METRIC_FIELDS if field not in ROLLUP_FIELDS]
+
+# Days before yesterday re-exported to the event store on every run
+EVENT_STORE_REFRESH_DAYS = getattr(settings, 'EVENT_STORE_REFRESH_DAYS', 3)
+
+# Days before the closed one whose hourly rollups the nightly job rebuilds
+HOURLY_ROLLUP_REFRESH_DAYS = getattr(settings, 'HOURLY_ROLLUP_REFRESH_DAYS', 3)
+
+# Days before the closed one whose live counters the nightly job reconciles again.
+# A delta still buffered in another process when a day is first reconciled lands
+# on top of the corrected counts; the following nights correct it.
+REALTIME_RECONCILE_DAYS = getattr(settings, 'REALTIME_METRICS_RECONCILE_DAYS', 2)
+
+# Dashboard sources run concurrently on a shared pool of this many threads,
+# and any source still running after DASHBOARD_QUERY_TIMEOUT seconds is left out
+DASHBOARD_MAX_WORKERS = getattr(settings, 'DASHBOARD_MAX_WORKERS', 8)
+DASHBOARD_QUERY_TIMEOUT = getattr(settings, 'DASHBOARD_QUERY_TIMEOUT', 5)
+
+# Longest range, in days, the dashboard view accepts
+DASHBOARD_MAX_DAYS = getattr(settings, 'DASHBOARD_MAX_DAYS', 92)
+
+_dashboard_pool = None
+_dashboard_pool_lock = threading.Lock()
+
+# One per pool thread, held from submit until the source finishes, so sources
+# never queue behind ones that timed out but are still running
+_dashboard_slots = threading.BoundedSemaphore(DASHBOARD_MAX_WORKERS)
+
+
+def _get_dashboard_pool():
+    global _dashboard_pool
+    with _dashboard_pool_lock:
+        if _dashboard_pool is None:
+            _dashboard_pool = ThreadPoolExecutor(max_workers=DASHBOARD_MAX_WORKERS, thread_name_prefix='dashboard')
+        return _dashboard_pool
+
+
+def _release_dashboard_slot(future):
+    _dashboard_slots.release()
+
+
+def _run_dashboard_source(func, *args):
+    try:
+        return func(*args)
+    finally:
+        # Pool threads live outside the request cycle, so release their connections here
+        connections.close_all()
 
 class AnalyticsService:
     """Services for analytics data processing and retrieval"""
     
     @staticmethod
+    def day_bounds(day):
+        """Return the first and last instant of a day"""
+        return datetime.combine(day, datetime.min.time()), datetime.combine(day, datetime.max.time())
+    
+    @staticmethod
+    def compute_channel_metrics(day, channel_ids):
+        """Compute ChannelMetrics values for each channel on a day using set-based queries"""
+        counters = AnalyticsService.compute_channel_counters(day, channel_ids)
+        closing = AnalyticsService.compute_closing_metrics(day, channel_ids)
+        return {channel_id: {**counters[channel_id], **closing[channel_id]} for channel_id in channel_ids}
+    
+    @staticmethod
+    def compute_channel_counters(day, channel_ids):
+        """Compute the live counters (ROLLUP_FIELDS) of each channel on a day, one grouped count per table"""
+        start_of_day, end_of_day = AnalyticsService.day_bounds(day)
+        metrics = {
+            channel_id: {field: 0 for field in ROLLUP_FIELDS}
+            for channel_id in channel_ids
+        }
+        
+        # Count messages
+        message_stats = Message.objects.filter(
+            channel_id__in=channel_ids,
+            sent_at__gte=start_of_day,
+            sent_at__lte=end_of_day
+        ).values('channel_id').annotate(
+            sent=Count('id'),
+            delivered=Count('id', filter=Q(status='delivered')),
+            read=Count('id', filter=Q(status='read'))
+        )
+        
+        for stat in message_stats:
+            metrics[stat['channel_id']].update(
+                messages_sent=stat['sent'],
+                messages_delivered=stat['delivered'],
+                messages_read=stat['read']
+            )
+        
+        # Count conversations
+        conversation_stats = Conversation.objects.filter(
+            channel_id__in=channel_ids,
+            started_at__gte=start_of_day,
+            started_at__lte=end_of_day
+        ).values('channel_id').annotate(started=Count('id'))
+        
+        for stat in conversation_stats:
+            metrics[stat['channel_id']]['conversations_started'] = stat['started']
+        
+        return metrics
+    
+    @staticmethod
+    def compute_closing_metrics(day, channel_ids):
+        """Compute the CHANNEL_CLOSING_FIELDS of each channel on a day, which no event keeps current"""
+        start_of_day, end_of_day = AnalyticsService.day_bounds(day)
+        metrics = {
+            channel_id: {field: 0 for field in CHANNEL_CLOSING_FIELDS}
+            for channel_id in channel_ids
+        }
+        for values in metrics.values():
+            values['response_time_sketch'] = b''
+        
+        conversations = Conversation.objects.filter(
+            channel_id__in=channel_ids,
+            started_at__gte=start_of_day,
+            started_at__lte=end_of_day
+        )
+        
+        # A conversation is considered completed if the last message is from the system
+        # and there's been no user message in the last 4 hours
+        cutoff_time = end_of_day - timedelta(hours=4)
+        last_message = ConversationMessage.objects.filter(
+            conversation=OuterRef('pk')
+        ).order_by('-created_at')
+        
+        conversation_stats = conversations.annotate(
+            last_from_user=Subquery(last_message.values('is_from_user')[:1]),
+            last_at=Subquery(last_message.values('created_at')[:1])
+        ).values('channel_id').annotate(
+            completed=Count('id', filter=Q(last_from_user=False, last_at__lte=cutoff_time))
+        )
+        
+        for stat in conversation_stats:
+            metrics[stat['channel_id']]['conversations_completed'] = stat['completed']
+        
+        # Calculate response time statistics
+        # Time between user message and subsequent system response
+        for channel_id, stats in AnalyticsService.response_time_stats(conversations).items():
+            metrics[channel_id].update(
+                average_response_time=stats['mean'],
+                response_time_p50=stats['p50'],
+                response_time_p90=stats['p90'],
+                response_time_p99=stats['p99'],
+                response_time_sketch=stats['sketch']
+            )
+        
+        return metrics
+    
+    @staticmethod
+    def reconcile_channel_counters(day, channel_ids):
+        """Correct a day's live counters against the source tables; returns the rows that had drifted
+        
+        Only rows whose counters differ are written. Drift means counted
+        events were missed, e.g. writes that bypassed save(), so it is logged.
+        """
+        actual = AnalyticsService.compute_channel_counters(day, channel_ids)
+        stored = {
+            row.pop('channel_id'): row
+            for row in ChannelMetrics.objects.filter(date=day, channel_id__in=channel_ids).values('channel_id', *ROLLUP_FIELDS)
+        }
+        
+        drifted = {}
+        for channel_id, values in actual.items():
+            if values != stored.get(channel_id, {field: 0 for field in ROLLUP_FIELDS}):
+                drifted[(channel_id, day)] = values
+        
+        if drifted:
+            logger.info(
+                'Reconciled ChannelMetrics counters of %s for channels %s',
+                day, sorted(channel_id for channel_id, _ in drifted)
+            )
+            AnalyticsService.store_channel_metrics(drifted, ROLLUP_FIELDS)
+        
+        return drifted
+    
+    @staticmethod
+    def response_time_stats(conversations, chunk_size=RESPONSE_TIME_CHUNK_SIZE):
+        """Compute user-to-reply gap statistics per channel for the given conversations
+        
+        Messages are streamed as columns in bounded chunks and every conversation
+        in a chunk is paired at once: a reply is a system message whose previous
+        message in the same conversation is from the user.
+        """
+        rows = ConversationMessage.objects.filter(
+            conversation__in=conversations
+        ).order_by(
+            'conversation_id', 'created_at', 'id'
+        ).values_list(
+            'conversation__channel_id', 'conversation_id', 'created_at', 'is_from_user'
+        ).iterator(chunk_size=chunk_size)
+        
+        gaps = {}
+        previous = []
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            
+            # Carry the last row over so replies spanning chunks are paired
+            channel_ids, conversation_ids, created_at, from_user = zip(*(previous + chunk))
+            previous = chunk[-1:]
+            
+            channel_ids = np.array(channel_ids)
+            conversation_ids = np.array(conversation_ids)
+            from_user = np.array(from_user, dtype=bool)
+            # Offsets from the chunk start keep microsecond precision in float64
+            base = created_at[0]
+            seconds = np.array([(timestamp - base).total_seconds() for timestamp in created_at])
+            
+            is_reply = (conversation_ids[1:] == conversation_ids[:-1]) & from_user[:-1] & ~from_user[1:]
+            chunk_gaps = np.diff(seconds)[is_reply]
+            chunk_channels = channel_ids[1:][is_reply]
+            
+            for channel_id in np.unique(chunk_channels):
+                gaps.setdefault(int(channel_id), []).append(chunk_gaps[chunk_channels == channel_id])
+        
+        stats = {}
+        for channel_id, parts in gaps.items():
+            values = np.concatenate(parts)
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            stats[channel_id] = {
+                'count': len(values),
+                'mean': float(values.mean()),
+                'p50': float(p50),
+                'p90': float(p90),
+                'p99': float(p99),
+                'sketch': LatencySketch().add_many(values).to_bytes()
+            }
+        
+        return stats
+    
+    @staticmethod
+    def compute_chatbot_metrics(day):
+        """Compute ChatbotMetrics values for a day in a single aggregate query"""
+        start_of_day, end_of_day = AnalyticsService.day_bounds(day)
+        
+        stats = ChatbotInteraction.objects.filter(
+            timestamp__gte=start_of_day,
+            timestamp__lte=end_of_day
+        ).aggregate(
+            interactions_count=Count('id'),
+            successful_interactions=Count('id', filter=Q(confidence_score__gte=0.7)),
+            handoffs_count=Count('id', filter=Q(needs_handoff=True)),
+            average_confidence=Avg('confidence_score'),
+            average_feedback=Avg('feedback_rating')
+        )
+        
+        stats['average_confidence'] = stats['average_confidence'] or 0
+        stats['average_feedback'] = stats['average_feedback'] or 0
+        
+        return stats
+    
+    @staticmethod
+    def compute_hourly_metrics(hour):
+        """Roll one hour up into every hourly rollup table"""
+        return AnalyticsService.compute_hourly_rollups(hour, hour + timedelta(hours=1))
+    
+    @staticmethod
+    def compute_hourly_rollups(start, end):
+        """Rebuild every hourly rollup for the hours in [start, end); returns the rows written
+        
+        Each source is read with one query grouped by hour, and the range's
+        rows are replaced in one transaction, so an hour whose messages moved
+        or changed state is corrected wherever it lies in the range.
+        """
+        from email_service.models import EmailMessage
+        from whatsapp_service.models import WhatsAppMessage
+        
+        start = start.replace(minute=0, second=0, microsecond=0)
+        channel_rows = {}
+        
+        message_stats = Message.objects.filter(
+            sent_at__gte=start,
+            sent_at__lt=end
+        ).annotate(hour=TruncHour('sent_at')).values('channel_id', 'hour').annotate(
+            sent=Count('id'),
+            delivered=Count('id', filter=Q(status='delivered')),
+            read=Count('id', filter=Q(status='read'))
+        )
+        for stat in message_stats:
+            channel_rows.setdefault((stat['channel_id'], stat['hour']), {}).update(
+                messages_sent=stat['sent'],
+                messages_delivered=stat['delivered'],
+                messages_read=stat['read']
+            )
+        
+        conversation_stats = Conversation.objects.filter(
+            started_at__gte=start,
+            started_at__lt=end
+        ).annotate(hour=TruncHour('started_at')).values('channel_id', 'hour').annotate(started=Count('id'))
+        for stat in conversation_stats:
+            channel_rows.setdefault((stat['channel_id'], stat['hour']), {})['conversations_started'] = stat['started']
+        
+        account_stats = WhatsAppMessage.objects.filter(
+            message__sent_at__gte=start,
+            message__sent_at__lt=end
+        ).annotate(hour=TruncHour('message__sent_at')).values('account_id', 'hour').annotate(
+            messages_sent=Count('id'),
+            messages_delivered=Count('id', filter=Q(message__status='delivered')),
+            messages_read=Count('id', filter=Q(message__status='read')),
+            messages_failed=Count('id', filter=Q(message__status='failed'))
+        )
+        
+        email_stats = EmailMessage.objects.filter(
+            message__sent_at__gte=start,
+            message__sent_at__lt=end
+        ).annotate(hour=TruncHour('message__sent_at')).values('hour').annotate(
+            messages_sent=Count('id'),
+            messages_opened=Count('id', filter=Q(opens__gt=0)),
+            messages_clicked=Count('id', filter=Q(clicks__gt=0))
+        )
+        
+        intent_stats = ChatbotInteraction.objects.filter(
+            timestamp__gte=start,
+            timestamp__lt=end
+        ).annotate(hour=TruncHour('timestamp')).values('detected_intent_id', 'hour').annotate(
+            interactions_count=Count('id'),
+            # Success means confidence above threshold
+            successful_interactions=Count('id', filter=Q(confidence_score__gte=0.7)),
+            handoffs_count=Count('id', filter=Q(needs_handoff=True)),
+            confidence_sum=Sum('confidence_score'),
+            feedback_sum=Sum('feedback_rating'),
+            feedback_count=Count('feedback_rating')
+        )
+        
+        rollups = {
+            ChannelHourlyMetrics: [
+                ChannelHourlyMetrics(channel_id=channel_id, hour=hour, **values)
+                for (channel_id, hour), values in channel_rows.items()
+            ],
+            AccountHourlyMetrics: [AccountHourlyMetrics(**stat) for stat in account_stats],
+            EmailHourlyMetrics: [EmailHourlyMetrics(**stat) for stat in email_stats],
+            IntentHourlyMetrics: [
+                IntentHourlyMetrics(
+                    intent_id=stat.pop('detected_intent_id'),
+                    feedback_sum=stat.pop('feedback_sum') or 0,
+                    **stat
+                ) for stat in intent_stats
+            ],
+        }
+        
+        with transaction.atomic():
+            for model, rows in rollups.items():
+                model.objects.filter(hour__gte=start, hour__lt=end).delete()
+                model.objects.bulk_create(rows)
+            
+            days, day = [], start.date()
+            while day <= (end - timedelta(microseconds=1)).date():
+                days.append(day)
+                day += timedelta(days=1)
+            analytics_cache.mark_rewritten(days)
+        
+        return sum(len(rows) for rows in rollups.values())
+    
+    @staticmethod
+    def rollup_plan(start, end):
+        """Split [start, end) into whole days and the hourly ranges left at either edge"""
+        start = start.replace(minute=0, second=0, microsecond=0)
+        if end.minute or end.second or end.microsecond:
+            end = end.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        
+        def midnight(day):
+            return datetime.combine(day, datetime.min.time(), tzinfo=start.tzinfo)
+        
+        first_day = start.date() if start == midnight(start.date()) else start.date() + timedelta(days=1)
+        end_day = end.date()  # Exclusive
+        if first_day >= end_day:
+            return None, [(start, end)]
+        
+        hour_ranges = [
+            (a, b) for a, b in [(start, midnight(first_day)), (midnight(end_day), end)] if a < b
+        ]
+        return (first_day, end_day - timedelta(days=1)), hour_ranges
+    
+    @staticmethod
+    def store_channel_metrics(rows, fields=CHANNEL_METRIC_FIELDS):
+        """Upsert the given ChannelMetrics fields keyed by (channel_id, day) in one statement"""
+        ChannelMetrics.objects.bulk_create(
+            [ChannelMetrics(channel_id=channel_id, date=day, **values) for (channel_id, day), values in rows.items()],
+            update_conflicts=True,
+            unique_fields=['channel', 'date'],
+            update_fields=fields
+        )
+    
+    @staticmethod
+    def backfill_units(start_date, end_date, name, channel_ids=None):
+        """Split a date range into the (day, channel) units a backfill still has to run
+        
+        A channel of None stands for the day's chatbot metrics and hourly rollups. Units already
+        checkpointed under the same backfill name are skipped, so an interrupted
+        backfill resumes where it stopped.
+        """
+        if channel_ids is None:
+            channel_ids = list(Channel.objects.filter(is_active=True).values_list('id', flat=True))
+        
+        # Raw rows of archived days are gone, so recomputing them would wipe their rollups
+        hot_since = ArchiveService.hot_since()
+        if hot_since and start_date < hot_since:
+            start_date = hot_since
+        
+        done = set(MetricsBackfillCheckpoint.objects.filter(
+            name=name,
+            date__gte=start_date,
+            date__lte=end_date
+        ).values_list('date', 'channel_id'))
+        
+        units = []
+        day = start_date
+        while day <= end_date:
+            for channel_id in [None] + list(channel_ids):
+                if (day, channel_id) not in done:
+                    units.append((day.isoformat(), channel_id))
+            day += timedelta(days=1)
+        
+        return units
+    
+    @staticmethod
+    def run_backfill_units(units, name):
+        """Recompute a list of (day, channel) units, upsert the results in bulk and checkpoint them"""
+        channels_by_day = {}
+        chatbot_days = []
+        for day, channel_id in units:
+            day = date.fromisoformat(day)
+            if channel_id is None:
+                chatbot_days.append(day)
+            else:
+                channels_by_day.setdefault(day, []).append(channel_id)
+        
+        # Channels sharing a day are computed together, one query per metric family
+        channel_rows = {}
+        for day, channel_ids in channels_by_day.items():
+            for channel_id, values in AnalyticsService.compute_channel_metrics(day, channel_ids).items():
+                channel_rows[(channel_id, day)] = values
+        chatbot_rows = {day: AnalyticsService.compute_chatbot_metrics(day) for day in chatbot_days}
+        
+        with transaction.atomic():
+            AnalyticsService.store_channel_metrics(channel_rows)
+            for day, values in chatbot_rows.items():
+                ChatbotMetrics.objects.update_or_create(date=day, defaults=values)
+                AnalyticsService.compute_hourly_rollups(
+                    datetime.combine(day, datetime.min.time()),
+                    datetime.combine(day + timedelta(days=1), datetime.min.time())
+                )
+            
+            MetricsBackfillCheckpoint.objects.bulk_create([
+                MetricsBackfillCheckpoint(name=name, date=date.fromisoformat(day), channel_id=channel_id)
+                for day, channel_id in units
+            ], ignore_conflicts=True)
+            
+            analytics_cache.mark_rewritten(list(channels_by_day) + chatbot_days)
+        
+        return len(units)
+    
+    @staticmethod
+    @analytics_cache.cached
     def get_channel_metrics(channel_id, start_date, end_date):
         """Get metrics for a specific channel in date range"""
-        metrics = ChannelMetrics.objects.filter(
-            channel_id=channel_id,
+        return AnalyticsService.get_channels_metrics([channel_id], start_date, end_date)[channel_id]
+    
+    @staticmethod
+    @analytics_cache.cached
+    def get_channels_metrics(channel_ids, start_date, end_date):
+        """Get metrics for several channels in date range with one query, keyed by channel id"""
+        rows = list(ChannelMetrics.objects.filter(
+            channel_id__in=channel_ids,
             date__gte=start_date,
             date__lte=end_date
-        ).order_by('date')
-        
-        # Format for charts and tables
-        result = {
-            'dates': [],
-            'messages_sent': [],
-            'messages_delivered': [],
-            'messages_read': [],
-            'conversations_started': [],
-            'conversations_completed': [],
-            'average_response_time': []
+        ).order_by('channel_id', 'date').values_list(
+            'channel_id', 'date', 'response_time_sketch', *CHANNEL_METRIC_SERIES
+        ))
+        
+        # One column per field; rows are sorted by channel so each channel is a contiguous run
+        counters = ROLLUP_FIELDS + ['conversations_completed']
+        row_channels = np.array([row[0] for row in rows], dtype=np.int64)
+        columns = {
+            field: np.array([row[3 + i] for row in rows], dtype=np.int64 if field in counters else float)
+            for i, field in enumerate(CHANNEL_METRIC_SERIES)
         }
+        channel_ids = list(channel_ids)
+        firsts = np.searchsorted(row_channels, channel_ids, side='left')
+        lasts = np.searchsorted(row_channels, channel_ids, side='right')
+        
+        # Totals of every channel at once, as differences of running sums at run boundaries
+        totals = {}
+        for field in counters:
+            running = np.concatenate([[0], np.cumsum(columns[field])])
+            totals[field] = running[lasts] - running[firsts]
+        
+        results = {}
+        for index, channel_id in enumerate(channel_ids):
+            first, last = int(firsts[index]), int(lasts[index])
+            result = {'dates': [rows[i][1].strftime('%Y-%m-%d') for i in range(first, last)]}
+            for field in CHANNEL_METRIC_SERIES:
+                result[field] = columns[field][first:last].tolist()
+            
+            # Response times are merged from the daily sketches rather than
+            # averaging daily means, which would weight quiet days like busy ones
+            response_times = LatencySketch.merge_all(rows[i][2] for i in range(first, last))
+            
+            sent = int(totals['messages_sent'][index])
+            delivered = int(totals['messages_delivered'][index])
+            read = int(totals['messages_read'][index])
+            result['totals'] = {
+                'messages_sent': sent,
+                'messages_delivered': delivered,
+                'messages_read': read,
+                'conversations_started': int(totals['conversations_started'][index]),
+                'conversations_completed': int(totals['conversations_completed'][index]),
+                'average_response_time': response_times.mean,
+                'response_time_p50': response_times.quantile(0.5),
+                'response_time_p95': response_times.quantile(0.95),
+                'response_time_p99': response_times.quantile(0.99),
+                'delivery_rate': delivered / sent * 100 if sent > 0 else 0,
+                'read_rate': read / delivered * 100 if delivered > 0 else 0
+            }
+            results[channel_id] = result
         
-        for metric in metrics:
-            result['dates'].append(metric.date.strftime('%Y-%m-%d'))
-            result['messages_sent'].append(metric.messages_sent)
-            result['messages_delivered'].append(metric.messages_delivered)
-            result['messages_read'].append(metric.messages_read)
-            result['conversations_started'].append(metric.conversations_started)
-            result['conversations_completed'].append(metric.conversations_completed)
-            result['average_response_time'].append(metric.average_response_time)
-        
-        # Calculate totals and averages
-        result['totals'] = {
-            'messages_sent': sum(result['messages_sent']),
-            'messages_delivered': sum(result['messages_delivered']),
-            'messages_read': sum(result['messages_read']),
-            'conversations_started': sum(result['conversations_started']),
-            'conversations_completed': sum(result['conversations_completed']),
-            'average_response_time': sum(result['average_response_time']) / len(result['average_response_time']) if result['average_response_time'] else 0,
-            'delivery_rate': sum(result['messages_delivered']) / sum(result['messages_sent']) * 100 if sum(result['messages_sent']) > 0 else 0,
-            'read_rate': sum(result['messages_read']) / sum(result['messages_delivered']) * 100 if sum(result['messages_delivered']) > 0 else 0
+        return results
+    
+    @staticmethod
+    def get_dashboard(start_date, end_date, timeout=None):
+        """Cross-channel overview of the whole days start_date to end_date, every source queried concurrently
+        
+        Returns whatever sources finish within the timeout; the rest are listed
+        under 'errors' as 'timeout', 'error', or 'busy' when every pool thread
+        is still taken by earlier sources.
+        """
+        timeout = DASHBOARD_QUERY_TIMEOUT if timeout is None else timeout
+        channels = list(Channel.objects.filter(is_active=True).values_list('id', 'name'))
+        
+        # Sources filtering on timestamps get the whole of both end days
+        start = timezone.make_aware(datetime.combine(start_date, datetime.min.time()))
+        end = timezone.make_aware(datetime.combine(end_date, datetime.max.time()))
+        
+        sources = {
+            'email': (AnalyticsService.get_email_performance, start, end),
+            'whatsapp': (AnalyticsService.get_whatsapp_performance, start, end),
+            'chatbot': (AnalyticsService.get_chatbot_metrics, start, end),
+            'channels': (AnalyticsService.get_channels_metrics, [channel_id for channel_id, _ in channels], start_date, end_date),
         }
         
+        pool = _get_dashboard_pool()
+        result = {'errors': {}}
+        futures = {}
+        for source, call in sources.items():
+            if not _dashboard_slots.acquire(blocking=False):
+                result['errors'][source] = 'busy'
+                continue
+            future = pool.submit(_run_dashboard_source, *call)
+            future.add_done_callback(_release_dashboard_slot)
+            futures[future] = source
+        done, pending = wait(futures, timeout=timeout)
+        
+        for future, source in futures.items():
+            if future in pending:
+                # A query that already started cannot be interrupted; its result is just dropped
+                future.cancel()
+                result['errors'][source] = 'timeout'
+            elif future.exception():
+                # Details stay in the logs; the payload goes to the browser
+                logger.error('Dashboard source %s failed', source, exc_info=future.exception())
+                result['errors'][source] = 'error'
+            else:
+                result[source] = future.result()
+        
+        if 'channels' in result:
+            result['channels'] = {name: result['channels'][channel_id] for channel_id, name in channels}
+        
         return result
     
     @staticmethod
+    @analytics_cache.cached
+    def get_channel_activity(channel_id, start, end):
+        """Get message and conversation counts for a channel between two datetimes
+        
+        Reads whole days from ChannelMetrics and only the edge hours from
+        ChannelHourlyMetrics, so any range costs at most two small queries.
+        """
+        days, hour_ranges = AnalyticsService.rollup_plan(start, end)
+        totals = {field: 0 for field in ROLLUP_FIELDS}
+        sums = {field: Sum(field) for field in ROLLUP_FIELDS}
+        
+        partials = []
+        if days:
+            partials.append(ChannelMetrics.objects.filter(
+                channel_id=channel_id,
+                date__gte=days[0],
+                date__lte=days[1]
+            ).aggregate(**sums))
+        
+        if hour_ranges:
+            in_hours = Q()
+            for range_start, range_end in hour_ranges:
+                in_hours |= Q(hour__gte=range_start, hour__lt=range_end)
+            partials.append(ChannelHourlyMetrics.objects.filter(
+                in_hours,
+                channel_id=channel_id
+            ).aggregate(**sums))
+        
+        for partial in partials:
+            for field in ROLLUP_FIELDS:
+                totals[field] += partial[field] or 0
+        
+        totals['delivery_rate'] = totals['messages_delivered'] / totals['messages_sent'] * 100 if totals['messages_sent'] > 0 else 0
+        totals['read_rate'] = totals['messages_read'] / totals['messages_delivered'] * 100 if totals['messages_delivered'] > 0 else 0
+        
+        return totals
+    
+    @staticmethod
+    @analytics_cache.cached
+    def get_account_activity(start, end):
+        """Get WhatsApp message counts per account between two datetimes from hourly rollups"""
+        start = start.replace(minute=0, second=0, microsecond=0)
+        
+        account_stats = AccountHourlyMetrics.objects.filter(
+            hour__gte=start,
+            hour__lt=end
+        ).values(
+            'account__name'
+        ).annotate(
+            sent=Sum('messages_sent'),
+            delivered=Sum('messages_delivered'),
+            read=Sum('messages_read'),
+            failed=Sum('messages_failed')
+        ).order_by('account__name')
+        
+        return [{
+            'account': stat['account__name'],
+            'sent': stat['sent'],
+            'delivered': stat['delivered'],
+            'read': stat['read'],
+            'failed': stat['failed'],
+            'delivery_rate': (stat['delivered'] / stat['sent'] * 100) if stat['sent'] > 0 else 0,
+            'read_rate': (stat['read'] / stat['delivered'] * 100) if stat['delivered'] > 0 else 0
+        } for stat in account_stats]
+    
+    @staticmethod
+    @analytics_cache.cached
     def get_email_performance(start_date, end_date):
-        """Get email specific performance metrics"""
-        from email_service.models import EmailMessage, EmailClick
-        
-        # Get basic delivery metrics
-        emails = EmailMessage.objects.filter(
-            message__sent_at__gte=start_date,
-            message__sent_at__lte=end_date
-        ).select_related('message')
+        """Get email specific performance metrics from the hourly email rollups"""
+        emails = EmailHourlyMetrics.objects.filter(
+            hour__gte=start_date,
+            hour__lte=end_date
+        )
         
-        total_sent = emails.count()
-        total_opened = emails.filter(opens__gt=0).count()
-        total_clicked = emails.filter(clicks__gt=0).count()
+        # One aggregate for the whole summary
+        counts = {
+            'sent': Sum('messages_sent'),
+            'opened': Sum('messages_opened'),
+            'clicked': Sum('messages_clicked')
+        }
+        summary = emails.aggregate(**counts)
+        total_sent = summary['sent'] or 0
+        total_opened = summary['opened'] or 0
+        total_clicked = summary['clicked'] or 0
         
         # Calculate rates
         open_rate = (total_opened / total_sent * 100) if total_sent > 0 else 0
@@ -74,12 +730,8 @@ class AnalyticsService:
         
         # Get daily stats
         daily_stats = emails.annotate(
-            date=TruncDate('message__sent_at')
-        ).values('date').annotate(
-            sent=Count('id'),
-            opened=Count('id', filter=F('opens') > 0),
-            clicked=Count('id', filter=F('clicks') > 0)
-        ).order_by('date')
+            date=TruncDate('hour')
+        ).values('date').annotate(**counts).order_by('date')
         
         # Format for response
         result = {
@@ -104,19 +756,24 @@ class AnalyticsService:
         return result
     
     @staticmethod
+    @analytics_cache.cached
     def get_whatsapp_performance(start_date, end_date):
-        """Get WhatsApp specific performance metrics"""
-        from whatsapp_service.models import WhatsAppMessage
-        
-        # Get basic delivery metrics
-        whatsapp_messages = WhatsAppMessage.objects.filter(
-            message__sent_at__gte=start_date,
-            message__sent_at__lte=end_date
-        ).select_related('message', 'account')
+        """Get WhatsApp specific performance metrics from the hourly account rollups"""
+        whatsapp_messages = AccountHourlyMetrics.objects.filter(
+            hour__gte=start_date,
+            hour__lte=end_date
+        )
         
-        total_sent = whatsapp_messages.count()
-        total_delivered = whatsapp_messages.filter(message__status='delivered').count()
-        total_read = whatsapp_messages.filter(message__status='read').count()
+        # One aggregate for the whole summary
+        counts = {
+            'sent': Sum('messages_sent'),
+            'delivered': Sum('messages_delivered'),
+            'read': Sum('messages_read')
+        }
+        summary = whatsapp_messages.aggregate(**counts)
+        total_sent = summary['sent'] or 0
+        total_delivered = summary['delivered'] or 0
+        total_read = summary['read'] or 0
         
         # Calculate delivery and read rates
         delivery_rate = (total_delivered / total_sent * 100) if total_sent > 0 else 0
@@ -126,20 +783,14 @@ class AnalyticsService:
         account_stats = whatsapp_messages.values(
             'account__name'
         ).annotate(
-            sent=Count('id'),
-            delivered=Count('id', filter=F('message__status') == 'delivered'),
-            read=Count('id', filter=F('message__status') == 'read'),
-            failed=Count('id', filter=F('message__status') == 'failed')
-        )
+            failed=Sum('messages_failed'),
+            **counts
+        ).order_by('account__name')
         
         # Get daily stats
         daily_stats = whatsapp_messages.annotate(
-            date=TruncDate('message__sent_at')
-        ).values('date').annotate(
-            sent=Count('id'),
-            delivered=Count('id', filter=F('message__status') == 'delivered'),
-            read=Count('id', filter=F('message__status') == 'read')
-        ).order_by('date')
+            date=TruncDate('hour')
+        ).values('date').annotate(**counts).order_by('date')
         
         # Format for response
         result = {
@@ -172,41 +823,40 @@ class AnalyticsService:
         return result
     
     @staticmethod
+    @analytics_cache.cached
     def get_chatbot_metrics(start_date, end_date):
-        """Get chatbot performance metrics"""
-        # Get all chatbot interactions in time period
-        interactions = ChatbotInteraction.objects.filter(
-            timestamp__gte=start_date,
-            timestamp__lte=end_date
+        """Get chatbot performance metrics from the hourly intent rollups"""
+        interactions = IntentHourlyMetrics.objects.filter(
+            hour__gte=start_date,
+            hour__lte=end_date
         )
         
-        total_interactions = interactions.count()
+        # Averages are rebuilt from sums, so they weigh every interaction equally
+        sums = {
+            'count': Sum('interactions_count'),
+            'successful': Sum('successful_interactions'),
+            'handoffs': Sum('handoffs_count'),
+            'confidence': Sum('confidence_sum'),
+            'feedback': Sum('feedback_sum'),
+            'rated': Sum('feedback_count')
+        }
+        summary = interactions.aggregate(**sums)
         
-        # Calculate success rate (interactions with confidence above threshold)
-        successful = interactions.filter(confidence_score__gte=0.7).count()
+        total_interactions = summary['count'] or 0
+        successful = summary['successful'] or 0
         success_rate = (successful / total_interactions * 100) if total_interactions > 0 else 0
         
-        # Get handoffs
-        handoffs = interactions.filter(conversation__metadata__has_key='needs_handoff').count()
+        handoffs = summary['handoffs'] or 0
         handoff_rate = (handoffs / total_interactions * 100) if total_interactions > 0 else 0
         
-        # Calculate average feedback
-        avg_feedback = interactions.exclude(
-            feedback_rating=None
-        ).aggregate(
-            avg=Avg('feedback_rating')
-        )['avg'] or 0
+        avg_feedback = summary['feedback'] / summary['rated'] if summary['rated'] else 0
         
         # Get intents breakdown
         intent_stats = interactions.exclude(
-            detected_intent=None
+            intent=None
         ).values(
-            'detected_intent__name'
-        ).annotate(
-            count=Count('id'),
-            avg_confidence=Avg('confidence_score'),
-            avg_feedback=Avg('feedback_rating')
-        ).order_by('-count')
+            'intent__name'
+        ).annotate(**sums).order_by('-count')
         
         # Format for response
         result = {
@@ -219,120 +869,127 @@ class AnalyticsService:
                 'avg_feedback': avg_feedback
             },
             'by_intent': [{
-                'intent': stat['detected_intent__name'],
+                'intent': stat['intent__name'],
                 'count': stat['count'],
                 'percentage': (stat['count'] / total_interactions * 100) if total_interactions > 0 else 0,
-                'avg_confidence': stat['avg_confidence'],
-                'avg_feedback': stat['avg_feedback'] or 0
+                'avg_confidence': stat['confidence'] / stat['count'],
+                'avg_feedback': stat['feedback'] / stat['rated'] if stat['rated'] else 0
             } for stat in intent_stats]
         }
         
         return result
 
-
 @shared_task
-def generate_daily_metrics():
-    """Generate daily metrics for all channels"""
-    yesterday = datetime.now().date() - timedelta(days=1)
-    start_of_day = datetime.combine(yesterday, datetime.min.time())
-    end_of_day = datetime.combine(yesterday, datetime.max.time())
-    
-    # Process each channel
-    channels = Channel.objects.filter(is_active=True)
-    for channel in channels:
-        # Count messages
-        messages = Message.objects.filter(
-            channel=channel,
-            sent_at__gte=start_of_day,
-            sent_at__lte=end_of_day
-        )
-        
-        messages_sent = messages.count()
-        messages_delivered = messages.filter(status='delivered').count()
-        messages_read = messages.filter(status='read').count()
-        
-        # Count conversations
-        conversations = Conversation.objects.filter(
-            channel=channel,
-            started_at__gte=start_of_day,
-            started_at__lte=end_of_day
-        )
-        
-        conversations_started = conversations.count()
-        
-        # Count completed conversations
-        # A conversation is considered completed if the last message is from the system
-        # and there's been no user message in the last 4 hours
-        cutoff_time = end_of_day - timedelta(hours=4)
-        conversations_completed = 0
-        
-        for conv in conversations:
-            last_message = ConversationMessage.objects.filter(
-                conversation=conv
-            ).order_by('-created_at').first()
-            
-            if last_message and not last_message.is_from_user and last_message.created_at <= cutoff_time:
-                conversations_completed += 1
-        
-        # Calculate average response time
-        # Time between user message and subsequent system response
-        response_times = []
-        
-        for conv in conversations:
-            messages = ConversationMessage.objects.filter(
-                conversation=conv
-            ).order_by('created_at')
-            
-            user_message_time = None
-            
-            for msg in messages:
-                if msg.is_from_user:
-                    user_message_time = msg.created_at
-                elif user_message_time:
-                    # Calculate response time in seconds
-                    response_time = (msg.created_at - user_message_time).total_seconds()
-                    response_times.append(response_time)
-                    user_message_time = None
-        
-        avg_response_time = sum(response_times) / len(response_times) if response_times else 0
-        
-        # Create or update metrics record
-        ChannelMetrics.objects.update_or_create(
-            channel=channel,
-            date=yesterday,
-            defaults={
-                'messages_sent': messages_sent,
-                'messages_delivered': messages_delivered,
-                'messages_read': messages_read,
-                'conversations_started': conversations_started,
-                'conversations_completed': conversations_completed,
-                'average_response_time': avg_response_time
-            }
-        )
+def generate_daily_metrics(day=None):
+    """Close a day's metrics for all channels
     
-    # Generate chatbot metrics
-    interactions = ChatbotInteraction.objects.filter(
-        timestamp__gte=start_of_day,
-        timestamp__lte=end_of_day
-    )
+    Counters are kept current by analytics.signals during the day, so here
+    they are only reconciled: one grouped count per table, writing just the
+    rows that drifted. The REALTIME_RECONCILE_DAYS days before are reconciled
+    again, after every process has flushed what it buffered for them. Completed conversations and response times have no
+    event to follow and are computed for the day.
+    """
+    if day:
+        # Celery delivers the day as an ISO string
+        day = date.fromisoformat(day) if isinstance(day, str) else day
+    else:
+        day = datetime.now().date() - timedelta(days=1)
+    accumulator.flush()
     
-    interactions_count = interactions.count()
-    successful_interactions = interactions.filter(confidence_score__gte=0.7).count()
-    handoffs_count = interactions.filter(conversation__metadata__has_key='needs_handoff').count()
+    channel_ids = list(Channel.objects.filter(is_active=True).values_list('id', flat=True))
+    for offset in range(REALTIME_RECONCILE_DAYS, -1, -1):
+        AnalyticsService.reconcile_channel_counters(day - timedelta(days=offset), channel_ids)
     
-    avg_confidence = interactions.aggregate(avg=Avg('confidence_score'))['avg'] or 0
-    avg_feedback = interactions.exclude(feedback_rating=None).aggregate(avg=Avg('feedback_rating'))['avg'] or 0
+    closing_metrics = AnalyticsService.compute_closing_metrics(day, channel_ids)
+    AnalyticsService.store_channel_metrics({
+        (channel_id, day): values for channel_id, values in closing_metrics.items()
+    }, CHANNEL_CLOSING_FIELDS)
     
     # Create or update chatbot metrics
     ChatbotMetrics.objects.update_or_create(
-        date=yesterday,
-        defaults={
-            'interactions_count': interactions_count,
-            'successful_interactions': successful_interactions,
-            'handoffs_count': handoffs_count,
-            'average_confidence': avg_confidence,
-            'average_feedback': avg_feedback
-        }
+        date=day,
+        defaults=AnalyticsService.compute_chatbot_metrics(day)
+    )
+    
+    # Hours of recent days still change after the day closes
+    AnalyticsService.compute_hourly_rollups(
+        datetime.combine(day - timedelta(days=HOURLY_ROLLUP_REFRESH_DAYS), datetime.min.time()),
+        datetime.combine(day + timedelta(days=1), datetime.min.time())
     )
     
+    analytics_cache.mark_rewritten([day])
+    
+    return True
+
+
+@shared_task
+def generate_hourly_metrics(hour=None):
+    """Rebuild the hourly rollups of today so far, or of one given hour
+    
+    Deliveries, reads, opens and feedback keep changing earlier hours, so the
+    whole day is rebuilt, including the previous hour when it belongs to
+    yesterday; it costs the same grouped queries as a single hour.
+    """
+    if hour:
+        start = datetime.fromisoformat(hour)
+        end = start + timedelta(hours=1)
+    else:
+        current_hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+        start = datetime.combine((current_hour - timedelta(hours=1)).date(), datetime.min.time())
+        end = current_hour + timedelta(hours=1)
+    
+    AnalyticsService.compute_hourly_rollups(start, end)
+    
     return True
+
+
+@shared_task
+def flush_realtime_metrics():
+    """Flush buffered real-time channel metric counters"""
+    return accumulator.flush()
+
+
+@shared_task
+def backfill_metrics(start_date, end_date, name=None, channel_ids=None, chunk_size=BACKFILL_CHUNK_SIZE):
+    """Rebuild metrics for a date range by fanning chunks of (day, channel) units out to workers"""
+    start_date = date.fromisoformat(start_date)
+    end_date = date.fromisoformat(end_date)
+    name = name or f"{start_date.isoformat()}:{end_date.isoformat()}"
+    
+    units = AnalyticsService.backfill_units(start_date, end_date, name, channel_ids)
+    group(
+        backfill_metrics_chunk.s(units[i:i + chunk_size], name)
+        for i in range(0, len(units), chunk_size)
+    ).apply_async()
+    
+    return len(units)
+
+
+@shared_task
+def backfill_metrics_chunk(units, name):
+    """Recompute one chunk of backfill units"""
+    return AnalyticsService.run_backfill_units(units, name)
+
+
+@shared_task
+def export_event_store(day=None, tables=None):
+    """Snapshot recent days of the event tables into the columnar event store"""
+    if day:
+        days = [date.fromisoformat(day)]
+    else:
+        # Statuses keep changing for a while after sending, so recent days are re-exported
+        yesterday = datetime.now().date() - timedelta(days=1)
+        days = [yesterday - timedelta(days=offset) for offset in range(EVENT_STORE_REFRESH_DAYS)]
+    
+    exported = 0
+    for table in tables or EVENT_STORE_TABLES:
+        for export_day in days:
+            exported += EventStore.export_day(table, export_day)
+    
+    return exported
+
+
+@shared_task
+def archive_cold_rows():
+    """Move messages, conversation messages and interactions past the archive horizon out of the hot tables"""
+    return ArchiveService.archive_all()
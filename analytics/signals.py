@@ -0,0 +1,42 @@
+# analytics/signals.py
+from django.db import transaction
+from django.db.models.signals import post_init, post_save
+from django.dispatch import receiver
+from communications.models import Message, Conversation
+from chatbot.models import ChatbotInteraction
+from analytics.realtime import accumulator
+
+
+def _message_state(instance):
+    # Read from __dict__ so deferred fields aren't fetched just to be tracked
+    return instance.__dict__.get('status'), instance.__dict__.get('sent_at')
+
+
+@receiver(post_init, sender=Message)
+def remember_message_state(sender, instance, **kwargs):
+    """Keep the loaded state so saves can be turned into counter deltas"""
+    instance._metrics_state = _message_state(instance)
+
+
+@receiver(post_save, sender=Message)
+def track_message_status(sender, instance, created, **kwargs):
+    """Update sent/delivered/read counters when a message changes state"""
+    old_state = (None, None) if created else instance._metrics_state
+    new_state = _message_state(instance)
+    instance._metrics_state = new_state
+
+    # Only count changes that actually commit
+    transaction.on_commit(lambda: accumulator.message_changed(instance.channel_id, old_state, new_state))
+
+
+@receiver(post_save, sender=Conversation)
+def track_conversation_started(sender, instance, created, **kwargs):
+    """Count new conversations as they are created"""
+    if created:
+        transaction.on_commit(lambda: accumulator.conversation_started(instance.channel_id, instance.started_at))
+
+
+@receiver(post_save, sender=ChatbotInteraction)
+def track_interaction(sender, instance, **kwargs):
+    """Invalidate cached results for the day of a new or changed interaction"""
+    transaction.on_commit(lambda: accumulator.touch(instance.timestamp.date()))
@@ -0,0 +1,118 @@
+# analytics/sketches.py
+import math
+import struct
+import numpy as np
+
+# Quantiles read back from a sketch are within this relative error of a real sample
+SKETCH_RELATIVE_ACCURACY = 0.01
+
+# version, relative accuracy, zero count, sum of values, number of buckets
+_HEADER = struct.Struct('<BdQdI')
+
+
+class LatencySketch:
+    """Mergeable log-bucketed histogram of durations in seconds
+
+    A value x lands in bucket ceil(log_gamma(x)), so every bucket spans a fixed
+    relative width and sketches built with the same accuracy merge by adding
+    bucket counts. Serialized sketches are a few KB at most, whatever the
+    number of samples.
+    """
+    VERSION = 1
+
+    # Durations below a millisecond are counted as zero
+    MIN_VALUE = 1e-3
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.indexes = np.zeros(0, dtype=np.int32)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.zero_count = 0
+        self.total = 0.0
+
+    @property
+    def count(self):
+        return self.zero_count + int(self.counts.sum())
+
+    @property
+    def mean(self):
+        count = self.count
+        return self.total / count if count else 0
+
+    def _absorb(self, indexes, counts):
+        indexes = np.concatenate([self.indexes, indexes])
+        counts = np.concatenate([self.counts, counts])
+        self.indexes, inverse = np.unique(indexes, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts, minlength=len(self.indexes)).astype(np.int64)
+
+    def add_many(self, values):
+        """Add an array of durations"""
+        values = np.asarray(values, dtype=float)
+        positive = values[values > self.MIN_VALUE]
+        self.zero_count += len(values) - len(positive)
+        self.total += float(values.sum())
+
+        indexes = np.ceil(np.log(positive) / self.log_gamma).astype(np.int32)
+        self._absorb(indexes, np.ones(len(indexes), dtype=np.int64))
+        return self
+
+    def merge(self, other):
+        """Fold another sketch with the same accuracy into this one"""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+        self.zero_count += other.zero_count
+        self.total += other.total
+        self._absorb(other.indexes, other.counts)
+        return self
+
+    def quantile(self, q):
+        """Approximate q-quantile (0 <= q <= 1) of the added durations"""
+        count = self.count
+        if not count:
+            return 0
+        rank = q * (count - 1)
+        if rank < self.zero_count:
+            return 0.0
+
+        bucket = np.searchsorted(np.cumsum(self.counts), rank - self.zero_count, side='right')
+        bucket = min(bucket, len(self.indexes) - 1)
+        # Midpoint of the bucket in relative terms
+        return float(2 * self.gamma ** int(self.indexes[bucket]) / (self.gamma + 1))
+
+    def to_bytes(self):
+        header = _HEADER.pack(self.VERSION, self.relative_accuracy, self.zero_count, self.total, len(self.indexes))
+        return header + self.indexes.astype('<i4').tobytes() + self.counts.astype('<i8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        version, relative_accuracy, zero_count, total, size = _HEADER.unpack_from(data)
+        if version != cls.VERSION:
+            raise ValueError(f"Unsupported sketch version {version}")
+
+        sketch = cls(relative_accuracy)
+        sketch.zero_count = zero_count
+        sketch.total = total
+        offset = _HEADER.size
+        sketch.indexes = np.frombuffer(data, dtype='<i4', count=size, offset=offset).astype(np.int32)
+        sketch.counts = np.frombuffer(data, dtype='<i8', count=size, offset=offset + 4 * size).astype(np.int64)
+        return sketch
+
+    @classmethod
+    def merge_all(cls, blobs):
+        """Merge serialized sketches in one pass; empty blobs are skipped"""
+        sketches = [cls.from_bytes(bytes(blob)) for blob in blobs if blob]
+        merged = cls(sketches[0].relative_accuracy if sketches else SKETCH_RELATIVE_ACCURACY)
+        if not sketches:
+            return merged
+
+        if any(sketch.relative_accuracy != merged.relative_accuracy for sketch in sketches):
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+        merged.zero_count = sum(sketch.zero_count for sketch in sketches)
+        merged.total = sum(sketch.total for sketch in sketches)
+        merged._absorb(
+            np.concatenate([sketch.indexes for sketch in sketches]),
+            np.concatenate([sketch.counts for sketch in sketches])
+        )
+        return merged
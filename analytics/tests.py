@@ -1,3 +1,851 @@
-from django.test import TestCase
+import os
+import random
+import shutil
+import tempfile
+import threading
+from datetime import date, datetime, timedelta
+from unittest import mock
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError
+from django.db.models import Avg, Count, F, Max, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from communications.models import Channel, Message, Conversation, ConversationMessage, Template
+from chatbot.models import ChatbotInteraction
+from analytics.models import ChannelMetrics, ChatbotMetrics, ChannelHourlyMetrics
+from analytics.archive import ArchiveService
+from analytics.cache import ANALYTICS_CACHE_SETTLED_SECONDS, analytics_cache
+from analytics.eventstore import EventStore
+from analytics.realtime import accumulator, flush_worker_process
+from analytics.services import AnalyticsService, generate_daily_metrics, generate_hourly_metrics, export_event_store
+from analytics.sketches import LatencySketch
 
-# Create your tests here.
+
+def legacy_channel_metrics(channel, day):
+    """Original per-conversation computation of a ChannelMetrics row, plus percentiles"""
+    start_of_day = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+    end_of_day = timezone.make_aware(datetime.combine(day, datetime.max.time()))
+
+    messages = Message.objects.filter(channel=channel, sent_at__gte=start_of_day, sent_at__lte=end_of_day)
+    conversations = Conversation.objects.filter(channel=channel, started_at__gte=start_of_day, started_at__lte=end_of_day)
+
+    cutoff_time = end_of_day - timedelta(hours=4)
+    conversations_completed = 0
+    for conv in conversations:
+        last_message = ConversationMessage.objects.filter(conversation=conv).order_by('-created_at').first()
+        if last_message and not last_message.is_from_user and last_message.created_at <= cutoff_time:
+            conversations_completed += 1
+
+    response_times = []
+    for conv in conversations:
+        user_message_time = None
+        for msg in ConversationMessage.objects.filter(conversation=conv).order_by('created_at'):
+            if msg.is_from_user:
+                user_message_time = msg.created_at
+            elif user_message_time:
+                response_times.append((msg.created_at - user_message_time).total_seconds())
+                user_message_time = None
+
+    return {
+        'messages_sent': messages.count(),
+        'messages_delivered': messages.filter(status='delivered').count(),
+        'messages_read': messages.filter(status='read').count(),
+        'conversations_started': conversations.count(),
+        'conversations_completed': conversations_completed,
+        'average_response_time': sum(response_times) / len(response_times) if response_times else 0,
+        'response_time_p50': float(np.percentile(response_times, 50)) if response_times else 0,
+        'response_time_p90': float(np.percentile(response_times, 90)) if response_times else 0,
+        'response_time_p99': float(np.percentile(response_times, 99)) if response_times else 0,
+    }
+
+
+def seed_day(day, seed=7):
+    """Populate channels, messages, conversations and interactions around a day"""
+    rng = random.Random(seed)
+    midnight = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+    channels = [
+        Channel.objects.create(name=f'Channel {i}', type=channel_type)
+        for i, channel_type in enumerate(['email', 'whatsapp', 'webchat', 'email'])
+    ]
+
+    for channel in channels[:3]:
+        for _ in range(40):
+            sent_at = midnight + timedelta(minutes=rng.randint(-600, 2000))
+            Message.objects.create(
+                channel=channel,
+                recipient='someone@example.com',
+                content='Hello',
+                status=rng.choice(['sent', 'delivered', 'read', 'failed']),
+                sent_at=sent_at
+            )
+
+        for _ in range(15):
+            conversation = Conversation.objects.create(channel=channel, external_id=str(rng.random()))
+            started_at = midnight + timedelta(minutes=rng.randint(-300, 1700))
+            Conversation.objects.filter(id=conversation.id).update(started_at=started_at)
+
+            created_at = started_at
+            messages = []
+            for _ in range(rng.randint(0, 12)):
+                created_at += timedelta(seconds=rng.randint(1, 5000))
+                message = ConversationMessage.objects.create(
+                    conversation=conversation,
+                    is_from_user=rng.random() < 0.55,
+                    content='...'
+                )
+                message.created_at = created_at
+                messages.append(message)
+            ConversationMessage.objects.bulk_update(messages, ['created_at'])
+
+            for _ in range(rng.randint(0, 3)):
+                interaction = ChatbotInteraction.objects.create(
+                    conversation=conversation,
+                    user_input='hi',
+                    confidence_score=rng.random(),
+                    feedback_rating=rng.choice([None, 1, 3, 5]),
+                    response='hello',
+                    needs_handoff=rng.random() < 0.2
+                )
+                ChatbotInteraction.objects.filter(id=interaction.id).update(
+                    timestamp=midnight + timedelta(minutes=rng.randint(-200, 1600))
+                )
+            if rng.random() < 0.3:
+                conversation.metadata = {'needs_handoff': True}
+                conversation.save()
+
+    # Inactive channels get no metrics row
+    channels[3].is_active = False
+    channels[3].save()
+    return channels
+
+
+class GenerateDailyMetricsTests(TestCase):
+    day = date(2025, 3, 14)
+
+    def setUp(self):
+        self.channels = seed_day(self.day)
+
+    def test_channel_metrics_match_per_conversation_logic(self):
+        expected = {channel.id: legacy_channel_metrics(channel, self.day) for channel in self.channels[:3]}
+
+        generate_daily_metrics(self.day)
+
+        rows = ChannelMetrics.objects.filter(date=self.day)
+        self.assertEqual({row.channel_id for row in rows}, set(expected))
+        for row in rows:
+            for field, value in expected[row.channel_id].items():
+                self.assertAlmostEqual(getattr(row, field), value, places=6, msg=field)
+
+    def test_task_takes_the_day_as_a_string(self):
+        fields = ['channel_id', 'messages_sent', 'messages_delivered', 'conversations_started', 'average_response_time']
+        generate_daily_metrics(self.day)
+        expected = list(ChannelMetrics.objects.filter(date=self.day).order_by('channel_id').values_list(*fields))
+
+        ChannelMetrics.objects.all().delete()
+        generate_daily_metrics.apply(args=(self.day.isoformat(),)).get()
+
+        self.assertEqual(list(ChannelMetrics.objects.filter(date=self.day).order_by('channel_id').values_list(*fields)), expected)
+
+    def test_response_times_pair_across_chunks(self):
+        conversations = Conversation.objects.filter(channel__in=self.channels[:3])
+
+        self.assertEqual(
+            AnalyticsService.response_time_stats(conversations, chunk_size=7),
+            AnalyticsService.response_time_stats(conversations)
+        )
+
+    def test_chatbot_metrics_match_per_query_logic(self):
+        start_of_day = timezone.make_aware(datetime.combine(self.day, datetime.min.time()))
+        end_of_day = timezone.make_aware(datetime.combine(self.day, datetime.max.time()))
+        interactions = ChatbotInteraction.objects.filter(timestamp__gte=start_of_day, timestamp__lte=end_of_day)
+
+        generate_daily_metrics(self.day)
+
+        metrics = ChatbotMetrics.objects.get(date=self.day)
+        self.assertEqual(metrics.interactions_count, interactions.count())
+        self.assertEqual(metrics.successful_interactions, interactions.filter(confidence_score__gte=0.7).count())
+        self.assertEqual(metrics.handoffs_count, interactions.filter(needs_handoff=True).count())
+        self.assertAlmostEqual(metrics.average_confidence, interactions.aggregate(avg=Avg('confidence_score'))['avg'] or 0)
+        self.assertAlmostEqual(
+            metrics.average_feedback,
+            interactions.exclude(feedback_rating=None).aggregate(avg=Avg('feedback_rating'))['avg'] or 0
+        )
+
+    def test_handoff_backfill_refreshes_metrics(self):
+        from chatbot.services import HANDOFF_RESPONSE, backfill_handoff_flags
+
+        generate_daily_metrics(self.day)
+        conversation = Conversation.objects.filter(metadata__has_key='needs_handoff').first()
+        interaction = ChatbotInteraction.objects.create(conversation=conversation, user_input='agent', response=HANDOFF_RESPONSE)
+        midnight = timezone.make_aware(datetime.combine(self.day, datetime.min.time()))
+        ChatbotInteraction.objects.filter(id=interaction.id).update(timestamp=midnight + timedelta(hours=9))
+        before = ChatbotMetrics.objects.get(date=self.day).handoffs_count
+        version = analytics_cache.range_version(self.day, self.day)
+
+        self.assertEqual(backfill_handoff_flags(), 1)
+
+        self.assertEqual(ChatbotMetrics.objects.get(date=self.day).handoffs_count, before + 1)
+        self.assertGreater(analytics_cache.range_version(self.day, self.day), version)
+
+    def test_rerun_updates_existing_rows(self):
+        generate_daily_metrics(self.day)
+        generate_daily_metrics(self.day)
+
+        self.assertEqual(ChannelMetrics.objects.filter(date=self.day).count(), 3)
+        self.assertEqual(ChatbotMetrics.objects.filter(date=self.day).count(), 1)
+
+
+    def test_channel_metrics_merge_daily_sketches(self):
+        for offset in range(3):
+            generate_daily_metrics(self.day + timedelta(days=offset))
+
+        result = AnalyticsService.get_channel_metrics(self.channels[0].id, self.day, self.day + timedelta(days=2))
+        rows = ChannelMetrics.objects.filter(channel=self.channels[0])
+        expected = LatencySketch.merge_all(rows.values_list('response_time_sketch', flat=True))
+
+        self.assertEqual(result['totals']['response_time_p95'], expected.quantile(0.95))
+        self.assertGreater(expected.count, 0)
+        self.assertEqual(result['totals']['average_response_time'], expected.mean)
+
+    def test_sketch_quantiles_within_relative_accuracy(self):
+        rng = np.random.default_rng(3)
+        parts = [rng.lognormal(5, 1.5, 5000) for _ in range(10)]
+        merged = LatencySketch.merge_all(LatencySketch().add_many(part).to_bytes() for part in parts)
+        values = np.concatenate(parts)
+
+        self.assertEqual(merged.count, len(values))
+        self.assertAlmostEqual(merged.mean, values.mean(), places=6)
+        for q in (0.5, 0.95, 0.99):
+            self.assertLess(abs(merged.quantile(q) / np.quantile(values, q) - 1), 0.02)
+
+
+class RealtimeChannelMetricsTests(TestCase):
+    day = date(2025, 3, 14)
+
+    def test_incremental_counters_match_recompute(self):
+        channels = seed_day(self.day)
+        ChannelMetrics.objects.all().delete()
+        sent_at = timezone.make_aware(datetime.combine(self.day, datetime.min.time())) + timedelta(hours=9)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            message = Message.objects.create(channel=channels[0], recipient='a@example.com', content='Hi')
+            message.status, message.sent_at = 'sent', sent_at
+            message.save()
+            message = Message.objects.get(id=message.id)
+            message.status = 'delivered'
+            message.save()
+            message.status = 'read'
+            message.save()
+            conversation = Conversation.objects.create(channel=channels[0], external_id='realtime')
+        accumulator.flush()
+
+        metrics = ChannelMetrics.objects.get(channel=channels[0], date=self.day)
+        self.assertEqual(
+            (metrics.messages_sent, metrics.messages_delivered, metrics.messages_read),
+            (1, 0, 1)
+        )
+        started = ChannelMetrics.objects.get(channel=channels[0], date=conversation.started_at.date())
+        self.assertEqual(started.conversations_started, 1)
+
+    def test_failed_flush_keeps_deltas(self):
+        channel = Channel.objects.create(name='Email', type='email')
+        accumulator.add(channel.id, self.day, {'messages_sent': 2})
+
+        with mock.patch('analytics.realtime.ChannelMetrics.objects.bulk_create', side_effect=DatabaseError('down')):
+            with self.assertRaises(DatabaseError):
+                accumulator.flush()
+        accumulator.add(channel.id, self.day, {'messages_sent': 1})
+
+        self.assertEqual(accumulator.flush(), 1)
+        self.assertEqual(ChannelMetrics.objects.get(channel=channel, date=self.day).messages_sent, 3)
+
+    def test_flush_skips_deleted_channels(self):
+        kept, deleted = Channel.objects.create(name='Kept', type='email'), Channel.objects.create(name='Gone', type='email')
+        accumulator.add(kept.id, self.day, {'messages_sent': 1})
+        accumulator.add(deleted.id, self.day, {'messages_sent': 1})
+        deleted.delete()
+
+        self.assertEqual(accumulator.flush(), 1)
+        self.assertEqual(accumulator.flush(), 0)
+        self.assertEqual(ChannelMetrics.objects.get().channel, kept)
+
+    def test_flush_on_save_path_logs_instead_of_raising(self):
+        channel = Channel.objects.create(name='Email', type='email')
+        with mock.patch('analytics.realtime.FLUSH_THRESHOLD', 1), \
+                mock.patch.object(accumulator, 'flush', side_effect=DatabaseError('down')), \
+                self.assertLogs('analytics.realtime', 'ERROR'):
+            accumulator.add(channel.id, self.day, {'messages_sent': 1})
+        accumulator.flush()
+
+    def test_idle_process_flushes_on_a_timer(self):
+        flushed = threading.Event()
+        with mock.patch('analytics.realtime.FLUSH_INTERVAL', 0.05), \
+                mock.patch.object(accumulator, 'flush', side_effect=flushed.set):
+            accumulator.add(1, self.day, {'messages_sent': 1})
+            self.assertTrue(flushed.wait(5))
+        # The delta's channel does not exist, so the real flush drops it
+        self.assertEqual(accumulator.flush(), 0)
+
+    def test_exiting_worker_process_flushes(self):
+        channel = Channel.objects.create(name='Email', type='email')
+        accumulator.add(channel.id, self.day, {'messages_sent': 2})
+        flush_worker_process()
+        self.assertEqual(ChannelMetrics.objects.get(channel=channel, date=self.day).messages_sent, 2)
+
+    def test_deltas_flushed_after_reconciliation_are_corrected_later(self):
+        channels = seed_day(self.day)
+        generate_daily_metrics(self.day)
+        expected = ChannelMetrics.objects.get(channel=channels[0], date=self.day).messages_sent
+
+        # Buffered by another process before the day closed, flushed after
+        accumulator.add(channels[0].id, self.day, {'messages_sent': 1})
+        accumulator.flush()
+        generate_daily_metrics(self.day + timedelta(days=1))
+
+        self.assertEqual(ChannelMetrics.objects.get(channel=channels[0], date=self.day).messages_sent, expected)
+
+    def test_daily_job_reconciles_only_drifted_counters(self):
+        channels = seed_day(self.day)
+        generate_daily_metrics(self.day)
+        ChannelMetrics.objects.filter(channel=channels[0], date=self.day).update(messages_sent=F('messages_sent') + 5)
+
+        with self.assertLogs('analytics.services', 'INFO') as logs:
+            drifted = AnalyticsService.reconcile_channel_counters(self.day, [channel.id for channel in channels])
+
+        self.assertEqual(list(drifted), [(channels[0].id, self.day)])
+        self.assertIn(str(channels[0].id), logs.output[0])
+        self.assertEqual(
+            ChannelMetrics.objects.get(channel=channels[0], date=self.day).messages_sent,
+            legacy_channel_metrics(channels[0], self.day)['messages_sent']
+        )
+
+
+@override_settings(ANALYTICS_CACHE_ENABLED=False)
+class BulkChannelMetricsTests(TestCase):
+    day = date(2025, 3, 14)
+
+    def setUp(self):
+        self.channels = seed_day(self.day)
+        for day in [self.day - timedelta(days=1), self.day, self.day + timedelta(days=1)]:
+            generate_daily_metrics(day)
+        self.start, self.end = self.day - timedelta(days=1), self.day + timedelta(days=1)
+
+    def test_all_channels_in_one_query(self):
+        channel_ids = [channel.id for channel in self.channels]
+        with self.assertNumQueries(1):
+            results = AnalyticsService.get_channels_metrics(channel_ids, self.start, self.end)
+
+        for channel_id in channel_ids:
+            rows = ChannelMetrics.objects.filter(channel_id=channel_id, date__gte=self.start, date__lte=self.end)
+            sums = rows.aggregate(sent=Sum('messages_sent'), started=Sum('conversations_started'))
+            self.assertEqual(results[channel_id]['totals']['messages_sent'], sums['sent'] or 0)
+            self.assertEqual(results[channel_id]['totals']['conversations_started'], sums['started'] or 0)
+            self.assertEqual(len(results[channel_id]['dates']), rows.count())
+
+        # The inactive channel has no rows at all
+        self.assertEqual(results[self.channels[3].id]['totals']['delivery_rate'], 0)
+
+    def test_matches_single_channel_results(self):
+        channel = self.channels[1]
+        bulk = AnalyticsService.get_channels_metrics([self.channels[0].id, channel.id], self.start, self.end)
+        self.assertEqual(bulk[channel.id], AnalyticsService.get_channel_metrics(channel.id, self.start, self.end))
+        self.assertEqual(
+            bulk[channel.id]['messages_read'],
+            list(ChannelMetrics.objects.filter(channel=channel).order_by('date').values_list('messages_read', flat=True))
+        )
+
+
+class BackfillTests(TestCase):
+    day = date(2025, 3, 14)
+
+    def setUp(self):
+        self.channels = seed_day(self.day)
+        self.start, self.end = self.day - timedelta(days=1), self.day + timedelta(days=1)
+
+    def snapshot(self):
+        """Every metrics row the backfill writes, without ids"""
+        return [
+            sorted(tuple(sorted((key, value) for key, value in row.items() if key != 'id')) for row in model.objects.values())
+            for model in [ChannelMetrics, ChatbotMetrics, ChannelHourlyMetrics]
+        ]
+
+    def test_resumed_backfill_skips_completed_units(self):
+        units = AnalyticsService.backfill_units(self.start, self.end, 'resume')
+        # A (day, chatbot) unit plus one per active channel, for each of the three days
+        self.assertEqual(len(units), 3 * (1 + 3))
+
+        AnalyticsService.run_backfill_units(units[:5], 'resume')
+        self.assertEqual(AnalyticsService.backfill_units(self.start, self.end, 'resume'), units[5:])
+        # Other backfill names keep their own checkpoints
+        self.assertEqual(AnalyticsService.backfill_units(self.start, self.end, 'other'), units)
+
+        AnalyticsService.run_backfill_units(units[5:], 'resume')
+        self.assertEqual(AnalyticsService.backfill_units(self.start, self.end, 'resume'), [])
+
+    def test_rerun_writes_identical_rows(self):
+        AnalyticsService.run_backfill_units(AnalyticsService.backfill_units(self.start, self.end, 'first'), 'first')
+        first = self.snapshot()
+        self.assertTrue(all(first))
+
+        AnalyticsService.run_backfill_units(AnalyticsService.backfill_units(self.start, self.end, 'second'), 'second')
+        self.assertEqual(self.snapshot(), first)
+
+
+class RollupQueryTests(TestCase):
+    day = date(2025, 3, 14)
+
+    def test_rollup_plan_uses_days_inside_and_hours_at_edges(self):
+        start = datetime(2025, 3, 13, 18, 30)
+        end = datetime(2025, 3, 16, 2, 10)
+
+        days, hour_ranges = AnalyticsService.rollup_plan(start, end)
+
+        self.assertEqual(days, (date(2025, 3, 14), date(2025, 3, 15)))
+        self.assertEqual(hour_ranges, [
+            (datetime(2025, 3, 13, 18), datetime(2025, 3, 14)),
+            (datetime(2025, 3, 16), datetime(2025, 3, 16, 3)),
+        ])
+        self.assertEqual(
+            AnalyticsService.rollup_plan(datetime(2025, 3, 14, 6), datetime(2025, 3, 14, 12)),
+            (None, [(datetime(2025, 3, 14, 6), datetime(2025, 3, 14, 12))])
+        )
+
+    def test_channel_activity_matches_raw_counts(self):
+        channels = seed_day(self.day)
+        midnight = timezone.make_aware(datetime.combine(self.day, datetime.min.time()))
+        for offset in range(-1, 3):
+            generate_daily_metrics(self.day + timedelta(days=offset))
+        for hour in range(-24, 72):
+            AnalyticsService.compute_hourly_metrics(midnight + timedelta(hours=hour))
+
+        start, end = midnight - timedelta(hours=5), midnight + timedelta(days=1, hours=7)
+        for channel in channels[:3]:
+            messages = Message.objects.filter(channel=channel, sent_at__gte=start, sent_at__lt=end)
+            activity = AnalyticsService.get_channel_activity(channel.id, start, end)
+
+            self.assertEqual(activity['messages_sent'], messages.count())
+            self.assertEqual(activity['messages_read'], messages.filter(status='read').count())
+            self.assertEqual(
+                activity['conversations_started'],
+                Conversation.objects.filter(channel=channel, started_at__gte=start, started_at__lt=end).count()
+            )
+
+    def test_hourly_job_rebuilds_earlier_hours_of_the_day(self):
+        channel = Channel.objects.create(name='Email', type='email')
+        now = timezone.now()
+        sent_at = max(now.replace(hour=0, minute=0, second=0, microsecond=0), now - timedelta(hours=3))
+        message = Message.objects.create(channel=channel, recipient='a@example.com', content='Hi', status='sent', sent_at=sent_at)
+        generate_hourly_metrics()
+
+        # A delivery receipt arriving hours after sending
+        message.status = 'delivered'
+        message.save()
+        generate_hourly_metrics()
+
+        row = ChannelHourlyMetrics.objects.get(channel=channel)
+        self.assertEqual((row.hour, row.messages_sent, row.messages_delivered), (sent_at.replace(minute=0, second=0, microsecond=0), 1, 1))
+
+
+@override_settings(ANALYTICS_CACHE_ENABLED=False)
+class PerformanceQueryBudgetTests(TestCase):
+    day = date(2025, 3, 14)
+
+    def setUp(self):
+        from email_service.models import EmailMessage
+        from whatsapp_service.models import WhatsAppAccount, WhatsAppMessage
+
+        self.channels = seed_day(self.day)
+        accounts = [
+            WhatsAppAccount.objects.create(name=f'Account {i}', phone_number='+100', twilio_account_sid='sid', twilio_auth_token='token')
+            for i in range(2)
+        ]
+        for i, message in enumerate(Message.objects.filter(channel=self.channels[0])):
+            EmailMessage.objects.create(message=message, opens=i % 3, clicks=int(i % 5 == 0))
+        for i, message in enumerate(Message.objects.filter(channel=self.channels[1])):
+            WhatsAppMessage.objects.create(message=message, account=accounts[i % 2])
+
+        self.start = timezone.make_aware(datetime.combine(self.day, datetime.min.time()))
+        self.end = self.start + timedelta(days=2)
+        AnalyticsService.compute_hourly_rollups(self.start - timedelta(days=1), self.end + timedelta(days=1))
+
+    def test_email_performance_in_two_queries(self):
+        with self.assertNumQueries(2):
+            result = AnalyticsService.get_email_performance(self.start, self.end)
+
+        messages = Message.objects.filter(channel=self.channels[0], sent_at__gte=self.start, sent_at__lte=self.end)
+        self.assertEqual(result['summary']['total_sent'], messages.count())
+        self.assertEqual(result['summary']['total_opened'], messages.filter(email_details__opens__gt=0).count())
+        self.assertEqual(sum(day['clicked'] for day in result['daily']), result['summary']['total_clicked'])
+
+    def test_whatsapp_performance_in_three_queries(self):
+        with self.assertNumQueries(3):
+            result = AnalyticsService.get_whatsapp_performance(self.start, self.end)
+
+        messages = Message.objects.filter(channel=self.channels[1], sent_at__gte=self.start, sent_at__lte=self.end)
+        self.assertEqual(result['summary']['total_delivered'], messages.filter(status='delivered').count())
+        self.assertEqual(sum(account['sent'] for account in result['by_account']), messages.count())
+        self.assertEqual(sum(day['read'] for day in result['daily']), result['summary']['total_read'])
+
+    def test_chatbot_metrics_in_two_queries(self):
+        with self.assertNumQueries(2):
+            result = AnalyticsService.get_chatbot_metrics(self.start, self.end)
+
+        interactions = ChatbotInteraction.objects.filter(timestamp__gte=self.start, timestamp__lte=self.end)
+        self.assertEqual(result['summary']['total_interactions'], interactions.count())
+        self.assertEqual(
+            result['summary']['handoffs'],
+            interactions.filter(needs_handoff=True).count()
+        )
+
+    def test_results_come_from_rollups(self):
+        sources = [
+            AnalyticsService.get_email_performance,
+            AnalyticsService.get_whatsapp_performance,
+            AnalyticsService.get_chatbot_metrics
+        ]
+        results = [source(self.start, self.end) for source in sources]
+
+        Message.objects.all().delete()
+        ChatbotInteraction.objects.all().delete()
+
+        self.assertEqual([source(self.start, self.end) for source in sources], results)
+
+
+class AnalyticsCacheTests(TestCase):
+    day = date(2025, 3, 14)
+
+    def setUp(self):
+        self.channel = seed_day(self.day)[0]
+        generate_daily_metrics(self.day)
+        analytics_cache.clear()
+
+    def test_closed_range_cached_until_a_day_in_it_is_rewritten(self):
+        first = AnalyticsService.get_channel_metrics(self.channel.id, self.day, self.day)
+
+        # Only the data version lookup
+        with self.assertNumQueries(1):
+            self.assertEqual(AnalyticsService.get_channel_metrics(self.channel.id, self.day, self.day), first)
+
+        Message.objects.filter(channel=self.channel).update(status='read')
+        generate_daily_metrics(self.day)
+
+        rebuilt = AnalyticsService.get_channel_metrics(self.channel.id, self.day, self.day)
+        self.assertGreater(rebuilt['totals']['messages_read'], first['totals']['messages_read'])
+
+    def test_rewrites_outside_the_range_keep_entries(self):
+        AnalyticsService.get_channel_metrics(self.channel.id, self.day, self.day)
+        analytics_cache.mark_rewritten([self.day + timedelta(days=1)])
+
+        with self.assertNumQueries(1):
+            AnalyticsService.get_channel_metrics(self.channel.id, self.day, self.day)
+        self.assertGreater(analytics_cache.stats()['AnalyticsService.get_channel_metrics']['hit_rate'], 0)
+
+    def test_every_rewrite_changes_the_range_version(self):
+        end = self.day + timedelta(days=1)
+        before = analytics_cache.range_version(self.day, end)
+
+        analytics_cache.mark_rewritten([self.day])
+        analytics_cache.mark_rewritten([end])
+
+        self.assertEqual(analytics_cache.range_version(self.day, end), before + 2)
+
+    def test_settled_results_expire(self):
+        backend = mock.Mock(**{'get.return_value': None})
+        with mock.patch.object(analytics_cache, '_local', backend):
+            AnalyticsService.get_channel_metrics(self.channel.id, self.day, self.day)
+
+        self.assertEqual(backend.set.call_args.kwargs['timeout'], ANALYTICS_CACHE_SETTLED_SECONDS)
+
+    def test_new_interactions_bump_their_day(self):
+        today = timezone.now().date()
+        before = analytics_cache.range_version(today, today)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ChatbotInteraction.objects.create(conversation=Conversation.objects.first(), user_input='hi', response='hello')
+        accumulator.flush()
+
+        self.assertGreater(analytics_cache.range_version(today, today), before)
+
+
+class EventStoreTests(TestCase):
+    day = date(2025, 3, 14)
+
+    def setUp(self):
+        seed_day(self.day)
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        patcher = mock.patch('analytics.eventstore.EVENT_STORE_ROOT', root.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.days = [self.day - timedelta(days=1), self.day, self.day + timedelta(days=1)]
+        for day in self.days:
+            export_event_store(day.isoformat())
+        self.start = timezone.make_aware(datetime.combine(self.days[0], datetime.min.time()))
+        self.end = timezone.make_aware(datetime.combine(self.days[-1], datetime.max.time()))
+
+    def test_grouped_counts_match_orm(self):
+        rows = EventStore.query('messages', self.days[0], self.days[-1], group_by=['channel_type', 'status'])
+
+        expected = Message.objects.filter(sent_at__gte=self.start, sent_at__lte=self.end).values(
+            'channel__type', 'status'
+        ).annotate(count=Count('id'))
+        self.assertEqual(
+            {(row['channel_type'], row['status']): row['count'] for row in rows},
+            {(row['channel__type'], row['status']): row['count'] for row in expected}
+        )
+
+    def test_filters_and_aggregates_skip_nulls(self):
+        cutoff = timezone.make_aware(datetime.combine(self.day, datetime.min.time())) + timedelta(hours=6)
+        rows = EventStore.query(
+            'interactions', self.days[0], self.days[-1],
+            filters=[('timestamp', '>=', cutoff)],
+            group_by=['needs_handoff'],
+            aggregates={'avg_feedback': ('mean', 'feedback_rating'), 'max_confidence': ('max', 'confidence_score')}
+        )
+
+        expected = ChatbotInteraction.objects.filter(timestamp__gte=cutoff, timestamp__lte=self.end).values(
+            'needs_handoff'
+        ).annotate(avg_feedback=Avg('feedback_rating'), max_confidence=Max('confidence_score'))
+        self.assertEqual(len(rows), len(expected))
+        for row, expected_row in zip(rows, expected.order_by('needs_handoff')):
+            self.assertEqual(row['needs_handoff'], expected_row['needs_handoff'])
+            self.assertAlmostEqual(row['avg_feedback'], expected_row['avg_feedback'])
+            self.assertAlmostEqual(row['max_confidence'], expected_row['max_confidence'])
+
+    def test_reexport_replaces_snapshot(self):
+        Message.objects.filter(sent_at__date=self.day).update(status='read')
+        export_event_store(self.day.isoformat(), tables=['messages'])
+
+        rows = EventStore.query('messages', self.day, self.day, filters=[('status', '!=', 'read')])
+        self.assertEqual(rows, [{'count': 0}])
+
+    def test_null_ints_are_missing_values(self):
+        channel = Channel.objects.first()
+        template = Template.objects.create(name='Launch', channel=channel, content='Hello')
+        tagged = Message.objects.filter(sent_at__date=self.day).order_by('id').values_list('id', flat=True)[:10]
+        Message.objects.filter(id__in=list(tagged)).update(template=template)
+        export_event_store(self.day.isoformat(), tables=['messages'])
+
+        untagged = Message.objects.filter(sent_at__date=self.day, template=None).count()
+
+        rows = EventStore.query(
+            'messages', self.day, self.day, group_by=['template_id'],
+            aggregates={'count': ('count', None), 'total': ('sum', 'template_id'), 'lowest': ('min', 'template_id')}
+        )
+        self.assertEqual(rows, [
+            {'template_id': template.id, 'count': 10, 'total': 10.0 * template.id, 'lowest': template.id},
+            {'template_id': None, 'count': untagged, 'total': 0, 'lowest': None},
+        ])
+
+        overall = EventStore.query('messages', self.day, self.day, aggregates={'mean': ('mean', 'template_id')})
+        self.assertEqual(overall, [{'mean': template.id}])
+        self.assertEqual(
+            EventStore.query('messages', self.day, self.day, filters=[('template_id', '<', template.id + 1)]),
+            [{'count': 10}]
+        )
+        self.assertEqual(
+            EventStore.query('messages', self.day, self.day, filters=[('template_id', '==', None)]),
+            [{'count': untagged}]
+        )
+
+    def test_reexport_never_leaves_the_day_missing(self):
+        Message.objects.filter(sent_at__date=self.day).update(status='read')
+        seen = []
+        remove = shutil.rmtree
+
+        def rmtree(path, *args, **kwargs):
+            # The old snapshot is only removed once the new one is in place
+            seen.append(EventStore.query('messages', self.day, self.day, filters=[('status', '!=', 'read')]))
+            remove(path, *args, **kwargs)
+
+        with mock.patch('analytics.eventstore.shutil.rmtree', side_effect=rmtree):
+            export_event_store(self.day.isoformat(), tables=['messages'])
+
+        self.assertEqual(seen, [[{'count': 0}]])
+        partitions = os.path.dirname(EventStore.partition_path('messages', self.day))
+        self.assertEqual(len(os.listdir(partitions)), 2 * len(self.days))
+
+
+@override_settings(ANALYTICS_CACHE_ENABLED=False)
+class DashboardTests(TransactionTestCase):
+    # Sources run on pool threads with their own connections, so data must be committed
+    day = date(2025, 3, 14)
+
+    def setUp(self):
+        self.channels = seed_day(self.day)
+        generate_daily_metrics(self.day)
+
+    def test_combines_every_source(self):
+        result = AnalyticsService.get_dashboard(self.day, self.day)
+
+        start = timezone.make_aware(datetime.combine(self.day, datetime.min.time()))
+        end = timezone.make_aware(datetime.combine(self.day, datetime.max.time()))
+        self.assertEqual(result['errors'], {})
+        self.assertEqual(result['email'], AnalyticsService.get_email_performance(start, end))
+        self.assertEqual(result['chatbot'], AnalyticsService.get_chatbot_metrics(start, end))
+        # The end day is counted up to its last instant
+        self.assertEqual(
+            result['chatbot']['summary']['total_interactions'],
+            ChatbotInteraction.objects.filter(timestamp__gte=start, timestamp__lte=end).count()
+        )
+        self.assertEqual(
+            result['channels'][self.channels[1].name],
+            AnalyticsService.get_channel_metrics(self.channels[1].id, self.day, self.day)
+        )
+
+    def test_slow_source_returns_partial_result(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        slow = lambda start_date, end_date: release.wait(5)
+
+        with mock.patch.object(AnalyticsService, 'get_whatsapp_performance', slow):
+            result = AnalyticsService.get_dashboard(self.day, self.day, timeout=0.5)
+
+        self.assertEqual(result['errors'], {'whatsapp': 'timeout'})
+        self.assertNotIn('whatsapp', result)
+        self.assertIn('email', result)
+        self.assertEqual(len(result['channels']), 3)
+
+    def test_failed_source_is_logged_not_returned(self):
+        def broken(start_date, end_date):
+            raise DatabaseError('relation "secret_table" does not exist')
+
+        with mock.patch.object(AnalyticsService, 'get_email_performance', broken):
+            with self.assertLogs('analytics.services', 'ERROR'):
+                result = AnalyticsService.get_dashboard(self.day, self.day)
+
+        self.assertEqual(result['errors'], {'email': 'error'})
+        self.assertIn('chatbot', result)
+
+    def test_timed_out_sources_hold_their_threads(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        slow = lambda start, end: release.wait(5)
+        slots = threading.BoundedSemaphore(1)
+
+        with mock.patch('analytics.services._dashboard_slots', slots), \
+                mock.patch.object(AnalyticsService, 'get_email_performance', slow):
+            first = AnalyticsService.get_dashboard(self.day, self.day, timeout=0.2)
+            # Nothing is queued behind the source still running
+            second = AnalyticsService.get_dashboard(self.day, self.day, timeout=0.2)
+
+            self.assertEqual(first['errors'], {'email': 'timeout', 'whatsapp': 'busy', 'chatbot': 'busy', 'channels': 'busy'})
+            self.assertEqual(second['errors'], dict.fromkeys(['email', 'whatsapp', 'chatbot', 'channels'], 'busy'))
+
+            release.set()
+            self.assertTrue(slots.acquire(timeout=5))
+
+    def test_view_returns_json_payload(self):
+        self.client.force_login(get_user_model().objects.create_user('admin', is_staff=True))
+
+        response = self.client.get('/analytics/dashboard/', {'start': '2025-03-14', 'end': '2025-03-14'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.json()['channels']), {channel.name for channel in self.channels[:3]})
+
+        self.assertEqual(self.client.get('/analytics/dashboard/', {'start': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get('/analytics/dashboard/', {'start': '2025-03-15', 'end': '2025-03-14'}).status_code, 400)
+        self.assertEqual(self.client.get('/analytics/dashboard/', {'start': '2020-01-01', 'end': '2025-03-14'}).status_code, 400)
+
+    def test_view_is_staff_only(self):
+        params = {'start': '2025-03-14', 'end': '2025-03-14'}
+        self.assertEqual(self.client.get('/analytics/dashboard/', params).status_code, 401)
+
+        self.client.force_login(get_user_model().objects.create_user('agent'))
+        self.assertEqual(self.client.get('/analytics/dashboard/', params).status_code, 403)
+
+
+class ArchiveTests(TestCase):
+    day = date(2025, 3, 14)
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media = override_settings(MEDIA_ROOT=media_root.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.channels = seed_day(self.day)
+        generate_daily_metrics(self.day)
+        self.cutoff = timezone.make_aware(datetime.combine(self.day + timedelta(days=1), datetime.min.time()))
+        self.start = self.cutoff - timedelta(days=5)
+
+    def test_moves_cold_rows_and_reads_them_back(self):
+        conversation = ConversationMessage.objects.filter(created_at__lt=self.cutoff).first().conversation
+        before = list(ArchiveService.scan('conversation_messages', self.start, self.cutoff + timedelta(days=5), conversation_id=conversation.id))
+        old_message = Message.objects.filter(sent_at__lt=self.cutoff).first()
+        metrics = list(ChannelMetrics.objects.order_by('id').values())
+
+        moved = ArchiveService.archive_all(self.cutoff)
+
+        self.assertGreater(moved['messages'], 0)
+        self.assertFalse(Message.objects.filter(sent_at__lt=self.cutoff).exists())
+        self.assertFalse(ChatbotInteraction.objects.filter(timestamp__lt=self.cutoff).exists())
+        self.assertTrue(Message.objects.filter(sent_at__gte=self.cutoff).exists())
+
+        # Read-through lookups see archived and hot rows alike
+        self.assertEqual(ArchiveService.get('messages', old_message.id)['recipient'], old_message.recipient)
+        self.assertEqual(
+            list(ArchiveService.scan('conversation_messages', self.start, self.cutoff + timedelta(days=5), conversation_id=conversation.id)),
+            before
+        )
+        self.assertEqual(list(ChannelMetrics.objects.order_by('id').values()), metrics)
+
+    def test_archived_bounces_keep_suppressing(self):
+        from communications.suppression import SuppressionService
+
+        channel = self.channels[0]
+        for recipient, failures in [('bounce@example.com', 3), ('once@example.com', 1)]:
+            for _ in range(failures):
+                Message.objects.create(
+                    channel=channel, recipient=recipient, content='Hi', status='failed', sent_at=self.start,
+                    metadata={'bounce': True}
+                )
+
+        ArchiveService.archive('messages', self.cutoff)
+        SuppressionService.refresh()
+
+        self.assertFalse(Message.objects.filter(status='failed', sent_at__lt=self.cutoff).exists())
+        self.assertEqual(
+            SuppressionService.suppressed('email', ['bounce@example.com', 'once@example.com']),
+            {'bounce@example.com'}
+        )
+
+    def test_unsent_messages_age_by_creation(self):
+        unsent = Message.objects.create(channel=self.channels[0], recipient='a@example.com', content='Hi', status='failed')
+        pending = Message.objects.create(channel=self.channels[0], recipient='b@example.com', content='Hi')
+        Message.objects.filter(id__in=[unsent.id, pending.id]).update(created_at=self.start)
+
+        ArchiveService.archive('messages', self.cutoff)
+
+        self.assertEqual(list(Message.objects.filter(id__in=[unsent.id, pending.id])), [pending])
+        self.assertEqual(ArchiveService.get('messages', unsent.id)['recipient'], 'a@example.com')
+
+    def test_scan_finds_unsent_messages_by_creation(self):
+        unsent = Message.objects.create(channel=self.channels[0], recipient='a@example.com', content='Hi', status='failed')
+        Message.objects.filter(id=unsent.id).update(created_at=self.start + timedelta(hours=1))
+        window = (self.start, self.start + timedelta(hours=2))
+        before = list(ArchiveService.scan('messages', *window, recipient='a@example.com'))
+
+        ArchiveService.archive('messages', self.cutoff)
+
+        self.assertEqual([row['id'] for row in before], [unsent.id])
+        self.assertFalse(Message.objects.filter(id=unsent.id).exists())
+        # Archived rows also carry their child rows
+        after = list(ArchiveService.scan('messages', *window, recipient='a@example.com'))
+        self.assertEqual([{key: row[key] for key in before[0]} for row in after], before)
+
+    def test_scan_takes_dates_and_naive_bounds(self):
+        ArchiveService.archive_all(self.cutoff)
+        aware = list(ArchiveService.scan('interactions', self.start, self.cutoff + timedelta(days=1)))
+
+        self.assertTrue(aware)
+        self.assertEqual(list(ArchiveService.scan('interactions', self.start.replace(tzinfo=None), self.cutoff.replace(tzinfo=None) + timedelta(days=1))), aware)
+        self.assertEqual(list(ArchiveService.scan('interactions', self.start.date(), self.cutoff.date() + timedelta(days=1))), aware)
+
+    def test_backfill_skips_archived_days(self):
+        ArchiveService.archive_all(self.cutoff)
+
+        units = AnalyticsService.backfill_units(self.day - timedelta(days=1), self.day + timedelta(days=1), 'after-archive')
+        self.assertEqual({day for day, _ in units}, {(self.day + timedelta(days=1)).isoformat()})
@@ -1,3 +1,25 @@
-from django.shortcuts import render
+from datetime import date, timedelta
+from django.http import JsonResponse
+from analytics.services import AnalyticsService, DASHBOARD_MAX_DAYS
 
-# Create your views here.
+
+def dashboard(request):
+    """Combined cross-channel analytics for ?start=YYYY-MM-DD&end=YYYY-MM-DD (default: last 7 days)
+
+    It covers every channel, so only staff can read it.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff only'}, status=403)
+
+    try:
+        end_date = date.fromisoformat(request.GET['end']) if 'end' in request.GET else date.today()
+        start_date = date.fromisoformat(request.GET['start']) if 'start' in request.GET else end_date - timedelta(days=6)
+    except ValueError:
+        return JsonResponse({'error': 'start and end must be YYYY-MM-DD dates'}, status=400)
+
+    if not timedelta(0) <= end_date - start_date < timedelta(days=DASHBOARD_MAX_DAYS):
+        return JsonResponse({'error': f'start must be on or before end, spanning at most {DASHBOARD_MAX_DAYS} days'}, status=400)
+
+    return JsonResponse(AnalyticsService.get_dashboard(start_date, end_date))
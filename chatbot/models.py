@@ -34,8 +34,15 @@ class ChatbotInteraction(models.Model):
     confidence_score = models.FloatField(default=0.0)
     response = models.TextField()
     feedback_rating = models.IntegerField(null=True, blank=True)
+    needs_handoff = models.BooleanField(default=False)  # This interaction handed the conversation to a human
     timestamp = models.DateTimeField(auto_now_add=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['needs_handoff', 'timestamp'], name='interaction_handoff_idx'),
+            models.Index(fields=['timestamp'], name='interaction_timestamp_idx'),
+        ]
+    
     def __str__(self):
         return f"Interaction: {self.conversation.id} - {self.detected_intent}"
 
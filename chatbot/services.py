@@ -1,13 +1,21 @@
 # chatbot/services.py
 import re
 import json
+from datetime import datetime, timedelta
 from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import TruncDate
 from celery import shared_task
 import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 from communications.models import Conversation, ConversationMessage
 from chatbot.models import Intent, KnowledgeBase, ChatbotResponse, ChatbotInteraction, HandoffRule
+from analytics.cache import analytics_cache
+from analytics.models import ChatbotMetrics
+from analytics.services import AnalyticsService
+
+HANDOFF_RESPONSE = "I'll connect you with a human agent who can better assist you."
 
 class ChatbotService:
     """Service for handling chatbot interactions"""
@@ -123,7 +131,7 @@ class ChatbotService:
         needs_handoff = ChatbotService.check_handoff_rules(intent, confidence)
         
         if needs_handoff:
-            response_text = "I'll connect you with a human agent who can better assist you."
+            response_text = HANDOFF_RESPONSE
             
             # Update conversation metadata to indicate handoff needed
             conversation.metadata['needs_handoff'] = True
@@ -151,7 +159,8 @@ class ChatbotService:
             user_input=user_input,
             detected_intent=intent,
             confidence_score=confidence,
-            response=response_text
+            response=response_text,
+            needs_handoff=needs_handoff
         )
         
         return {
@@ -192,6 +201,9 @@ class ChatbotService:
         interaction.feedback_rating = rating
         interaction.save()
         
+        # Cached chatbot metrics for the interaction's day are now stale
+        analytics_cache.mark_rewritten([interaction.timestamp])
+        
         # In production, would add logic to improve responses based on feedback
         return True
     
@@ -210,6 +222,33 @@ class ChatbotService:
         return kb
 
 
+@shared_task
+def backfill_handoff_flags():
+    """Set needs_handoff on interactions recorded before the flag existed and refresh the affected days"""
+    # Handoffs were only recorded on the conversation, and every handoff
+    # interaction replied with the handoff message
+    interactions = ChatbotInteraction.objects.filter(
+        needs_handoff=False,
+        response=HANDOFF_RESPONSE,
+        conversation__metadata__has_key='needs_handoff'
+    )
+    
+    with transaction.atomic():
+        days = sorted(interactions.annotate(day=TruncDate('timestamp')).values_list('day', flat=True).distinct())
+        updated = interactions.update(needs_handoff=True)
+    
+    # update() bypasses the signals, so the days' handoff counts are rebuilt here
+    for day in days:
+        ChatbotMetrics.objects.update_or_create(date=day, defaults=AnalyticsService.compute_chatbot_metrics(day))
+        AnalyticsService.compute_hourly_rollups(
+            datetime.combine(day, datetime.min.time()),
+            datetime.combine(day + timedelta(days=1), datetime.min.time())
+        )
+    analytics_cache.mark_rewritten(days)
+    
+    return updated
+
+
 @shared_task
 def train_intent_model():
     """Periodically retrain the NLP model"""
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class CommunicationsConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'communications'
+
+    def ready(self):
+        # Invalidate suppression lists in every process when suppressions or consent change
+        from communications import suppression  # noqa: F401
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from communications.services import OutboxService
+
+
+class Command(BaseCommand):
+    help = 'Record outbox entries for pending scheduled messages created before the outbox'
+
+    def handle(self, *args, **options):
+        recorded = OutboxService.backfill_scheduled()
+        self.stdout.write(f'{recorded} scheduled messages queued in the outbox')
@@ -0,0 +1,182 @@
+import asyncio
+import base64
+import json
+import os
+import resource
+import struct
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+from django.core.management.base import BaseCommand, CommandError
+
+
+async def open_socket(host, port, target):
+    """Open a WebSocket and return its (reader, writer) once the server has switched protocols"""
+    reader, writer = await asyncio.open_connection(host, port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write((
+        f'GET {target} HTTP/1.1\r\n'
+        f'Host: {host}:{port}\r\n'
+        'Upgrade: websocket\r\n'
+        'Connection: Upgrade\r\n'
+        f'Sec-WebSocket-Key: {key}\r\n'
+        'Sec-WebSocket-Version: 13\r\n\r\n'
+    ).encode('latin-1'))
+    await writer.drain()
+
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = head.split(b' ', 2)[1]
+    if status != b'101':
+        writer.close()
+        raise ConnectionError(f'handshake answered {status.decode()}')
+    return reader, writer
+
+
+def encode_frame(payload, opcode=0x1):
+    """One final client frame; clients must mask what they send"""
+    mask = os.urandom(4)
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+    return header + mask + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+
+async def read_text(reader, writer):
+    """Next text frame from the server, answering pings on the way"""
+    while True:
+        first, second = await reader.readexactly(2)
+        opcode, length = first & 0x0F, second & 0x7F
+        if length == 126:
+            length, = struct.unpack('!H', await reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', await reader.readexactly(8))
+        payload = await reader.readexactly(length)
+
+        if opcode == 0x1:
+            return payload.decode('utf-8')
+        if opcode == 0x8:
+            raise ConnectionError('closed by server')
+        if opcode == 0x9:
+            writer.write(encode_frame(payload, 0xA))
+
+
+def server_rss(pid):
+    """Resident memory of a local process in bytes, or None"""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+class Command(BaseCommand):
+    help = 'Open many concurrent webchat WebSockets against a running ASGI server and report latencies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='Webchat endpoint, e.g. ws://127.0.0.1:8000/ws/webchat/1/')
+        parser.add_argument('--connections', type=int, default=1000, help='Concurrent sockets to open')
+        parser.add_argument('--rate', type=int, default=500, help='New sockets opened per second')
+        parser.add_argument('--messages', type=int, default=1, help='Messages each socket sends before going idle')
+        parser.add_argument('--text', default='Hello', help='Message text')
+        parser.add_argument('--hold', type=float, default=10, help='Seconds to keep every socket open and idle')
+        parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for a handshake or reply')
+        parser.add_argument('--server-pid', type=int, help='Server process to sample resident memory from')
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        if url.scheme != 'ws':
+            raise CommandError('Only ws:// URLs are supported')
+
+        # Every socket is a file descriptor on this side too
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < options['connections'] + 100 and soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+        asyncio.run(self.run(url, options))
+
+    async def run(self, url, options):
+        host, port = url.hostname, url.port or 80
+        # Each socket is a new visitor; the server issues its id
+        target = f"{url.path or '/'}{'?' + url.query if url.query else ''}"
+        message = encode_frame(json.dumps({'type': 'message', 'text': options['text']}).encode('utf-8'))
+        timeout, pid = options['timeout'], options['server_pid']
+
+        connect_times, reply_times, errors, holding = [], [], Counter(), []
+        idle, release = asyncio.Semaphore(0), asyncio.Event()
+
+        async def visitor(n):
+            writer = None
+            try:
+                started = time.perf_counter()
+                reader, writer = await asyncio.wait_for(open_socket(host, port, target), timeout)
+                await asyncio.wait_for(read_text(reader, writer), timeout)  # welcome
+                connect_times.append(time.perf_counter() - started)
+
+                for _ in range(options['messages']):
+                    sent = time.perf_counter()
+                    writer.write(message)
+                    reply = json.loads(await asyncio.wait_for(read_text(reader, writer), timeout))
+                    if reply.get('type') != 'reply':
+                        raise ValueError(reply.get('error', reply.get('type')))
+                    reply_times.append(time.perf_counter() - sent)
+            except Exception as e:
+                errors[f'{type(e).__name__}: {e}'] += 1
+                if writer:
+                    writer.close()
+                idle.release()
+                return
+
+            # Idle from here on; the server keeps the socket with nothing to do
+            holding.append(n)
+            idle.release()
+            await release.wait()
+            writer.close()
+
+        rss_before = server_rss(pid) if pid else None
+        started = time.perf_counter()
+
+        visitors = []
+        for n in range(options['connections']):
+            visitors.append(asyncio.create_task(visitor(n)))
+            if options['rate'] and (n + 1) % options['rate'] == 0:
+                await asyncio.sleep(1)
+
+        for _ in visitors:
+            await idle.acquire()
+        ramp = time.perf_counter() - started
+
+        self.stdout.write(f"{len(holding)}/{options['connections']} sockets open after {ramp:.1f}s")
+        self.stdout.write(
+            f"  handshake p50 {percentile(connect_times, 0.5) * 1000:.1f}ms"
+            f"  p99 {percentile(connect_times, 0.99) * 1000:.1f}ms"
+        )
+        if reply_times:
+            self.stdout.write(
+                f"  reply     p50 {percentile(reply_times, 0.5) * 1000:.1f}ms"
+                f"  p99 {percentile(reply_times, 0.99) * 1000:.1f}ms"
+                f"  ({len(reply_times)} replies)"
+            )
+        for error, count in errors.most_common():
+            self.stdout.write(self.style.ERROR(f"  {count} x {error}"))
+
+        await asyncio.sleep(options['hold'])
+        rss_idle = server_rss(pid) if pid else None
+        if rss_before is not None and rss_idle is not None and holding:
+            self.stdout.write(
+                f"  server RSS {rss_before / 2**20:.1f}MB -> {rss_idle / 2**20:.1f}MB,"
+                f" {(rss_idle - rss_before) / len(holding) / 1024:.1f}KB per idle socket"
+            )
+
+        release.set()
+        await asyncio.gather(*visitors)
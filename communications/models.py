@@ -1,6 +1,7 @@
 
 # communications/models.py
 from django.db import models
+from django.db.models.functions import Lower
 from accounts.models import User
 
 class Channel(models.Model):
@@ -51,10 +52,39 @@ class Message(models.Model):
     sent_at = models.DateTimeField(null=True, blank=True)
     delivered_at = models.DateTimeField(null=True, blank=True)
     read_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'scheduled_at'], name='message_status_scheduled_idx'),
+            models.Index(fields=['channel', 'sent_at'], name='message_channel_sent_idx'),
+            models.Index(fields=['sent_at'], name='message_sent_idx'),
+            # Ages the messages that were never sent, for archiving
+            models.Index(fields=['created_at'], name='message_unsent_created_idx', condition=models.Q(sent_at__isnull=True)),
+            # Hard-bounce counts for suppression, matched on the lower-cased address
+            models.Index(Lower('recipient'), name='message_failed_recipient_idx', condition=models.Q(status='failed')),
+        ]
     
     def __str__(self):
         return f"{self.channel.name} - {self.recipient} - {self.status}"
 
+class OutboxEntry(models.Model):
+    """A message waiting to be handed to its channel's sender, written in the same transaction as the message"""
+    message = models.OneToOneField(Message, on_delete=models.CASCADE, related_name='outbox_entry')
+    channel_type = models.CharField(max_length=20, choices=Channel.CHANNEL_TYPES)
+    available_at = models.DateTimeField()  # Now, or the time the message is scheduled for
+    # Set while a dispatcher run has claimed the entry
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['available_at'], name='outbox_available_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.channel_type} - {self.message_id}"
+
 class Conversation(models.Model):
     channel = models.ForeignKey(Channel, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='conversations')
@@ -64,6 +94,11 @@ class Conversation(models.Model):
     started_at = models.DateTimeField(auto_now_add=True)
     last_message_at = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['channel', 'external_id'], name='conversation_channel_ext_idx'),
+        ]
+    
     def __str__(self):
         return f"{self.channel.name} - {self.user or self.external_id}"
 
@@ -77,6 +112,27 @@ class ConversationMessage(models.Model):
     
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['conversation', 'created_at'], name='convmessage_conv_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.conversation.id} - {'User' if self.is_from_user else 'System'}"
+
+class Suppression(models.Model):
+    REASON_CHOICES = (
+        ('unsubscribe', 'Unsubscribed'),
+        ('bounce', 'Bounced'),
+        ('complaint', 'Spam Complaint'),
+    )
+    
+    recipient = models.CharField(max_length=255)  # Normalized email or phone number
+    channel_type = models.CharField(max_length=20, choices=Channel.CHANNEL_TYPES, blank=True)  # Blank applies to all channels
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES, default='unsubscribe')
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        unique_together = ('recipient', 'channel_type')
+    
+    def __str__(self):
+        return f"{self.recipient} - {self.get_reason_display()}"
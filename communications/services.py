@@ -0,0 +1,263 @@
+# communications/services.py
+import base64
+import logging
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from celery import shared_task
+from communications.models import ConversationMessage, Message, OutboxEntry
+
+logger = logging.getLogger(__name__)
+
+# Outbox entries claimed per round trip
+OUTBOX_BATCH_SIZE = getattr(settings, 'OUTBOX_BATCH_SIZE', 500)
+
+# How long a claim is held before another run may pick the entry up again
+OUTBOX_LEASE = timedelta(seconds=getattr(settings, 'OUTBOX_LEASE_SECONDS', 600))
+
+# Entries due within this window are handed to the broker with an ETA,
+# so a run every minute still sends scheduled messages on time
+OUTBOX_LOOKAHEAD = timedelta(seconds=getattr(settings, 'OUTBOX_LOOKAHEAD_SECONDS', 0))
+
+# Messages handed to a channel's sender per task, i.e. per broker operation
+OUTBOX_TASK_SIZE = getattr(settings, 'OUTBOX_TASK_SIZE', 100)
+
+
+def _eta(rows, now):
+    # Rows are ordered by available_at, so waiting for the last one holds the
+    # others back by at most the lookahead
+    available_at = rows[-1][1]
+    return available_at if available_at > now else None
+
+
+def _dispatch_email(rows, now):
+    from email_service.services import send_emails
+
+    send_emails.apply_async(([message_id for message_id, _, _ in rows],), eta=_eta(rows, now))
+
+
+def _dispatch_whatsapp(rows, now):
+    from whatsapp_service.services import send_whatsapp_messages
+
+    whatsapp_message_ids = [whatsapp_message_id for _, _, whatsapp_message_id in rows if whatsapp_message_id]
+    if whatsapp_message_ids:
+        send_whatsapp_messages.apply_async((whatsapp_message_ids,), eta=_eta(rows, now))
+
+    # Without WhatsApp details there is nothing to send; their entries are
+    # deleted with the chunk, so the messages fail visibly instead
+    missing = [message_id for message_id, _, whatsapp_message_id in rows if not whatsapp_message_id]
+    if missing:
+        logger.error('WhatsApp messages %s have no WhatsApp details and were marked failed', missing)
+        messages = list(Message.objects.filter(id__in=missing))
+        for message in messages:
+            message.status = 'failed'
+            message.metadata = {**message.metadata, 'error': 'missing_whatsapp_details'}
+        Message.objects.bulk_update(messages, ['status', 'metadata'])
+
+
+# Largest page a history request may ask for
+HISTORY_MAX_PAGE_SIZE = getattr(settings, 'HISTORY_MAX_PAGE_SIZE', 200)
+
+# Fields of a history message; the light projection skips the JSON columns
+HISTORY_FIELDS = ['id', 'is_from_user', 'content', 'created_at', 'attachments', 'metadata']
+HISTORY_LIGHT_FIELDS = ['id', 'is_from_user', 'content', 'created_at']
+
+
+# Channel type -> sender enqueueing one task for a chunk of (message_id, available_at, whatsapp_message_id) rows
+CHANNEL_DISPATCHERS = {
+    'email': _dispatch_email,
+    'whatsapp': _dispatch_whatsapp,
+}
+
+
+class OutboxService:
+    """Transactional outbox for every outbound channel
+
+    Senders record an entry in the same transaction that creates the message,
+    so no message is left unsent and none is enqueued before it is committed.
+    The dispatcher leases due entries in batches, hands each channel's share to
+    its sender as one task per OUTBOX_TASK_SIZE messages, and deletes the
+    entries of each chunk as soon as that chunk is enqueued.
+    """
+
+    @staticmethod
+    def record(messages, channel_type, available_at=None):
+        """Record the dispatch intent of messages; call inside the transaction creating them
+
+        Without available_at the messages are due now, and a dispatcher run is
+        queued once the transaction commits.
+        """
+        OutboxEntry.objects.bulk_create([
+            OutboxEntry(message_id=message.id, channel_type=channel_type, available_at=available_at or timezone.now())
+            for message in messages
+        ], ignore_conflicts=True)
+
+        if messages and available_at is None:
+            transaction.on_commit(dispatch_outbox.delay)
+
+    @staticmethod
+    def claim_due(now=None, batch_size=OUTBOX_BATCH_SIZE):
+        """Lease up to batch_size due entries and return their messages grouped by channel type"""
+        now = now or timezone.now()
+        lease_until = now + OUTBOX_LEASE
+        lease_free = Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lte=now)
+
+        with transaction.atomic():
+            # Served by the available_at index; rows locked by an overlapping
+            # run are skipped rather than waited on
+            ids = list(
+                OutboxEntry.objects.select_for_update(skip_locked=True)
+                .filter(lease_free, available_at__lte=now + OUTBOX_LOOKAHEAD)
+                .order_by('available_at')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                return {}
+
+            # Backends without row locks fall back to the lease itself: only
+            # the run whose lease landed on a row gets to dispatch it
+            OutboxEntry.objects.filter(lease_free, id__in=ids).update(lease_expires_at=lease_until)
+
+        claimed = {}
+        rows = OutboxEntry.objects.filter(id__in=ids, lease_expires_at=lease_until).order_by('available_at').values_list(
+            'message_id', 'channel_type', 'available_at', 'message__whatsapp_details__id'
+        )
+        for message_id, channel_type, available_at, whatsapp_message_id in rows:
+            claimed.setdefault(channel_type, []).append((message_id, available_at, whatsapp_message_id))
+
+        return claimed
+
+    @staticmethod
+    def dispatch_due(now=None, batch_size=OUTBOX_BATCH_SIZE):
+        """Enqueue every due message exactly once, one bounded batch at a time"""
+        now = now or timezone.now()
+        lease_until = now + OUTBOX_LEASE
+        dispatched = 0
+
+        while True:
+            claimed = OutboxService.claim_due(now, batch_size)
+            if not claimed:
+                break
+
+            for channel_type, rows in claimed.items():
+                # Channels without a sender keep their entries, leased, until one is registered
+                dispatcher = CHANNEL_DISPATCHERS.get(channel_type)
+                if not dispatcher:
+                    continue
+
+                for start in range(0, len(rows), OUTBOX_TASK_SIZE):
+                    chunk = rows[start:start + OUTBOX_TASK_SIZE]
+                    dispatcher(chunk, now)
+                    # Matching on the lease leaves alone entries another run
+                    # took over after ours lapsed
+                    OutboxEntry.objects.filter(
+                        message_id__in=[message_id for message_id, _, _ in chunk],
+                        lease_expires_at=lease_until
+                    ).delete()
+                    dispatched += len(chunk)
+
+        return dispatched
+
+    @staticmethod
+    def backfill_scheduled(batch_size=OUTBOX_BATCH_SIZE):
+        """Record outbox entries for scheduled pending messages that have none
+
+        Messages scheduled before the outbox existed were picked up by
+        polling their status and would otherwise never be sent. Safe to run
+        more than once; returns the number of entries recorded.
+        """
+        recorded, last_id = 0, 0
+        while True:
+            rows = list(
+                Message.objects.filter(
+                    id__gt=last_id,
+                    status='pending',
+                    scheduled_at__isnull=False,
+                    outbox_entry__isnull=True,
+                    channel__type__in=CHANNEL_DISPATCHERS
+                ).order_by('id').values_list('id', 'channel__type', 'scheduled_at')[:batch_size]
+            )
+            if not rows:
+                return recorded
+
+            OutboxEntry.objects.bulk_create([
+                OutboxEntry(message_id=message_id, channel_type=channel_type, available_at=scheduled_at)
+                for message_id, channel_type, scheduled_at in rows
+            ], ignore_conflicts=True)
+            recorded += len(rows)
+            last_id = rows[-1][0]
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class ConversationHistoryService:
+    """Pages through a conversation's messages by keyset on (created_at, id)
+
+    A cursor encodes the position of one message. Pages seek past it through
+    the (conversation, created_at) index, so fetching a page deep in a long
+    thread costs the same as fetching the first one.
+    """
+
+    @staticmethod
+    def encode_cursor(created_at, message_id):
+        return base64.urlsafe_b64encode(f'{created_at.isoformat()}|{message_id}'.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            created_at, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            return datetime.fromisoformat(created_at), int(message_id)
+        except (ValueError, UnicodeError) as e:
+            raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+
+    @staticmethod
+    def get_history(conversation_id, before=None, since=None, limit=50, light=False):
+        """One page of messages
+
+        Without since, pages run from the newest message backwards and
+        'next_cursor' (passed as before) continues into older history. With
+        since, returns messages newer than that cursor, oldest first, for
+        incremental polling; 'next_cursor' is then the cursor to poll from next.
+        """
+        limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+        messages = ConversationMessage.objects.filter(conversation_id=conversation_id)
+
+        if since:
+            created_at, message_id = ConversationHistoryService.decode_cursor(since)
+            messages = messages.filter(
+                Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=message_id)
+            ).order_by('created_at', 'id')
+        else:
+            if before:
+                created_at, message_id = ConversationHistoryService.decode_cursor(before)
+                messages = messages.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+                )
+            messages = messages.order_by('-created_at', '-id')
+
+        # One extra row tells whether another page follows
+        rows = list(messages.values(*(HISTORY_LIGHT_FIELDS if light else HISTORY_FIELDS))[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        if rows:
+            next_cursor = ConversationHistoryService.encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+        else:
+            # Polling with nothing new resumes from the same place
+            next_cursor = since
+
+        return {
+            'messages': rows,
+            'has_more': has_more,
+            'next_cursor': next_cursor if has_more or since else None
+        }
+
+
+@shared_task
+def dispatch_outbox():
+    """Enqueue every outbound message that has come due, across channels"""
+    return OutboxService.dispatch_due()
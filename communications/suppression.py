@@ -0,0 +1,252 @@
+# communications/suppression.py
+import hashlib
+import math
+import time
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Count, Q
+from django.db.models.functions import Lower
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from accounts.models import User
+from communications.models import Message, Suppression
+
+# Failed sends to one recipient before it is treated as a hard bounce
+SUPPRESSION_FAILURE_THRESHOLD = getattr(settings, 'SUPPRESSION_FAILURE_THRESHOLD', 3)
+
+# Target false positive rate of the in-memory filter; positives are confirmed
+# against the database so this only affects how many lookups are made
+SUPPRESSION_ERROR_RATE = getattr(settings, 'SUPPRESSION_ERROR_RATE', 0.001)
+
+# Seconds before a process rebuilds its filter from the database
+SUPPRESSION_TTL = getattr(settings, 'SUPPRESSION_TTL_SECONDS', 300)
+
+# Django cache holding the suppression version; it must be shared (e.g. Redis)
+# for an unsubscribe handled in one process to reach the filters of the others
+SUPPRESSION_CACHE = getattr(settings, 'SUPPRESSION_CACHE', 'default')
+SUPPRESSION_VERSION_KEY = 'suppression-version'
+
+# Recipients hashed per vectorized step, and per exact lookup query
+SUPPRESSION_CHUNK_SIZE = 100000
+LOOKUP_CHUNK_SIZE = 500
+
+# User field holding the address used by each channel type
+CONTACT_FIELDS = {
+    'email': 'email',
+    'whatsapp': 'phone',
+}
+
+
+def normalize_recipient(recipient):
+    """Canonical form used for suppression matching"""
+    return recipient.strip().lower()
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings with vectorized add and lookup"""
+
+    def __init__(self, capacity, error_rate=SUPPRESSION_ERROR_RATE):
+        capacity = max(capacity, 1)
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2) + 1
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+
+    def _positions(self, items):
+        # Double hashing: k bit positions from the two halves of one 128-bit digest
+        digests = b''.join(hashlib.blake2b(item.encode(), digest_size=16).digest() for item in items)
+        halves = np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+        steps = np.arange(self.hash_count, dtype=np.uint64)
+        return (halves[:, :1] + steps * (halves[:, 1:] | np.uint64(1))) % np.uint64(self.size)
+
+    def add_many(self, items):
+        """Add a list of strings to the filter"""
+        if not items:
+            return
+        positions = self._positions(items).ravel()
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3), (1 << (positions & np.uint64(7))).astype(np.uint8))
+
+    def contains_many(self, items):
+        """Boolean array, True where an item may be in the filter"""
+        if not items:
+            return np.zeros(0, dtype=bool)
+        positions = self._positions(items)
+        bits = self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)
+        return (bits & 1).all(axis=1)
+
+
+def suppression_sources(channel_type, recipients=None):
+    """Querysets of the lower-cased recipients suppressed for a channel type, optionally limited to recipients
+
+    Suppression rows are stored normalized; messages and users keep the
+    spelling they were given, so they are matched on their lower-cased form.
+    """
+    unsubscribed = Suppression.objects.filter(Q(channel_type=channel_type) | Q(channel_type=''))
+
+    # Only failures the carrier reported as undeliverable are hard bounces;
+    # send errors and spam rejections say nothing about the address
+    bounced = Message.objects.filter(
+        channel__type=channel_type,
+        status='failed',
+        metadata__bounce=True
+    ).annotate(key=Lower('recipient'))
+
+    contact_field = CONTACT_FIELDS.get(channel_type)
+    no_consent = None
+    if contact_field:
+        no_consent = User.objects.filter(consent_marketing=False).exclude(
+            **{contact_field: ''}
+        ).annotate(key=Lower(contact_field))
+
+    if recipients is not None:
+        keys = list({normalize_recipient(recipient) for recipient in recipients})
+        unsubscribed = unsubscribed.filter(recipient__in=keys)
+        bounced = bounced.filter(key__in=keys)
+        if no_consent is not None:
+            no_consent = no_consent.filter(key__in=keys)
+
+    sources = [
+        unsubscribed.values_list('recipient', flat=True),
+        bounced.values('key').annotate(
+            failures=Count('id')
+        ).filter(
+            failures__gte=SUPPRESSION_FAILURE_THRESHOLD
+        ).values_list('key', flat=True),
+    ]
+    if no_consent is not None:
+        sources.append(no_consent.values_list('key', flat=True))
+
+    return sources
+
+
+def suppression_version():
+    """Version of the suppressed set, shared by every process using SUPPRESSION_CACHE"""
+    return caches[SUPPRESSION_CACHE].get(SUPPRESSION_VERSION_KEY, 0)
+
+
+def bump_suppression_version():
+    """Make every process rebuild its suppression lists before their next check"""
+    cache = caches[SUPPRESSION_CACHE]
+    cache.add(SUPPRESSION_VERSION_KEY, 0, timeout=None)
+    try:
+        cache.incr(SUPPRESSION_VERSION_KEY)
+    except ValueError:
+        # Evicted since the add; any change of value invalidates the lists
+        cache.set(SUPPRESSION_VERSION_KEY, 1, timeout=None)
+
+
+class SuppressionList:
+    """In-memory probabilistic view of the suppressed recipients of one channel type"""
+
+    def __init__(self, channel_type, version=0):
+        self.channel_type = channel_type
+        self.built_at = time.monotonic()
+        # Read before loading, so changes made while building trigger another rebuild
+        self.version = version
+
+        sources = suppression_sources(channel_type)
+        # Headroom for unsubscribes recorded while the list is cached
+        capacity = int(sum(source.count() for source in sources) * 1.25) + 1000
+        self.filter = BloomFilter(capacity)
+
+        for source in sources:
+            chunk = []
+            for recipient in source.iterator(chunk_size=SUPPRESSION_CHUNK_SIZE):
+                chunk.append(normalize_recipient(recipient))
+                if len(chunk) >= SUPPRESSION_CHUNK_SIZE:
+                    self.filter.add_many(chunk)
+                    chunk = []
+            self.filter.add_many(chunk)
+
+    @property
+    def expired(self):
+        return time.monotonic() - self.built_at > SUPPRESSION_TTL
+
+    def candidates(self, normalized):
+        """Subset of normalized recipients the filter may contain"""
+        candidates = set()
+        for start in range(0, len(normalized), SUPPRESSION_CHUNK_SIZE):
+            chunk = normalized[start:start + SUPPRESSION_CHUNK_SIZE]
+            mask = self.filter.contains_many(chunk)
+            candidates.update(recipient for recipient, hit in zip(chunk, mask) if hit)
+        return candidates
+
+
+_suppression_lists = {}
+
+
+class SuppressionService:
+    """Checks bulk recipient lists against bounces, unsubscribes and marketing consent
+
+    Each process keeps a Bloom filter per channel type and confirms its hits
+    against the database. Unsubscribes and consent changes bump a version in
+    SUPPRESSION_CACHE, and every process rebuilds its filters on the next
+    check after the version moves, so a filter never misses a suppression
+    recorded elsewhere. Bounces are picked up when the filter expires.
+    """
+
+    @staticmethod
+    def get_list(channel_type):
+        """Return this process's suppression list for a channel type, rebuilding it when stale"""
+        version = suppression_version()
+        suppression_list = _suppression_lists.get(channel_type)
+        if suppression_list is None or suppression_list.expired or suppression_list.version != version:
+            suppression_list = _suppression_lists[channel_type] = SuppressionList(channel_type, version)
+        return suppression_list
+
+    @staticmethod
+    def suppressed(channel_type, recipients):
+        """Return the set of recipients that must not receive bulk messages on a channel type"""
+        recipients = list(recipients)
+        normalized = [normalize_recipient(recipient) for recipient in recipients]
+        candidates = list(SuppressionService.get_list(channel_type).candidates(normalized))
+
+        # Confirm filter hits exactly; only the (few) candidates reach the database
+        confirmed = set()
+        for start in range(0, len(candidates), LOOKUP_CHUNK_SIZE):
+            for source in suppression_sources(channel_type, candidates[start:start + LOOKUP_CHUNK_SIZE]):
+                confirmed.update(source)
+
+        return {recipient for recipient, key in zip(recipients, normalized) if key in confirmed}
+
+    @staticmethod
+    def unsubscribe(recipient, channel_type='', reason='unsubscribe'):
+        """Suppress a recipient for one channel type, or all channels when channel_type is blank"""
+        recipient = normalize_recipient(recipient)
+        # Saving the row makes every process rebuild its filters
+        suppression, _ = Suppression.objects.get_or_create(
+            recipient=recipient,
+            channel_type=channel_type,
+            defaults={'reason': reason}
+        )
+        return suppression
+
+    @staticmethod
+    def refresh(channel_type=None):
+        """Drop cached suppression lists, in every process, so the next check rebuilds them
+
+        Call after changing suppressions or consent with queryset update(),
+        which sends no signals.
+        """
+        if channel_type:
+            _suppression_lists.pop(channel_type, None)
+        else:
+            _suppression_lists.clear()
+        bump_suppression_version()
+
+
+@receiver(post_save, sender=Suppression)
+def suppression_saved(sender, **kwargs):
+    # Bumped once the row is visible, so other processes rebuild with it
+    transaction.on_commit(bump_suppression_version)
+
+
+@receiver(post_save, sender=User)
+def consent_saved(sender, instance, update_fields=None, **kwargs):
+    # Only a user without marketing consent adds to the suppressed set
+    if instance.consent_marketing:
+        return
+    if update_fields is not None and not {'consent_marketing', *CONTACT_FIELDS.values()} & set(update_fields):
+        return
+    transaction.on_commit(bump_suppression_version)
@@ -0,0 +1,537 @@
+import json
+import random
+import re
+import sys
+from datetime import date, datetime, timedelta
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.db import connection
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from communications.models import Channel, Message, Conversation, ConversationMessage, OutboxEntry, Suppression
+from communications.services import OutboxService, ConversationHistoryService, InvalidCursor
+from communications.suppression import SUPPRESSION_FAILURE_THRESHOLD, SuppressionService, suppression_sources
+from communications.webchat import (
+    CLOSE_FORBIDDEN_ORIGIN, CLOSE_INVALID_TOKEN, CLOSE_UNKNOWN_CHANNEL, WebchatService,
+    issue_visitor_token, read_visitor_token, webchat_application
+)
+from chatbot.models import ChatbotInteraction
+from whatsapp_service.models import WhatsAppAccount, WhatsAppMessage
+from whatsapp_service.services import WhatsAppService, send_whatsapp_messages
+from email_service.services import send_emails
+from analytics.realtime import accumulator
+from analytics.services import AnalyticsService, generate_daily_metrics
+from analytics.models import AccountHourlyMetrics, IntentHourlyMetrics
+
+
+def explain(sql, params=()):
+    """Query plan of a statement as one string"""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return '\n'.join(row[-1] for row in cursor.fetchall())
+        cursor.execute(f'EXPLAIN {sql}', params)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+def full_scans(plan, table):
+    """Plan steps reading every row of table"""
+    if connection.vendor == 'sqlite':
+        return re.findall(rf'SCAN {table}\b(?! USING (?:COVERING )?INDEX)', plan)
+    return re.findall(rf'Seq Scan on {table}\b', plan)
+
+
+@override_settings(ANALYTICS_CACHE_ENABLED=False)
+class QueryPlanTests(TestCase):
+    """Hot service queries must be served by an index, whatever the table size"""
+    day = date(2025, 3, 14)
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(3)
+        midnight = timezone.make_aware(datetime.combine(cls.day, datetime.min.time()))
+        cls.channels = [Channel.objects.create(name=f'Channel {i}', type=t) for i, t in enumerate(['email', 'whatsapp'])]
+        account = WhatsAppAccount.objects.create(name='Main', phone_number='+100', twilio_account_sid='AC', twilio_auth_token='x')
+
+        def moment():
+            return midnight + timedelta(minutes=rng.randint(-20000, 20000))
+
+        messages = Message.objects.bulk_create([
+            Message(
+                channel=rng.choice(cls.channels),
+                recipient=f'user{i}@example.com',
+                content='Hello',
+                status=rng.choice(['pending', 'sent', 'delivered', 'read', 'failed']),
+                scheduled_at=moment() if rng.random() < 0.2 else None,
+                sent_at=moment()
+            ) for i in range(6000)
+        ])
+        WhatsAppMessage.objects.bulk_create([
+            WhatsAppMessage(message=message, account=account, twilio_message_id=f'SM{message.id}')
+            for message in messages if message.channel_id == cls.channels[1].id
+        ])
+        OutboxEntry.objects.bulk_create([
+            OutboxEntry(message=message, channel_type=message.channel.type, available_at=message.scheduled_at)
+            for message in messages if message.status == 'pending' and message.scheduled_at
+        ])
+
+        conversations = Conversation.objects.bulk_create([
+            Conversation(channel=rng.choice(cls.channels), external_id=f'+1{i:09d}') for i in range(1500)
+        ])
+        ConversationMessage.objects.bulk_create([
+            ConversationMessage(conversation=rng.choice(conversations), is_from_user=rng.random() < 0.5, content='...')
+            for _ in range(6000)
+        ])
+        ChatbotInteraction.objects.bulk_create([
+            ChatbotInteraction(conversation=rng.choice(conversations), user_input='hi', response='hello', confidence_score=rng.random())
+            for _ in range(3000)
+        ])
+        # Spread created_at and timestamp out so date filters are selective
+        ConversationMessage.objects.bulk_update(
+            [ConversationMessage(id=pk, created_at=moment()) for pk in ConversationMessage.objects.values_list('id', flat=True)],
+            ['created_at'], batch_size=500
+        )
+        ChatbotInteraction.objects.bulk_update(
+            [ChatbotInteraction(id=pk, timestamp=moment()) for pk in ChatbotInteraction.objects.values_list('id', flat=True)],
+            ['timestamp'], batch_size=500
+        )
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def assertIndexed(self, func, indexes, tables):
+        """Run func, EXPLAIN every SELECT it issued, and require each of indexes
+        to be used and none of tables to be read in full"""
+        with CaptureQueriesContext(connection) as queries:
+            func()
+
+        selects = [query['sql'] for query in queries.captured_queries if query['sql'].lstrip().upper().startswith('SELECT')]
+        plans = [(sql, explain(sql)) for sql in selects]
+        for sql, plan in plans:
+            for table in tables:
+                self.assertFalse(full_scans(plan, table), f'{table} scanned by:\n{sql}\n{plan}')
+
+        used = '\n'.join(plan for _, plan in plans)
+        for index in indexes:
+            self.assertIn(index, used, f'{index} unused by:\n' + '\n'.join(selects))
+
+    def test_outbox_claim(self):
+        now = timezone.make_aware(datetime.combine(self.day, datetime.min.time()))
+        self.assertIndexed(
+            lambda: OutboxService.claim_due(now),
+            ['outbox_available_idx'], [OutboxEntry._meta.db_table]
+        )
+
+    def test_incoming_message_conversation_lookup(self):
+        # The lookup WhatsAppService.process_incoming_message runs for every inbound message
+        self.assertIndexed(
+            lambda: Conversation.objects.get_or_create(channel=self.channels[1], external_id='+1000000042'),
+            ['conversation_channel_ext_idx'], [Conversation._meta.db_table]
+        )
+
+    def test_conversation_history(self):
+        conversation = Conversation.objects.first()
+        self.assertIndexed(
+            lambda: list(conversation.messages.order_by('created_at')[:50]),
+            ['convmessage_conv_created_idx'], [ConversationMessage._meta.db_table]
+        )
+
+    def test_twilio_status_lookup(self):
+        sid = WhatsAppMessage.objects.values_list('twilio_message_id', flat=True).first()
+        self.assertIndexed(
+            lambda: WhatsAppMessage.objects.filter(twilio_message_id=sid).first(),
+            ['whatsapp_twilio_message_idx'], [WhatsAppMessage._meta.db_table]
+        )
+
+    def test_generate_daily_metrics(self):
+        self.assertIndexed(
+            lambda: generate_daily_metrics(self.day),
+            ['message_channel_sent_idx', 'convmessage_conv_created_idx', 'interaction_timestamp_idx'],
+            [Message._meta.db_table, ConversationMessage._meta.db_table, ChatbotInteraction._meta.db_table]
+        )
+
+    def test_analytics_filters(self):
+        def run():
+            AnalyticsService.get_chatbot_metrics(self.day, self.day + timedelta(days=1))
+            AnalyticsService.get_whatsapp_performance(self.day, self.day + timedelta(days=1))
+            AnalyticsService.get_email_performance(self.day, self.day + timedelta(days=1))
+
+        # Dashboards read rollups only
+        self.assertIndexed(
+            run,
+            ['account_hourly_hour_idx', 'intent_hourly_hour_idx'],
+            [
+                Message._meta.db_table, ChatbotInteraction._meta.db_table,
+                AccountHourlyMetrics._meta.db_table, IntentHourlyMetrics._meta.db_table
+            ]
+        )
+
+    def test_hourly_rollups(self):
+        start = timezone.make_aware(datetime.combine(self.day, datetime.min.time()))
+        self.assertIndexed(
+            lambda: AnalyticsService.compute_hourly_rollups(start, start + timedelta(days=1)),
+            ['message_sent_idx', 'interaction_timestamp_idx'],
+            [Message._meta.db_table, ChatbotInteraction._meta.db_table]
+        )
+
+
+class ConversationHistoryTests(TestCase):
+
+    def setUp(self):
+        channel = Channel.objects.create(name='Web', type='webchat')
+        self.conversation = Conversation.objects.create(channel=channel, external_id='visitor')
+        start = timezone.now() - timedelta(days=1)
+        messages = ConversationMessage.objects.bulk_create([
+            ConversationMessage(conversation=self.conversation, content=str(i), attachments=[{'url': 'x'}])
+            for i in range(23)
+        ])
+        # Pairs of messages share a timestamp, so ordering relies on the id tiebreak
+        for i, message in enumerate(messages):
+            message.created_at = start + timedelta(minutes=i // 2)
+        ConversationMessage.objects.bulk_update(messages, ['created_at'])
+        self.ids = [message.id for message in messages]
+
+    def test_pages_cover_history_newest_first(self):
+        seen, cursor = [], None
+        while True:
+            with self.assertNumQueries(1):
+                page = ConversationHistoryService.get_history(self.conversation.id, before=cursor, limit=5)
+            seen.extend(message['id'] for message in page['messages'])
+            cursor = page['next_cursor']
+            if not page['has_more']:
+                break
+
+        self.assertEqual(seen, self.ids[::-1])
+        self.assertIsNone(cursor)
+
+    def test_since_cursor_returns_only_newer_messages(self):
+        latest = ConversationHistoryService.get_history(self.conversation.id, limit=1)
+        since = ConversationHistoryService.encode_cursor(latest['messages'][0]['created_at'], latest['messages'][0]['id'])
+
+        empty = ConversationHistoryService.get_history(self.conversation.id, since=since)
+        self.assertEqual((empty['messages'], empty['next_cursor']), ([], since))
+
+        new = ConversationMessage.objects.create(conversation=self.conversation, content='new')
+        page = ConversationHistoryService.get_history(self.conversation.id, since=since)
+        self.assertEqual([message['id'] for message in page['messages']], [new.id])
+
+    def test_light_projection_skips_json_fields(self):
+        message = ConversationHistoryService.get_history(self.conversation.id, light=True)['messages'][0]
+        self.assertNotIn('attachments', message)
+        self.assertNotIn('metadata', message)
+
+    def test_view(self):
+        url = f'/communications/conversations/{self.conversation.id}/messages/'
+        self.client.force_login(get_user_model().objects.create_user('agent', is_staff=True))
+        page = self.client.get(url, {'limit': 10, 'fields': 'light'}).json()
+        self.assertEqual(len(page['messages']), 10)
+
+        older = self.client.get(url, {'before': page['next_cursor']}).json()
+        self.assertEqual(older['messages'][0]['id'], self.ids[-11])
+
+        self.assertEqual(self.client.get(url, {'before': 'not-a-cursor'}).status_code, 400)
+        self.assertEqual(self.client.get('/communications/conversations/0/messages/').status_code, 404)
+        with self.assertRaises(InvalidCursor):
+            ConversationHistoryService.decode_cursor('%%%')
+
+    def test_view_only_serves_authorized_users(self):
+        url = f'/communications/conversations/{self.conversation.id}/messages/'
+        users = get_user_model().objects
+        self.assertEqual(self.client.get(url).status_code, 401)
+
+        self.client.force_login(users.create_user('stranger'))
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        owner = users.create_user('owner')
+        self.conversation.user = owner
+        self.conversation.save()
+        self.client.force_login(owner)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+@override_settings(ANALYTICS_CACHE_ENABLED=False)
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        self.account = WhatsAppAccount.objects.create(name='Main', phone_number='+100', twilio_account_sid='AC', twilio_auth_token='x')
+        self.channel = Channel.objects.create(name='WhatsApp', type='whatsapp', configuration={'account_id': self.account.id})
+        enqueue = mock.patch('whatsapp_service.services.send_whatsapp_messages.apply_async')
+        self.enqueue = enqueue.start()
+        self.addCleanup(enqueue.stop)
+
+    def test_broadcast_records_intents_with_messages(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            messages = WhatsAppService.send_broadcast(self.account.id, [f'+1{i:09d}' for i in range(250)], 'Hello')
+
+        self.assertEqual(OutboxEntry.objects.filter(message__in=messages, channel_type='whatsapp').count(), 250)
+        # One dispatcher run queued for the whole broadcast, nothing sent directly
+        self.assertEqual(len(callbacks), 1)
+        self.enqueue.assert_not_called()
+
+    def test_dispatch_enqueues_each_message_once_in_chunks(self):
+        with self.captureOnCommitCallbacks():
+            messages = WhatsAppService.send_broadcast(self.account.id, [f'+1{i:09d}' for i in range(250)], 'Hello')
+
+        # Claimed 120 at a time and enqueued at most OUTBOX_TASK_SIZE (100) per task
+        self.assertEqual(OutboxService.dispatch_due(batch_size=120), 250)
+        self.assertEqual(OutboxService.dispatch_due(), 0)
+
+        queued = [whatsapp_message_id for call in self.enqueue.call_args_list for whatsapp_message_id in call.args[0][0]]
+        self.assertEqual(sorted(queued), sorted(message.whatsapp_details.id for message in messages))
+        self.assertEqual(self.enqueue.call_count, 5)
+        self.assertFalse(OutboxEntry.objects.exists())
+
+    def test_messages_without_details_fail_instead_of_vanishing(self):
+        sendable = Message.objects.create(channel=self.channel, recipient='+1', content='Hi')
+        WhatsAppMessage.objects.create(message=sendable, account=self.account)
+        orphan = Message.objects.create(channel=self.channel, recipient='+2', content='Hi', metadata={'campaign': 'spring'})
+        OutboxService.record([sendable, orphan], 'whatsapp', timezone.now())
+
+        with self.assertLogs('communications.services', 'ERROR'):
+            self.assertEqual(OutboxService.dispatch_due(), 2)
+
+        self.enqueue.assert_called_once_with(([sendable.whatsapp_details.id],), eta=None)
+        orphan.refresh_from_db()
+        self.assertEqual((orphan.status, orphan.metadata), ('failed', {'campaign': 'spring', 'error': 'missing_whatsapp_details'}))
+        self.assertFalse(OutboxEntry.objects.exists())
+
+    def test_scheduled_entries_wait_until_due(self):
+        message = Message.objects.create(channel=self.channel, recipient='+1', content='Later')
+        WhatsAppMessage.objects.create(message=message, account=self.account)
+        now = timezone.now()
+        OutboxService.record([message], 'whatsapp', now + timedelta(hours=1))
+
+        self.assertEqual(OutboxService.dispatch_due(now), 0)
+        self.assertEqual(OutboxService.dispatch_due(now + timedelta(hours=1)), 1)
+        self.enqueue.assert_called_once_with(([message.whatsapp_details.id],), eta=None)
+
+    def test_leased_entries_are_not_claimed_twice(self):
+        with self.captureOnCommitCallbacks():
+            WhatsAppService.send_broadcast(self.account.id, ['+1', '+2'], 'Hello')
+
+        now = timezone.now()
+        self.assertEqual(len(OutboxService.claim_due(now)['whatsapp']), 2)
+        self.assertEqual(OutboxService.claim_due(now), {})
+
+    def test_failed_messages_do_not_strand_the_rest_of_their_chunk(self):
+        with self.captureOnCommitCallbacks():
+            messages = WhatsAppService.send_broadcast(self.account.id, ['+1', '+2'], 'Hello')
+        ids = [message.whatsapp_details.id for message in messages]
+
+        client = mock.Mock()
+        client.messages.create.return_value.sid = 'SM1'
+        with mock.patch.object(WhatsAppService, 'get_twilio_client', return_value=client), \
+                self.assertLogs('whatsapp_service.services', 'ERROR'):
+            self.assertEqual(send_whatsapp_messages([max(ids) + 100] + ids), 2)
+        self.assertEqual(Message.objects.filter(status='sent').count(), 2)
+
+        email_channel = Channel.objects.create(name='Email', type='email')
+        bare = Message.objects.create(channel=email_channel, recipient='a@example.com', content='x')
+        broken = Message.objects.create(channel=email_channel, recipient='b@example.com', content='x')
+        sendgrid = {'sendgrid': mock.Mock(), 'sendgrid.helpers.mail': mock.Mock()}
+        with mock.patch.dict(sys.modules, sendgrid), \
+                mock.patch('email_service.services.send_email', side_effect=[RuntimeError('boom'), True]), \
+                self.assertLogs('email_service.services', 'ERROR'):
+            self.assertEqual(send_emails([broken.id, bare.id]), 1)
+        broken.refresh_from_db()
+        self.assertEqual((broken.status, broken.metadata), ('failed', {'error': 'boom'}))
+
+        # Without email details the message fails on its own instead of raising
+        with mock.patch.dict(sys.modules, sendgrid):
+            self.assertEqual(send_emails([bare.id]), 0)
+        bare.refresh_from_db()
+        self.assertEqual((bare.status, bare.metadata), ('failed', {'error': 'missing email details'}))
+
+    def test_backfill_records_scheduled_messages_without_entries(self):
+        later = timezone.now() + timedelta(hours=1)
+        scheduled = Message.objects.create(channel=self.channel, recipient='+1', content='Later', scheduled_at=later)
+        WhatsAppMessage.objects.create(message=scheduled, account=self.account)
+        queued = Message.objects.create(channel=self.channel, recipient='+2', content='Later', scheduled_at=later)
+        OutboxService.record([queued], 'whatsapp', later)
+        Message.objects.create(channel=self.channel, recipient='+3', content='Done', scheduled_at=later, status='sent')
+
+        self.assertEqual(OutboxService.backfill_scheduled(batch_size=1), 1)
+        self.assertEqual(OutboxService.backfill_scheduled(), 0)
+        entry = OutboxEntry.objects.get(message=scheduled)
+        self.assertEqual((entry.channel_type, entry.available_at), ('whatsapp', later))
+
+
+class SuppressionTests(TestCase):
+
+    def setUp(self):
+        SuppressionService.refresh()
+        self.channel = Channel.objects.create(name='Email', type='email')
+
+    def fail(self, recipient, metadata, times=SUPPRESSION_FAILURE_THRESHOLD):
+        for _ in range(times):
+            Message.objects.create(channel=self.channel, recipient=recipient, content='x', status='failed', metadata=metadata)
+
+    def test_only_hard_bounces_count_whatever_their_spelling(self):
+        self.fail('Foo@X.com', {'bounce': True}, SUPPRESSION_FAILURE_THRESHOLD - 1)
+        self.fail('foo@x.com', {'bounce': True}, 1)
+        self.fail('timeout@example.com', {'error': 'Connection timed out'})
+        self.fail('spam@example.com', {'error': 'spam_score_exceeded'})
+
+        self.assertEqual(sorted(suppression_sources('email')[1]), ['foo@x.com'])
+        self.assertEqual(
+            SuppressionService.suppressed('email', ['FOO@x.com', 'timeout@example.com', 'spam@example.com']),
+            {'FOO@x.com'}
+        )
+
+    def test_filter_misses_skip_the_database_and_hits_are_confirmed(self):
+        SuppressionService.unsubscribe('Gone@Example.com')
+        SuppressionService.get_list('email')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(SuppressionService.suppressed('email', ['kept@example.com']), set())
+
+        # A false positive of the filter is ruled out by the exact check
+        suppression_list = SuppressionService.get_list('email')
+        with mock.patch.object(suppression_list.filter, 'contains_many', side_effect=lambda items: [True] * len(items)):
+            self.assertEqual(
+                SuppressionService.suppressed('email', ['kept@example.com', ' gone@example.com']),
+                {' gone@example.com'}
+            )
+
+    def test_changes_from_other_processes_reach_cached_lists(self):
+        user = get_user_model().objects.create(username='ann', email='Ann@Example.com', consent_marketing=True)
+        stale = SuppressionService.get_list('email')
+        self.assertEqual(SuppressionService.suppressed('email', ['ann@example.com', 'bob@example.com']), set())
+
+        # Written without SuppressionService, as another process would
+        with self.captureOnCommitCallbacks(execute=True):
+            Suppression.objects.create(recipient='bob@example.com', channel_type='')
+        with self.captureOnCommitCallbacks(execute=True):
+            user.consent_marketing = False
+            user.save(update_fields=['consent_marketing'])
+
+        self.assertEqual(
+            SuppressionService.suppressed('email', ['ann@example.com', 'bob@example.com']),
+            {'ann@example.com', 'bob@example.com'}
+        )
+        self.assertIsNot(SuppressionService.get_list('email'), stale)
+
+    def test_unrelated_user_saves_keep_cached_lists(self):
+        user = get_user_model().objects.create(username='ann', email='ann@example.com')
+        cached = SuppressionService.get_list('email')
+        with self.captureOnCommitCallbacks(execute=True):
+            user.save(update_fields=['last_login'])
+        self.assertIs(SuppressionService.get_list('email'), cached)
+
+
+@override_settings(ANALYTICS_CACHE_ENABLED=False)
+class WebchatTests(TransactionTestCase):
+    """The pool threads answering messages use their own connections, so data must be committed"""
+
+    def setUp(self):
+        self.channel = Channel.objects.create(name='Site', type='webchat')
+        # Ids are reused across flushed tests, so start from an empty channel cache
+        cache = mock.patch('communications.webchat._open_channels', (None, frozenset()))
+        cache.start()
+        self.addCleanup(cache.stop)
+        # Counters buffered by these tests are written before the tables are flushed
+        self.addCleanup(accumulator.flush)
+
+    def session(self, path, frames, query_string=b'', headers=(), application=webchat_application):
+        """Connect, send each frame in turn and return everything the application sent"""
+        async def run():
+            communicator = ApplicationCommunicator(
+                application, {'type': 'websocket', 'path': path, 'query_string': query_string, 'headers': list(headers)}
+            )
+            await communicator.send_input({'type': 'websocket.connect'})
+            outputs = [await communicator.receive_output(5)]
+            if outputs[0]['type'] == 'websocket.accept':
+                outputs.append(await communicator.receive_output(5))
+                for frame in frames:
+                    await communicator.send_input({'type': 'websocket.receive', 'text': frame})
+                    outputs.append(await communicator.receive_output(5))
+                await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await communicator.wait(5)
+            return outputs
+
+        outputs = async_to_sync(run)()
+        return outputs[0], [json.loads(output['text']) for output in outputs[1:]]
+
+    def test_unknown_or_inactive_channel_is_refused(self):
+        Channel.objects.filter(id=self.channel.id).update(is_active=False)
+        for path in [f'/ws/webchat/{self.channel.id}/', '/ws/webchat/0/', '/ws/other/']:
+            first, _ = self.session(path, [])
+            self.assertEqual(first, {'type': 'websocket.close', 'code': CLOSE_UNKNOWN_CHANNEL})
+
+    def test_unknown_channels_reload_at_most_once_per_miss_ttl(self):
+        with mock.patch.object(WebchatService, 'open_channel_ids', wraps=WebchatService.open_channel_ids) as load:
+            for _ in range(5):
+                first, _ = self.session('/ws/webchat/0/', [])
+                self.assertEqual(first, {'type': 'websocket.close', 'code': CLOSE_UNKNOWN_CHANNEL})
+        self.assertEqual(load.call_count, 1)
+
+    def test_messages_get_replies_in_one_conversation(self):
+        path = f'/ws/webchat/{self.channel.id}/'
+        first, frames = self.session(
+            path, ['{"type": "message", "text": "Hello"}', '{"type": "ping"}', '{"type": "message"}']
+        )
+
+        self.assertEqual(first, {'type': 'websocket.accept'})
+        self.assertEqual(frames[0]['type'], 'welcome')
+        self.assertEqual([frame['type'] for frame in frames[1:]], ['reply', 'pong', 'error'])
+
+        # Reconnecting with the issued token continues the same conversation
+        token = frames[0]['token']
+        _, resumed = self.session(path, ['Anyone there?'], f'token={token}'.encode())
+        self.assertEqual(read_visitor_token(self.channel.id, resumed[0]['token']), read_visitor_token(self.channel.id, token))
+
+        conversation = Conversation.objects.get(channel=self.channel, external_id=read_visitor_token(self.channel.id, token))
+        self.assertEqual({frames[1]['conversation_id'], resumed[1]['conversation_id']}, {conversation.id})
+        self.assertEqual(
+            list(conversation.messages.order_by('id').values_list('is_from_user', flat=True)),
+            [True, False, True, False]
+        )
+        self.assertEqual(resumed[1]['message_id'], conversation.messages.order_by('id').last().id)
+
+    def test_pipeline_failures_are_logged(self):
+        with mock.patch.object(WebchatService, 'handle_message', side_effect=RuntimeError('boom')), \
+                self.assertLogs('communications.webchat', 'ERROR') as logs:
+            _, frames = self.session(f'/ws/webchat/{self.channel.id}/', ['Hello'])
+        self.assertEqual(frames[1], {'type': 'error', 'error': 'Message could not be processed'})
+        self.assertIn('boom', logs.output[0])
+
+    def test_visitor_ids_come_only_from_valid_tokens(self):
+        other = Channel.objects.create(name='Other site', type='webchat')
+        token = issue_visitor_token(self.channel.id, 'v-1')
+        for query_string in [b'visitor=v-1', f'token={token}x'.encode(), f'token={issue_visitor_token(other.id, "v-1")}'.encode()]:
+            first, frames = self.session(f'/ws/webchat/{self.channel.id}/', [], query_string)
+            if query_string.startswith(b'visitor='):
+                # A visitor id claimed by the client is ignored; a new one is issued
+                self.assertNotEqual(read_visitor_token(self.channel.id, frames[0]['token']), 'v-1')
+            else:
+                self.assertEqual(first, {'type': 'websocket.close', 'code': CLOSE_INVALID_TOKEN})
+
+    def test_sockets_from_other_origins_are_refused(self):
+        path = f'/ws/webchat/{self.channel.id}/'
+        host = (b'host', b'chat.example.com:8000')
+        first, _ = self.session(path, [], headers=[host, (b'origin', b'https://evil.example.net')])
+        self.assertEqual(first, {'type': 'websocket.close', 'code': CLOSE_FORBIDDEN_ORIGIN})
+        first, _ = self.session(path, [], headers=[host, (b'origin', b'https://chat.example.com')])
+        self.assertEqual(first, {'type': 'websocket.accept'})
+
+        with mock.patch('communications.webchat.WEBCHAT_ALLOWED_ORIGINS', ['.example.net']):
+            first, _ = self.session(path, [], headers=[host, (b'origin', b'https://evil.example.net')])
+        self.assertEqual(first, {'type': 'websocket.accept'})
+
+    def test_asgi_entrypoint_serves_http_and_webchat(self):
+        from config.asgi import application
+
+        async def get(path):
+            communicator = ApplicationCommunicator(application, {
+                'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': [(b'host', b'testserver')]
+            })
+            await communicator.send_input({'type': 'http.request', 'body': b''})
+            return await communicator.receive_output(5)
+
+        self.assertEqual(async_to_sync(get)('/missing/')['status'], 404)
+        first, frames = self.session(f'/ws/webchat/{self.channel.id}/', [], application=application)
+        self.assertEqual(first, {'type': 'websocket.accept'})
+        self.assertEqual(frames[0]['type'], 'welcome')
@@ -0,0 +1,8 @@
+from django.urls import path
+
+from . import views
+
+urlpatterns = [
+    path("", views.index, name="index"),
+    path("conversations/<int:conversation_id>/messages/", views.conversation_history, name="conversation-history"),
+]
@@ -0,0 +1,37 @@
+from django.http import HttpResponse, JsonResponse
+from communications.models import Conversation
+from communications.services import ConversationHistoryService, InvalidCursor
+
+
+def index(request):
+    return HttpResponse("Hello, world. You're at communications")
+
+
+def conversation_history(request, conversation_id):
+    """Keyset-paginated messages of a conversation
+
+    ?before=<cursor> pages into older history, ?since=<cursor> polls for newer
+    messages, ?limit=N sets the page size and ?fields=light leaves out
+    attachments and metadata. Staff can read every conversation, other users
+    only their own.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'Authentication required'}, status=401)
+
+    conversations = Conversation.objects.all() if request.user.is_staff else Conversation.objects.filter(user=request.user)
+    # Conversations the caller may not read look missing, so ids cannot be probed
+    if not conversations.filter(id=conversation_id).exists():
+        return JsonResponse({'error': 'Conversation not found'}, status=404)
+
+    try:
+        page = ConversationHistoryService.get_history(
+            conversation_id,
+            before=request.GET.get('before'),
+            since=request.GET.get('since'),
+            limit=int(request.GET.get('limit', 50)),
+            light=request.GET.get('fields') == 'light'
+        )
+    except (InvalidCursor, ValueError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse(page)
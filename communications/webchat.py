@@ -0,0 +1,242 @@
+# communications/webchat.py
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+from django.conf import settings
+from django.core import signing
+from django.db import close_old_connections
+from django.http.request import split_domain_port, validate_host
+from communications.models import Channel, Conversation
+
+logger = logging.getLogger(__name__)
+
+# Threads running the (synchronous) chatbot pipeline for all sockets of a process
+WEBCHAT_MAX_WORKERS = getattr(settings, 'WEBCHAT_MAX_WORKERS', 8)
+
+# Seconds the set of open webchat channels is reused before it is reloaded
+WEBCHAT_CHANNEL_TTL = getattr(settings, 'WEBCHAT_CHANNEL_TTL', 60)
+
+# Seconds after a load during which unknown channel ids are refused without reloading
+WEBCHAT_CHANNEL_MISS_TTL = getattr(settings, 'WEBCHAT_CHANNEL_MISS_TTL', 5)
+
+# Longest user message accepted, in characters
+WEBCHAT_MAX_MESSAGE_LENGTH = getattr(settings, 'WEBCHAT_MAX_MESSAGE_LENGTH', 4000)
+
+# Hosts pages may open webchat sockets from, matched like ALLOWED_HOSTS; by default only the server's own host
+WEBCHAT_ALLOWED_ORIGINS = getattr(settings, 'WEBCHAT_ALLOWED_ORIGINS', None)
+
+# Seconds a visitor token stays valid; every connection is welcomed with a fresh one
+WEBCHAT_VISITOR_TOKEN_MAX_AGE = getattr(settings, 'WEBCHAT_VISITOR_TOKEN_MAX_AGE', 30 * 24 * 3600)
+
+# ws[s]://<host>/ws/webchat/<channel_id>/[?token=<visitor token>]
+WEBCHAT_PATH = re.compile(r'/ws/webchat/(?P<channel_id>\d+)/?')
+
+VISITOR_TOKEN_SALT = 'communications.webchat.visitor'
+
+# Close codes, sent before accepting, so clients see an HTTP 403
+CLOSE_INVALID_TOKEN = 4401
+CLOSE_FORBIDDEN_ORIGIN = 4403
+CLOSE_UNKNOWN_CHANNEL = 4404
+
+_webchat_pool = None
+_webchat_pool_lock = threading.Lock()
+
+# (monotonic load time, ids of open webchat channels); only touched on the event loop
+_open_channels = (None, frozenset())
+
+
+def _get_webchat_pool():
+    global _webchat_pool
+    with _webchat_pool_lock:
+        if _webchat_pool is None:
+            _webchat_pool = ThreadPoolExecutor(max_workers=WEBCHAT_MAX_WORKERS, thread_name_prefix='webchat')
+        return _webchat_pool
+
+
+def _run_webchat_call(func, *args):
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def _run(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_get_webchat_pool(), _run_webchat_call, func, *args)
+
+
+async def _is_open(channel_id):
+    global _open_channels
+    loaded_at, channel_ids = _open_channels
+    age = None if loaded_at is None else time.monotonic() - loaded_at
+    # Reloaded when stale, or for an id that may have been created since, at most once per miss TTL
+    if age is None or age > WEBCHAT_CHANNEL_TTL or (channel_id not in channel_ids and age > WEBCHAT_CHANNEL_MISS_TTL):
+        channel_ids = frozenset(await _run(WebchatService.open_channel_ids))
+        _open_channels = (time.monotonic(), channel_ids)
+    return channel_id in channel_ids
+
+
+def _header(scope, name):
+    for key, value in scope.get('headers', []):
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def _origin_allowed(scope):
+    origin = _header(scope, b'origin')
+    # Browsers always send an Origin; other clients can set any, so there is nothing to check
+    if origin is None:
+        return True
+
+    origin_host = urlsplit(origin).hostname
+    if not origin_host:
+        return False
+    if WEBCHAT_ALLOWED_ORIGINS is not None:
+        return validate_host(origin_host, WEBCHAT_ALLOWED_ORIGINS)
+
+    host, _ = split_domain_port(_header(scope, b'host') or '')
+    return bool(host) and origin_host == host
+
+
+def issue_visitor_token(channel_id, visitor):
+    """Signed token proving a visitor id was issued by this server for this channel"""
+    return signing.dumps([channel_id, visitor], salt=VISITOR_TOKEN_SALT)
+
+
+def read_visitor_token(channel_id, token):
+    """Visitor id carried by a token, or None when it is forged, expired or for another channel"""
+    try:
+        token_channel_id, visitor = signing.loads(token, salt=VISITOR_TOKEN_SALT, max_age=WEBCHAT_VISITOR_TOKEN_MAX_AGE)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    return visitor if token_channel_id == channel_id else None
+
+
+class WebchatService:
+    """Blocking side of the webchat transport, run on the webchat pool"""
+
+    @staticmethod
+    def open_channel_ids():
+        """Ids of the active webchat channels"""
+        return list(Channel.objects.filter(type='webchat', is_active=True).values_list('id', flat=True))
+
+    @staticmethod
+    def handle_message(channel_id, visitor, text, conversation_id=None):
+        """Run a visitor message through the chatbot; returns (conversation_id, chatbot result)"""
+        # Imported here: the chatbot pipeline loads its NLP dependencies on import
+        from chatbot.services import ChatbotService
+
+        if conversation_id is None:
+            conversation, _ = Conversation.objects.get_or_create(
+                channel_id=channel_id,
+                external_id=visitor,
+                defaults={'metadata': {'source': 'webchat'}}
+            )
+            conversation_id = conversation.id
+
+        return conversation_id, ChatbotService.process_user_message(conversation_id, text)
+
+
+def _frame(payload):
+    return {'type': 'websocket.send', 'text': json.dumps(payload, separators=(',', ':'))}
+
+
+def _parse(event):
+    """Text of a client frame: {"type": "message", "text": ...}, or a bare string"""
+    raw = event.get('text')
+    if raw is None:
+        raw = (event.get('bytes') or b'').decode('utf-8', 'replace')
+
+    try:
+        payload = json.loads(raw)
+    except ValueError:
+        return 'message', raw
+
+    if not isinstance(payload, dict):
+        return 'message', raw
+    return payload.get('type', 'message'), payload.get('text', '')
+
+
+async def webchat_application(scope, receive, send):
+    """ASGI application serving webchat channels over WebSockets
+
+    Each socket is one coroutine awaiting its next frame; an idle visitor
+    holds no thread, no database connection and no Django request, only this
+    frame's few locals. Open channels are cached in the process and the
+    conversation is created on the first message, so connecting normally
+    costs no query; a deactivated channel stops accepting sockets within
+    WEBCHAT_CHANNEL_TTL seconds. Replies are computed on a small shared
+    thread pool and pushed back on the same socket, in order.
+
+    Visitor ids are only ever issued by the server: the welcome frame carries
+    a signed token, and a client resumes its conversation by connecting with
+    ?token=<token>. Sockets from pages outside WEBCHAT_ALLOWED_ORIGINS and
+    tokens that do not verify are refused.
+    """
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+
+    if not _origin_allowed(scope):
+        await send({'type': 'websocket.close', 'code': CLOSE_FORBIDDEN_ORIGIN})
+        return
+
+    match = WEBCHAT_PATH.fullmatch(scope['path'])
+    channel_id = int(match['channel_id']) if match else None
+    if channel_id is None or not await _is_open(channel_id):
+        await send({'type': 'websocket.close', 'code': CLOSE_UNKNOWN_CHANNEL})
+        return
+
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    token = (query.get('token') or [None])[0]
+    if token:
+        visitor = read_visitor_token(channel_id, token)
+        if visitor is None:
+            await send({'type': 'websocket.close', 'code': CLOSE_INVALID_TOKEN})
+            return
+    else:
+        visitor = uuid.uuid4().hex
+    conversation_id = None
+
+    await send({'type': 'websocket.accept'})
+    await send(_frame({'type': 'welcome', 'token': issue_visitor_token(channel_id, visitor)}))
+
+    while True:
+        event = await receive()
+        if event['type'] == 'websocket.disconnect':
+            return
+        if event['type'] != 'websocket.receive':
+            continue
+
+        kind, text = _parse(event)
+        if kind == 'ping':
+            await send(_frame({'type': 'pong'}))
+            continue
+        if kind != 'message' or not isinstance(text, str) or not text.strip():
+            await send(_frame({'type': 'error', 'error': 'Expected {"type": "message", "text": "..."}'}))
+            continue
+        if len(text) > WEBCHAT_MAX_MESSAGE_LENGTH:
+            await send(_frame({'type': 'error', 'error': f'Message longer than {WEBCHAT_MAX_MESSAGE_LENGTH} characters'}))
+            continue
+
+        try:
+            conversation_id, result = await _run(WebchatService.handle_message, channel_id, visitor, text, conversation_id)
+        except Exception:
+            logger.exception('Webchat message on channel %s could not be processed', channel_id)
+            await send(_frame({'type': 'error', 'error': 'Message could not be processed'}))
+            continue
+
+        await send(_frame({
+            'type': 'reply',
+            'conversation_id': conversation_id,
+            'text': result['response'],
+            'message_id': result['message_id'],
+            'needs_handoff': result['needs_handoff']
+        }))
@@ -1,5 +0,0 @@
-from django.http import HttpResponse
-
-
-def index(request):
-    return HttpResponse("Hello, world. You're at communications")
\ No newline at end of file
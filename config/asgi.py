@@ -2,6 +2,7 @@
 ASGI config for config project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP goes to Django; WebSocket connections are the webchat channel.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
@@ -13,4 +14,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        # Imported on the first socket, so a webchat problem never takes HTTP down with it
+        from communications.webchat import webchat_application
+
+        return await webchat_application(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -15,10 +15,10 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from communicatons.views import index
 from django.urls import include, path
 
 urlpatterns = [
-    path('communications/', index, name='index'),
+    path('communications/', include('communications.urls')),
+    path('analytics/', include('analytics.urls')),
     path('admin/', admin.site.urls),
 ]
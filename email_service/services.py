@@ -1,12 +1,24 @@
 import csv
 import io
+import logging
 from datetime import datetime
+from itertools import islice
+from django.db import transaction
 from django.core.files.storage import default_storage
 from django.template import Template as DjangoTemplate, Context
 from django.conf import settings
 from celery import shared_task
 from communications.models import Channel, Template, Message
+from communications.services import OutboxService
+from communications.suppression import SuppressionService
+from analytics.cache import analytics_cache
 from email_service.models import EmailBatch, EmailMessage
+from email_service.spam import SPAM_THRESHOLD, spam_scorer
+
+logger = logging.getLogger(__name__)
+
+# Recipients rendered, scored and inserted per round trip
+INGEST_CHUNK_SIZE = 1000
 
 class EmailService:
     @staticmethod
@@ -24,73 +36,108 @@ class EmailService:
         """Process an email batch by creating messages for each recipient"""
         batch = EmailBatch.objects.get(id=batch_id)
         template = Template.objects.get(id=template_id)
-        channel = template.channel
+        
+        # Compile templates once for the whole batch
+        content_template = DjangoTemplate(template.content)
+        subject_template = DjangoTemplate(template.subject)
         
         # Read CSV file
         file_path = batch.recipients_file.path
         with open(file_path, 'r') as file:
             reader = csv.DictReader(file)
-            for row in reader:
-                # Ensure required field exists
-                if 'email' not in row:
-                    continue
-                
-                # Process template variables
-                context = Context(row)
-                django_template = DjangoTemplate(template.content)
-                rendered_content = django_template.render(context)
-                
-                subject_template = DjangoTemplate(template.subject)
-                rendered_subject = subject_template.render(context)
+            # Ensure required field exists
+            rows = (row for row in reader if 'email' in row)
+            
+            while True:
+                chunk = list(islice(rows, INGEST_CHUNK_SIZE))
+                if not chunk:
+                    break
                 
-                # Create message
-                message = Message.objects.create(
-                    channel=channel,
-                    template=template,
-                    recipient=row['email'],
-                    subject=rendered_subject,
-                    content=rendered_content,
-                    scheduled_at=schedule_time,
-                    status='pending'
-                )
+                # Drop bounced, unsubscribed and non-consenting recipients before any rows exist
+                suppressed = SuppressionService.suppressed('email', [row['email'] for row in chunk])
+                chunk = [row for row in chunk if row['email'] not in suppressed]
                 
-                # Create email specific details
-                EmailMessage.objects.create(
-                    message=message,
-                    batch=batch
+                EmailService._create_batch_messages(
+                    batch, template, chunk, content_template, subject_template, schedule_time
                 )
         
         batch.processed = True
         batch.save()
         
-        # If immediate sending (no schedule)
-        if not schedule_time:
-            send_batch_emails.delay(batch_id)
-        
         return batch
     
     @staticmethod
-    def check_spam_score(content):
-        """Calculate spam score for email content"""
-        # This would be a more complex implementation in production
-        # Simplified version for demonstration
-        spam_keywords = ['free', 'discount', 'offer', 'limited time', 'act now', 'click here']
-        score = 0
-        content_lower = content.lower()
+    def _create_batch_messages(batch, template, rows, content_template, subject_template, schedule_time):
+        """Render, spam score and bulk insert one chunk of batch recipients"""
+        rendered = [content_template.render(Context(row)) for row in rows]
+        scores = spam_scorer.score_template(template.content, rows, rendered)
+        
+        messages = []
+        for row, content, score in zip(rows, rendered, scores):
+            # Reject spammy content now rather than when the send is attempted
+            rejected = score > SPAM_THRESHOLD
+            messages.append(Message(
+                channel=template.channel,
+                template=template,
+                recipient=row['email'],
+                subject=subject_template.render(Context(row)),
+                content=content,
+                scheduled_at=schedule_time,
+                status='failed' if rejected else 'pending',
+                metadata={'error': 'spam_score_exceeded'} if rejected else {}
+            ))
+        
+        with transaction.atomic():
+            messages = Message.objects.bulk_create(messages)
+            
+            # Create email specific details
+            EmailMessage.objects.bulk_create([
+                EmailMessage(message=message, batch=batch, spam_score=float(score))
+                for message, score in zip(messages, scores)
+            ])
+            
+            # Queued for sending, now or at the scheduled time, in the same transaction
+            OutboxService.record(
+                [message for message in messages if message.status == 'pending'], 'email', schedule_time
+            )
+    
+    @staticmethod
+    def rescore_batch(batch_id):
+        """Recompute spam scores for the pending emails of a batch, e.g. after the rules change"""
+        emails = list(
+            EmailMessage.objects.filter(batch_id=batch_id, message__status='pending').select_related('message')
+        )
+        scores = spam_scorer.score_many([email.message.content for email in emails])
+        
+        rejected = []
+        for email, score in zip(emails, scores):
+            email.spam_score = float(score)
+            if score > SPAM_THRESHOLD:
+                email.message.status = 'failed'
+                email.message.metadata = {'error': 'spam_score_exceeded'}
+                rejected.append(email.message)
         
-        for keyword in spam_keywords:
-            if keyword in content_lower:
-                score += 0.1
+        with transaction.atomic():
+            EmailMessage.objects.bulk_update(emails, ['spam_score'], batch_size=INGEST_CHUNK_SIZE)
+            Message.objects.bulk_update(rejected, ['status', 'metadata'], batch_size=INGEST_CHUNK_SIZE)
         
-        return min(score, 1.0)
+        return len(rejected)
+    
+    @staticmethod
+    def check_spam_score(content):
+        """Calculate spam score for email content"""
+        return spam_scorer.score(content)
     
     @staticmethod
     def track_email_open(email_id, ip_address=None, user_agent=None):
         """Track email open event"""
         try:
-            email = EmailMessage.objects.get(id=email_id)
+            email = EmailMessage.objects.select_related('message').get(id=email_id)
             email.opens += 1
             email.save()
+            
+            # Cached email performance for the send day is now stale
+            analytics_cache.mark_rewritten([email.message.sent_at])
             return True
         except EmailMessage.DoesNotExist:
             return False
@@ -99,9 +146,10 @@ class EmailService:
     def track_email_click(email_id, url, ip_address=None, user_agent=None):
         """Track email link click event"""
         try:
-            email = EmailMessage.objects.get(id=email_id)
+            email = EmailMessage.objects.select_related('message').get(id=email_id)
             email.clicks += 1
             email.save()
+            analytics_cache.mark_rewritten([email.message.sent_at])
             
             # Create click event
             EmailClick.objects.create(
@@ -118,12 +166,31 @@ class EmailService:
 # Celery tasks for email service
 @shared_task
 def send_batch_emails(batch_id):
-    """Send all emails in a batch"""
-    batch = EmailBatch.objects.get(id=batch_id)
-    email_messages = EmailMessage.objects.filter(batch=batch, message__status='pending')
+    """Queue the pending emails of a batch that are not already waiting in the outbox"""
+    messages = list(Message.objects.filter(
+        email_details__batch_id=batch_id,
+        status='pending',
+        outbox_entry__isnull=True
+    ).only('id'))
+    
+    with transaction.atomic():
+        OutboxService.record(messages, 'email')
     
-    for email in email_messages:
-        send_email.delay(email.message.id)
+    return len(messages)
+
+
+@shared_task
+def send_emails(message_ids):
+    """Send a chunk of emails handed over by the outbox dispatcher"""
+    sent = 0
+    for message_id in message_ids:
+        try:
+            sent += send_email(message_id)
+        except Exception as e:
+            # The outbox entries of the chunk are gone, so one bad message must not strand the rest
+            logger.exception('Sending email message %s failed', message_id)
+            Message.objects.filter(id=message_id, status='pending').update(status='failed', metadata={'error': str(e)})
+    return sent
 
 
 @shared_task
@@ -133,15 +200,23 @@ def send_email(message_id):
     from sendgrid.helpers.mail import Mail
     
     message = Message.objects.get(id=message_id)
-    email_details = message.email_details
     
-    # Update spam score
-    email_details.spam_score = EmailService.check_spam_score(message.content)
-    email_details.save()
+    # Already handled by an earlier delivery of this task
+    if message.status != 'pending':
+        return False
     
-    # Skip sending if spam score is too high
-    if email_details.spam_score > 0.7:
+    try:
+        email_details = message.email_details
+    except EmailMessage.DoesNotExist:
         message.status = 'failed'
+        message.metadata = {'error': 'missing email details'}
+        message.save()
+        return False
+    
+    # Spam score is computed when the batch is ingested
+    if email_details.spam_score > SPAM_THRESHOLD:
+        message.status = 'failed'
+        message.metadata = {'error': 'spam_score_exceeded'}
         message.save()
         return False
     
@@ -177,6 +252,7 @@ def send_email(message_id):
             return True
         else:
             message.status = 'failed'
+            message.metadata = {'error': f'SendGrid responded {response.status_code}'}
             message.save()
             return False
             
@@ -190,11 +266,5 @@ def send_email(message_id):
 @shared_task
 def check_scheduled_emails():
     """Check for emails that need to be sent based on schedule"""
-    now = datetime.now()
-    scheduled_messages = Message.objects.filter(
-        status='pending',
-        scheduled_at__lte=now
-    )
-    
-    for message in scheduled_messages:
-        send_email.delay(message.id)
\ No newline at end of file
+    # Kept for existing beat schedules; the outbox dispatcher handles every channel
+    return OutboxService.dispatch_due()
@@ -0,0 +1,119 @@
+# email_service/spam.py
+import re
+import numpy as np
+from django.utils.html import conditional_escape
+
+# (keyword, weight) pairs - a message scores the sum of the weights of the
+# distinct keywords it contains, capped at 1.0
+SPAM_RULES = (
+    ('free', 0.1),
+    ('discount', 0.1),
+    ('offer', 0.1),
+    ('limited time', 0.1),
+    ('act now', 0.1),
+    ('click here', 0.1),
+)
+
+# Messages scoring above this are rejected
+SPAM_THRESHOLD = 0.7
+
+# Templates made only of literal text and plain {{ variable }} substitutions
+VARIABLE_RE = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+
+class SpamScorer:
+    """Weighted multi-keyword spam matcher compiled into a single regex"""
+
+    def __init__(self, rules=SPAM_RULES):
+        self.keywords = [keyword.lower() for keyword, _ in rules]
+        self.weights = np.array([weight for _, weight in rules], dtype=float)
+        self._index = {keyword: i for i, keyword in enumerate(self.keywords)}
+
+        # Longest keyword first so a keyword that prefixes another doesn't hide it.
+        # The lookahead reports a match at every offset, including overlapping ones
+        alternation = '|'.join(re.escape(k) for k in sorted(self.keywords, key=len, reverse=True))
+        self._pattern = re.compile(f'(?=({alternation}))')
+
+        # Any keyword touching a variable lies within this many chars of it
+        self.window = max(len(k) for k in self.keywords) - 1
+        self._template_cache = {}
+        self._window_cache = {}
+
+    def hits(self, text):
+        """Return the set of rule indexes matched anywhere in text"""
+        return frozenset(self._index[m] for m in self._pattern.findall(text.lower()))
+
+    def score_hits(self, hit_sets):
+        """Vectorized weighted score for a sequence of hit sets"""
+        matrix = np.zeros((len(hit_sets), len(self.keywords)), dtype=bool)
+        for row, hits in enumerate(hit_sets):
+            matrix[row, list(hits)] = True
+        return np.minimum(matrix @ self.weights, 1.0)
+
+    def score(self, text):
+        """Score a single piece of content"""
+        return float(self.score_hits([self.hits(text)])[0])
+
+    def score_many(self, texts):
+        """Score many pieces of content, scanning each distinct text once"""
+        unique = {}
+        for text in texts:
+            if text not in unique:
+                unique[text] = self.hits(text)
+        return self.score_hits([unique[text] for text in texts])
+
+    def _parse_template(self, source):
+        """Split template source into (literals, variables), or None if it isn't a plain substitution template"""
+        if source not in self._template_cache:
+            parsed = None
+            if '{%' not in source and '{#' not in source and len(VARIABLE_RE.findall(source)) == source.count('{{'):
+                parts = VARIABLE_RE.split(source)
+                literals, variables = parts[0::2], parts[1::2]
+                static_hits = frozenset().union(*(self.hits(literal) for literal in literals))
+                parsed = (literals, variables, static_hits)
+            self._template_cache[source] = parsed
+        return self._template_cache[source]
+
+    def _window_hits(self, window):
+        hits = self._window_cache.get(window)
+        if hits is None:
+            if len(self._window_cache) > 100000:
+                self._window_cache.clear()
+            hits = self._window_cache[window] = self.hits(window)
+        return hits
+
+    def score_template(self, source, contexts, rendered=None):
+        """Score the content a template renders to for each context
+
+        Literal template text is scanned once per template; per recipient only
+        the text around each substituted variable is scanned, and identical
+        windows are only scanned once. Templates using tags or filters fall
+        back to scanning the fully rendered content in `rendered`.
+        """
+        parsed = self._parse_template(source)
+        if parsed is None:
+            return self.score_many(rendered)
+
+        literals, variables, static_hits = parsed
+        hit_sets = []
+        for context in contexts:
+            pieces = [literals[0]]
+            spans = []
+            offset = len(literals[0])
+            for variable, literal in zip(variables, literals[1:]):
+                value = str(conditional_escape(context[variable])) if variable in context else ''
+                spans.append((offset, offset + len(value)))
+                pieces.append(value)
+                pieces.append(literal)
+                offset += len(value) + len(literal)
+
+            text = ''.join(pieces)
+            hits = static_hits
+            for start, end in spans:
+                hits = hits | self._window_hits(text[max(start - self.window, 0):end + self.window])
+            hit_sets.append(hits)
+
+        return self.score_hits(hit_sets)
+
+
+spam_scorer = SpamScorer()
@@ -1,3 +1,103 @@
-from django.test import TestCase
+import shutil
+import tempfile
+from unittest import mock
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from communications.models import Channel, Message, OutboxEntry, Template
+from communications.suppression import SuppressionService
+from email_service.models import EmailBatch
+from email_service.services import EmailService
+from email_service.spam import SpamScorer
 
-# Create your tests here.
+
+class SpamScorerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.scorer = SpamScorer()
+
+    def test_template_scores_match_full_scans(self):
+        source = 'Hi {{ name }}, {{ pitch }} - act now!'
+        contexts = [
+            {'name': 'Ann', 'pitch': 'a free offer'},
+            {'name': 'Bob', 'pitch': 'nothing new'},
+            # Keywords formed across a variable and the literal text around it
+            {'name': 'Cl', 'pitch': 'click'},
+            {'name': 'Dee', 'pitch': '<b>discount</b>'},
+            {'name': 'Eve'},
+        ]
+        rendered = [
+            'Hi Ann, a free offer - act now!',
+            'Hi Bob, nothing new - act now!',
+            'Hi Cl, click - act now!',
+            'Hi Dee, &lt;b&gt;discount&lt;/b&gt; - act now!',
+            'Hi Eve,  - act now!',
+        ]
+
+        scores = self.scorer.score_template(source, contexts, rendered)
+        self.assertEqual(list(scores), [self.scorer.score(text) for text in rendered])
+
+    def test_repeated_windows_reuse_their_verdict(self):
+        source = 'Dear {{ name }}, this offer ends soon. Click here to act now.'
+        contexts = [{'name': name} for name in ['Ann', 'Bob', 'Ann', 'Bob', 'Ann']]
+        rendered = [f'Dear {context["name"]}, this offer ends soon. Click here to act now.' for context in contexts]
+
+        with mock.patch.object(self.scorer, 'hits', wraps=self.scorer.hits) as hits:
+            scores = self.scorer.score_template(source, contexts, rendered)
+
+        # The two literals once, then one window per distinct name
+        self.assertEqual(hits.call_count, 4)
+        self.assertEqual(list(scores), [self.scorer.score(text) for text in rendered])
+        self.assertEqual(len(set(scores)), 1)
+
+    def test_templates_with_tags_fall_back_to_rendered_content(self):
+        source = '{% if vip %}Free upgrade{% endif %} for {{ name }}'
+        rendered = ['Free upgrade for Ann', ' for Bob']
+        scores = self.scorer.score_template(source, [{'vip': True, 'name': 'Ann'}, {'name': 'Bob'}], rendered)
+        self.assertEqual(list(scores), [self.scorer.score(text) for text in rendered])
+
+
+class ProcessBatchTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        SuppressionService.refresh()
+        self.channel = Channel.objects.create(name='Email', type='email')
+        self.batch = EmailBatch.objects.create(
+            name='Launch',
+            recipients_file=SimpleUploadedFile('recipients.csv', b'email,name\na@example.com,Ann\nb@example.com,Bob\n')
+        )
+
+    def process(self, content):
+        template = Template.objects.create(name='Launch', channel=self.channel, subject='Hi {{ name }}', content=content)
+        with mock.patch('email_service.services.SPAM_THRESHOLD', 0.25):
+            EmailService.process_batch(self.batch.id, template.id)
+        return Message.objects.filter(template=template).order_by('recipient')
+
+    def test_spammy_template_is_rejected_at_ingestion(self):
+        messages = self.process('Free offer for {{ name }}: act now!')
+
+        self.assertEqual(
+            list(messages.values_list('status', 'metadata')),
+            [('failed', {'error': 'spam_score_exceeded'})] * 2
+        )
+        self.assertEqual(
+            [round(score, 2) for score in messages.values_list('email_details__spam_score', flat=True)], [0.3, 0.3]
+        )
+        self.assertFalse(OutboxEntry.objects.exists())
+
+    def test_clean_template_is_queued(self):
+        messages = self.process('Hello {{ name }}, your order has shipped.')
+
+        self.assertEqual(list(messages.values_list('status', flat=True)), ['pending', 'pending'])
+        self.assertEqual(list(messages.values_list('email_details__spam_score', flat=True)), [0.0, 0.0])
+        self.assertEqual(OutboxEntry.objects.filter(message__in=messages).count(), 2)
+
+    def test_suppressed_recipients_get_no_messages(self):
+        SuppressionService.unsubscribe('A@Example.com')
+        messages = self.process('Hello {{ name }}, your order has shipped.')
+        self.assertEqual(list(messages.values_list('recipient', flat=True)), ['b@example.com'])
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ReportingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'reporting'
+
+    def ready(self):
+        # Warm the PDF renderer in Celery worker processes as they start
+        from reporting import pdf  # noqa: F401
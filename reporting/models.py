@@ -16,6 +16,7 @@ class Report(models.Model):
         ('pdf', 'PDF'),
         ('csv', 'CSV'),
         ('json', 'JSON'),
+        ('ndjson', 'NDJSON'),
     )
     
     name = models.CharField(max_length=255)
@@ -30,4 +31,14 @@ class Report(models.Model):
     file = models.FileField(upload_to='reports/', null=True, blank=True)
     
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+class ReportArtifact(models.Model):
+    """Generated report file shared by every report with the same content fingerprint"""
+    fingerprint = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to='reports/', null=True, blank=True)
+    generated_at = models.DateTimeField(auto_now=True)
+    rendering_until = models.DateTimeField(null=True, blank=True)  # Claim of the worker rendering the file
+    
+    def __str__(self):
+        return self.fingerprint
@@ -0,0 +1,170 @@
+# reporting/pdf.py
+import logging
+import os
+import threading
+import time
+import uuid
+from celery.signals import worker_process_init
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+
+logger = logging.getLogger(__name__)
+
+# Renders allowed at once across every process sharing PDF_RENDER_CACHE
+PDF_RENDER_CONCURRENCY = getattr(settings, 'PDF_RENDER_CONCURRENCY', os.cpu_count() or 1)
+
+# Seconds a render may wait for a free slot before giving up
+PDF_RENDER_TIMEOUT = getattr(settings, 'PDF_RENDER_TIMEOUT', 120)
+
+# Seconds a slot outlives its last refresh; a render refreshes its slot every
+# third of this, so only a killed renderer loses one and cannot keep it either
+PDF_RENDER_SLOT_TTL = getattr(settings, 'PDF_RENDER_SLOT_TTL', 600)
+
+# Django cache holding the slots; it must be shared (e.g. Redis) for the cap to span hosts and processes
+PDF_RENDER_CACHE = getattr(settings, 'PDF_RENDER_CACHE', 'default')
+
+# Warm WeasyPrint in every Celery worker process as it starts; enable on the workers consuming report tasks
+PDF_RENDER_WARM_WORKERS = getattr(settings, 'PDF_RENDER_WARM_WORKERS', False)
+
+# Stylesheets applied to every report, parsed once per process
+PDF_STYLESHEETS = getattr(settings, 'PDF_STYLESHEETS', [])
+
+# Seconds between attempts to take a slot
+SLOT_POLL_INTERVAL = 0.1
+
+# Run atomically by Redis: release or refresh a slot only while it still holds the caller's token
+RELEASE_SLOT_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+REFRESH_SLOT_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end return 0"
+
+
+class PdfRenderTimeout(Exception):
+    pass
+
+
+class PdfRenderer:
+    """Renders HTML to PDF in the calling process, with WeasyPrint loaded once per process
+
+    Rendering never starts child processes, so it works inside Celery's
+    daemonic prefork workers. Parallelism and memory are managed by routing
+    report tasks to a dedicated queue (REPORT_TASK_QUEUE) and consuming it
+    with a worker whose settings enable PDF_RENDER_WARM_WORKERS:
+
+        celery worker -Q reports --concurrency 4 --max-tasks-per-child 200
+
+    Every child of that worker is warmed as it starts, including the ones
+    replacing children retired by --max-tasks-per-child, so no report pays
+    for loading fonts. However many workers run, at most concurrency renders
+    proceed at once: each holds one of that many slots in a shared cache,
+    and a render that cannot get one within the timeout raises
+    PdfRenderTimeout. A slot is refreshed for as long as its render runs and
+    only ever released or refreshed by its owner, atomically on Redis.
+    """
+
+    def __init__(self, concurrency=PDF_RENDER_CONCURRENCY, timeout=PDF_RENDER_TIMEOUT,
+                 slot_ttl=PDF_RENDER_SLOT_TTL, cache_alias=PDF_RENDER_CACHE):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.slot_ttl = slot_ttl
+        self.cache_alias = cache_alias
+        self._state = None
+        self._lock = threading.Lock()
+
+    def warm(self):
+        """Import WeasyPrint, parse fonts and stylesheets and render one document, once per process"""
+        with self._lock:
+            if self._state is None:
+                from weasyprint import CSS, HTML
+                from weasyprint.text.fonts import FontConfiguration
+
+                font_config = FontConfiguration()
+                state = {
+                    'HTML': HTML,
+                    'font_config': font_config,
+                    'stylesheets': [CSS(filename=path, font_config=font_config) for path in PDF_STYLESHEETS],
+                }
+                # The first render in a process loads fonts and layout caches
+                self._write(state, '<p></p>')
+                self._state = state
+        return self._state
+
+    @staticmethod
+    def _write(state, html, base_url=None):
+        return state['HTML'](string=html, base_url=base_url).write_pdf(
+            stylesheets=state['stylesheets'],
+            font_config=state['font_config']
+        )
+
+    def _acquire_slot(self):
+        cache = caches[self.cache_alias]
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.timeout
+        while True:
+            for slot in range(self.concurrency):
+                key = f'pdf-render-slot:{slot}'
+                if cache.add(key, token, timeout=self.slot_ttl):
+                    return key, token
+            if time.monotonic() >= deadline:
+                raise PdfRenderTimeout(f"No PDF render slot free within {self.timeout}s")
+            time.sleep(SLOT_POLL_INTERVAL)
+
+    def _if_owner(self, key, token, script, action, *args):
+        """Run script on Redis, or action elsewhere, while the slot still holds token; returns whether it did"""
+        cache = caches[self.cache_alias]
+        # A slot that outlived its TTL may already belong to another render
+        if isinstance(cache, RedisCache):
+            cache_key = cache.make_and_validate_key(key)
+            client = cache._cache.get_client(cache_key, write=True)
+            return bool(client.eval(script, 1, cache_key, cache._cache._serializer.dumps(token), *args))
+        # Other backends have no compare-and-set, so a lease lapsing between the two calls can still be hit
+        if cache.get(key) != token:
+            return False
+        return action(cache)
+
+    def _release_slot(self, key, token):
+        return self._if_owner(key, token, RELEASE_SLOT_SCRIPT, lambda cache: cache.delete(key))
+
+    def _refresh_slot(self, key, token):
+        return self._if_owner(
+            key, token, REFRESH_SLOT_SCRIPT, lambda cache: cache.touch(key, self.slot_ttl),
+            caches[self.cache_alias].get_backend_timeout(self.slot_ttl)
+        )
+
+    def _hold_slot(self, key, token, done):
+        while not done.wait(self.slot_ttl / 3):
+            if not self._refresh_slot(key, token):
+                logger.warning('PDF render slot %s lapsed before its render finished', key)
+                return
+
+    def render(self, html, base_url=None):
+        """Render one document once a slot is free"""
+        state = self.warm()
+        key, token = self._acquire_slot()
+        done = threading.Event()
+        holder = threading.Thread(target=self._hold_slot, args=(key, token, done), name='pdf-render-slot', daemon=True)
+        holder.start()
+        try:
+            return self._write(state, html, base_url)
+        finally:
+            done.set()
+            holder.join()
+            self._release_slot(key, token)
+
+    def render_many(self, documents, base_url=None):
+        """Render several documents in order"""
+        return [self.render(html, base_url) for html in documents]
+
+
+pdf_renderer = PdfRenderer()
+
+
+@worker_process_init.connect
+def warm_worker_process(**kwargs):
+    """Warm the renderer in each new Celery worker process"""
+    if not PDF_RENDER_WARM_WORKERS:
+        return
+    try:
+        pdf_renderer.warm()
+    except Exception:
+        # The worker still serves other tasks; PDF renders will raise on their own
+        logger.exception('Warming the PDF renderer failed')
@@ -1,63 +1,195 @@
 # reporting/services.py
+from django.conf import settings
+from django.db import transaction
 from django.template.loader import render_to_string
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
+from django.utils import timezone
 import csv
+import gzip
+import hashlib
 import json
 import io
-from datetime import datetime
-from weasyprint import HTML
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from itertools import islice
 from celery import shared_task
 from analytics.services import AnalyticsService
-from reporting.models import Report
+from analytics.cache import AnalyticsCache, ANALYTICS_CACHE_SETTLE_DAYS
+from analytics.eventstore import EventStore
+from reporting.models import Report, ReportArtifact
+from reporting.pdf import pdf_renderer
+
+try:
+    import orjson
+except ImportError:  # Optional faster JSON backend
+    orjson = None
+
+# Raw rows fetched from the database per round trip while writing report files
+RAW_ROWS_CHUNK_SIZE = 2000
+
+# Artifacts of periods that still receive writes are only reused for this long
+REPORT_ARTIFACT_LIVE_SECONDS = getattr(settings, 'REPORT_ARTIFACT_LIVE_SECONDS', 300)
+
+# A render claim lapses after this long, so a crashed worker cannot block its fingerprint
+REPORT_RENDER_LEASE_SECONDS = getattr(settings, 'REPORT_RENDER_LEASE_SECONDS', 600)
+
+# Seconds between checks while another worker renders an identical report
+REPORT_RENDER_POLL_SECONDS = getattr(settings, 'REPORT_RENDER_POLL_SECONDS', 1)
+
+# Celery queue report generation runs on, so PDF rendering gets dedicated workers; None uses the default queue
+REPORT_TASK_QUEUE = getattr(settings, 'REPORT_TASK_QUEUE', None)
+
+
+def _json_default(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def _dumps(value):
+    """Compact JSON bytes, through orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(value, default=_json_default)
+    return json.dumps(value, separators=(',', ':'), default=_json_default).encode('utf-8')
+
 
 class ReportingService:
     """Services for generating and managing reports"""
     
+    @staticmethod
+    def fingerprint(report):
+        """Hash of everything that determines a report's file contents
+
+        Only reports agreeing on every field hashed here share a file, so the
+        renderers and report templates must not use any other report field.
+        """
+        content = {
+            # Written into the file name, the JSON metadata and the PDF header
+            'name': report.name,
+            'created_by': report.created_by_id,
+            'type': report.type,
+            'format': report.format,
+            'date_from': report.date_from.isoformat(),
+            'date_to': report.date_to.isoformat(),
+            'channels': sorted(report.channels.values_list('id', flat=True)),
+            'parameters': report.parameters,
+            # Bumped whenever analytics rows of a day in the period are rewritten
+            'data_version': AnalyticsCache.range_version(report.date_from, report.date_to)
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+    
+    @staticmethod
+    def _artifact_is_current(report, artifact):
+        if not artifact.file:
+            return False
+        settled = report.date_to < date.today() - timedelta(days=ANALYTICS_CACHE_SETTLE_DAYS)
+        return settled or timezone.now() - artifact.generated_at < timedelta(seconds=REPORT_ARTIFACT_LIVE_SECONDS)
+    
+    @staticmethod
+    def _claim_artifact(report, fingerprint):
+        """Return (artifact, True) to render it, (artifact, False) to reuse it, or (None, False) while another worker renders it"""
+        # The row lock only covers this check-and-set, never the render
+        with transaction.atomic():
+            artifact = ReportArtifact.objects.select_for_update().get(fingerprint=fingerprint)
+            if ReportingService._artifact_is_current(report, artifact):
+                return artifact, False
+            
+            now = timezone.now()
+            if artifact.rendering_until and artifact.rendering_until > now:
+                return None, False
+            
+            artifact.rendering_until = now + timedelta(seconds=REPORT_RENDER_LEASE_SECONDS)
+            artifact.save(update_fields=['rendering_until'])
+            return artifact, True
+    
     @staticmethod
     def generate_report(report_id):
-        """Generate a report based on stored parameters"""
+        """Generate a report, reusing the stored file of an identical earlier report"""
         report = Report.objects.get(id=report_id)
+        fingerprint = ReportingService.fingerprint(report)
+        
+        ReportArtifact.objects.get_or_create(fingerprint=fingerprint)
+        # Identical requests wait for whichever one claimed the render and
+        # then reuse its file
+        artifact, claimed = ReportingService._claim_artifact(report, fingerprint)
+        while artifact is None:
+            time.sleep(REPORT_RENDER_POLL_SECONDS)
+            artifact, claimed = ReportingService._claim_artifact(report, fingerprint)
+        
+        if claimed:
+            try:
+                filename, file_content = ReportingService._render_report(report)
+                with file_content:
+                    artifact.file.save(filename, file_content, save=False)
+            except Exception:
+                ReportArtifact.objects.filter(id=artifact.id).update(rendering_until=None)
+                raise
+            
+            ReportArtifact.objects.filter(id=artifact.id).update(
+                file=artifact.file.name,
+                generated_at=timezone.now(),
+                rendering_until=None
+            )
         
+        # Reports link to the shared artifact rather than holding a copy
+        report.file.name = artifact.file.name
+        report.save(update_fields=['file'])
+        
+        return report
+    
+    @staticmethod
+    def _render_report(report):
+        """Compute a report's data and render it; returns (filename, file)"""
         # Set date range
         start_date = report.date_from
         end_date = report.date_to
         
+        # Sources filtering on timestamps get the whole of both end days
+        start = timezone.make_aware(datetime.combine(start_date, datetime.min.time()))
+        end = timezone.make_aware(datetime.combine(end_date, datetime.max.time()))
+        
         # Get data based on report type
         data = {}
         
         if report.type == 'email':
-            data = AnalyticsService.get_email_performance(start_date, end_date)
+            data = AnalyticsService.get_email_performance(start, end)
         elif report.type == 'whatsapp':
-            data = AnalyticsService.get_whatsapp_performance(start_date, end_date)
+            data = AnalyticsService.get_whatsapp_performance(start, end)
         elif report.type == 'chatbot':
-            data = AnalyticsService.get_chatbot_metrics(start_date, end_date)
+            data = AnalyticsService.get_chatbot_metrics(start, end)
         elif report.type == 'conversation':
-            # Get data for all specified channels
-            channels_data = {}
-            for channel in report.channels.all():
-                channels_data[channel.name] = AnalyticsService.get_channel_metrics(
-                    channel.id, start_date, end_date
-                )
-            data = {'channels': channels_data}
+            # Get data for all specified channels in one query
+            channels = list(report.channels.values_list('id', 'name'))
+            metrics = AnalyticsService.get_channels_metrics([channel_id for channel_id, _ in channels], start_date, end_date)
+            data = {'channels': {name: metrics[channel_id] for channel_id, name in channels}}
         elif report.type == 'custom':
-            # Custom report logic would use report.parameters
-            pass
+            # Custom reports run over the columnar event store, not the live tables
+            params = report.parameters
+            data = {'rows': EventStore.query(
+                params.get('table', 'messages'),
+                start_date,
+                end_date,
+                filters=params.get('filters'),
+                group_by=params.get('group_by'),
+                aggregates=params.get('aggregates')
+            )}
         
-        # Generate file in requested format
+        # Generate file in requested format; CSV and JSON are streamed to a
+        # temporary file rather than built in memory
+        compress = report.parameters.get('gzip', False)
         if report.format == 'pdf':
             file_content = ReportingService._generate_pdf(report, data)
             filename = f"{report.name.lower().replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}.pdf"
         elif report.format == 'csv':
-            file_content = ReportingService._generate_csv(report, data)
-            filename = f"{report.name.lower().replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}.csv"
-        elif report.format == 'json':
-            file_content = ReportingService._generate_json(report, data)
-            filename = f"{report.name.lower().replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}.json"
+            file_content = ReportingService._generate_csv(report, data, compress=compress)
+            filename = f"{report.name.lower().replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}.csv{'.gz' if compress else ''}"
+        elif report.format in ('json', 'ndjson'):
+            file_content = ReportingService._generate_json(report, data, ndjson=report.format == 'ndjson', compress=compress)
+            filename = f"{report.name.lower().replace(' ', '_')}_{datetime.now().strftime('%Y%m%d')}.{report.format}{'.gz' if compress else ''}"
         
-        # Save file to report
-        report.file.save(filename, ContentFile(file_content))
+        if isinstance(file_content, bytes):
+            file_content = ContentFile(file_content)
         
-        return report
+        return filename, file_content
     
     @staticmethod
     def _generate_pdf(report, data):
@@ -81,60 +213,182 @@ class ReportingService:
         else:
             html_content = render_to_string('reports/custom_report.html', context)
         
-        # Generate PDF using WeasyPrint
-        pdf = HTML(string=html_content).write_pdf()
+        # Rendered in this process once one of the shared render slots is free
+        pdf = pdf_renderer.render(html_content)
         
         return pdf
     
     @staticmethod
-    def _generate_csv(report, data):
-        """Generate CSV report"""
-        output = io.StringIO()
-        writer = csv.writer(output)
+    def _generate_csv(report, data, compress=False):
+        """Generate CSV report into a temporary file, optionally gzipped"""
+        output = tempfile.TemporaryFile()
+        stream = gzip.GzipFile(fileobj=output, mode='wb') if compress else output
+        text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+        
+        # Rows come from a generator, so only one chunk is held in memory at a time
+        csv.writer(text).writerows(ReportingService._csv_rows(report, data))
         
-        # Write headers and data based on report type
+        text.flush()
+        text.detach()
+        if compress:
+            stream.close()
+        output.seek(0)
+        
+        return File(output)
+    
+    @staticmethod
+    def _csv_rows(report, data):
+        """Yield the CSV rows of a report: summary sections followed by raw per-day rows"""
         if report.type == 'email':
-            # Write summary
-            writer.writerow(['Email Performance Summary'])
-            writer.writerow(['Metric', 'Value'])
-            for key, value in data['summary'].items():
-                writer.writerow([key, value])
-            
-            # Write daily stats
-            writer.writerow([])
-            writer.writerow(['Daily Performance'])
-            writer.writerow(['Date', 'Sent', 'Opened', 'Clicked', 'Open Rate (%)', 'Click Rate (%)'])
-            for day in data['daily']:
-                writer.writerow([
-                    day['date'],
-                    day['sent'],
-                    day['opened'],
-                    day['clicked'],
-                    f"{day['open_rate']:.2f}",
-                    f"{day['click_rate']:.2f}"
+            yield from ReportingService._csv_summary('Email Performance Summary', data['summary'])
+            yield from ReportingService._csv_section('Daily Performance', data['daily'])
+        elif report.type == 'whatsapp':
+            yield from ReportingService._csv_summary('WhatsApp Activity Summary', data['summary'])
+            yield from ReportingService._csv_section('By Account', data['by_account'])
+            yield from ReportingService._csv_section('Daily Activity', data['daily'])
+        elif report.type == 'chatbot':
+            yield from ReportingService._csv_summary('Chatbot Performance Summary', data['summary'])
+            yield from ReportingService._csv_section('By Intent', data['by_intent'])
+        elif report.type == 'conversation':
+            for channel_name, metrics in data['channels'].items():
+                yield from ReportingService._csv_summary(f'{channel_name} Totals', metrics['totals'])
+                fields = [field for field in metrics if field not in ('dates', 'totals')]
+                yield from ReportingService._csv_section(f'{channel_name} Daily Metrics', [
+                    dict(date=day, **{field: metrics[field][i] for field in fields})
+                    for i, day in enumerate(metrics['dates'])
                 ])
+        elif report.type == 'custom':
+            yield from ReportingService._csv_section('Results', data['rows'])
+        
+        rows = ReportingService._raw_rows(report)
+        columns = next(rows, None)
+        if columns:
+            yield ['Raw Rows']
+            yield columns
+            yield from rows
+    
+    @staticmethod
+    def _csv_summary(title, summary):
+        yield [title]
+        yield ['Metric', 'Value']
+        for key, value in summary.items():
+            yield [key, f"{value:.2f}" if isinstance(value, float) else value]
+        yield []
+    
+    @staticmethod
+    def _csv_section(title, rows):
+        yield [title]
+        if rows:
+            yield list(rows[0])
+            for row in rows:
+                yield [f"{value:.2f}" if isinstance(value, float) else value for value in row.values()]
+        yield []
+    
+    @staticmethod
+    def _raw_rows(report):
+        """Yield the column names, then every underlying row of the report period streamed from the database"""
+        if report.type == 'custom':
+            return
+        
+        from email_service.models import EmailMessage
+        from whatsapp_service.models import WhatsAppMessage
+        from chatbot.models import ChatbotInteraction
+        from communications.models import ConversationMessage
         
-        # Similar implementation for other report types
+        start_of_period = datetime.combine(report.date_from, datetime.min.time())
+        end_of_period = datetime.combine(report.date_to + timedelta(days=1), datetime.min.time())
         
-        return output.getvalue().encode('utf-8')
+        if report.type == 'email':
+            time_field = 'message__sent_at'
+            queryset = EmailMessage.objects.all()
+            columns = ['message__recipient', 'message__status', 'opens', 'clicks', 'spam_score']
+        elif report.type == 'whatsapp':
+            time_field = 'message__sent_at'
+            queryset = WhatsAppMessage.objects.all()
+            columns = ['account__name', 'message__recipient', 'message__status', 'message__delivered_at', 'message__read_at']
+        elif report.type == 'chatbot':
+            time_field = 'timestamp'
+            queryset = ChatbotInteraction.objects.all()
+            columns = ['conversation_id', 'detected_intent__name', 'confidence_score', 'needs_handoff', 'feedback_rating']
+        else:
+            time_field = 'created_at'
+            queryset = ConversationMessage.objects.filter(conversation__channel__in=report.channels.all())
+            columns = ['conversation__channel__name', 'conversation_id', 'is_from_user']
+        
+        rows = queryset.filter(**{
+            f'{time_field}__gte': start_of_period,
+            f'{time_field}__lt': end_of_period
+        }).order_by(time_field, 'id').values_list(time_field, *columns).iterator(chunk_size=RAW_ROWS_CHUNK_SIZE)
+        
+        yield ['date'] + [column.replace('message__', '').replace('__', '_') for column in [time_field] + columns]
+        for row in rows:
+            yield [row[0].date().isoformat(), *row]
     
     @staticmethod
-    def _generate_json(report, data):
-        """Generate JSON report"""
+    def _generate_json(report, data, ndjson=False, compress=False):
+        """Generate compact JSON or newline-delimited JSON report into a temporary file, optionally gzipped"""
         # Add metadata
-        result = {
+        metadata = {
             'report_name': report.name,
             'report_type': report.type,
             'date_from': report.date_from.strftime('%Y-%m-%d'),
             'date_to': report.date_to.strftime('%Y-%m-%d'),
-            'generated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'data': data
+            'generated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }
         
-        return json.dumps(result, indent=2).encode('utf-8')
+        output = tempfile.TemporaryFile()
+        stream = gzip.GzipFile(fileobj=output, mode='wb') if compress else output
+        chunks = ReportingService._ndjson_chunks if ndjson else ReportingService._json_chunks
+        for chunk in chunks(report, metadata, data):
+            stream.write(chunk)
+        
+        if compress:
+            stream.close()
+        output.seek(0)
+        
+        return File(output)
+    
+    @staticmethod
+    def _json_chunks(report, metadata, data):
+        """Yield one JSON document: metadata, data and raw rows as column-ordered arrays"""
+        document = _dumps(dict(metadata, data=data))
+        rows = ReportingService._raw_rows(report)
+        columns = next(rows, None)
+        if columns is None:
+            yield document
+            return
+        
+        # Raw rows are spliced in before the closing brace, a chunk at a time
+        yield document[:-1] + b',"raw_rows":{"columns":' + _dumps(columns) + b',"rows":['
+        separator = b''
+        while chunk := list(islice(rows, RAW_ROWS_CHUNK_SIZE)):
+            yield separator + b','.join(_dumps(row) for row in chunk)
+            separator = b','
+        yield b']}}'
+    
+    @staticmethod
+    def _ndjson_chunks(report, metadata, data):
+        """Yield one JSON record per line, each tagged with its record type"""
+        yield _dumps(dict(metadata, record='report', summary=data.get('summary'))) + b'\n'
+        
+        for section, items in data.items():
+            if section == 'channels':
+                for channel_name, metrics in items.items():
+                    yield _dumps(dict(metrics['totals'], record='channel_totals', channel=channel_name)) + b'\n'
+                    fields = [field for field in metrics if field not in ('dates', 'totals')]
+                    for i, day in enumerate(metrics['dates']):
+                        record = {field: metrics[field][i] for field in fields}
+                        yield _dumps(dict(record, record='channel_daily', channel=channel_name, date=day)) + b'\n'
+            elif isinstance(items, list):
+                yield b''.join(_dumps(dict(item, record=section)) + b'\n' for item in items)
+        
+        rows = ReportingService._raw_rows(report)
+        columns = next(rows, None)
+        while columns and (chunk := list(islice(rows, RAW_ROWS_CHUNK_SIZE))):
+            yield b''.join(_dumps(dict(zip(columns, row), record='raw')) + b'\n' for row in chunk)
 
 
-@shared_task
+@shared_task(queue=REPORT_TASK_QUEUE)
 def generate_scheduled_report(report_id):
     """Celery task to generate a scheduled report"""
     ReportingService.generate_report(report_id)
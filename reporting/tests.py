@@ -1,3 +1,226 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from unittest import mock
+from celery.signals import worker_process_init
+from django.core.cache import cache
+from django.core.cache.backends.redis import RedisCache
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from analytics.services import generate_daily_metrics
+from analytics.tests import seed_day
+from chatbot.models import ChatbotInteraction
+from reporting.models import Report, ReportArtifact
+from reporting.pdf import RELEASE_SLOT_SCRIPT, PdfRenderer, PdfRenderTimeout
+from reporting.services import ReportingService
 
-# Create your tests here.
+
+class ReportGenerationTests(TestCase):
+    day = date(2025, 3, 14)
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media = override_settings(MEDIA_ROOT=media_root.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+        self.channels = seed_day(self.day)
+        generate_daily_metrics(self.day)
+
+    def generate(self, report_type, format, **parameters):
+        report = Report.objects.create(
+            name=f'{report_type} {format}', type=report_type, format=format,
+            date_from=self.day, date_to=self.day, parameters=parameters
+        )
+        report.channels.set(self.channels[:3])
+        report = ReportingService.generate_report(report.id)
+        with report.file.open('rb') as file:
+            content = file.read()
+        return gzip.decompress(content) if parameters.get('gzip') else content
+
+    def test_json_contains_data_and_raw_rows(self):
+        document = json.loads(self.generate('chatbot', 'json'))
+
+        interactions = ChatbotInteraction.objects.filter(timestamp__date=self.day)
+        summary = document['data']['summary']
+        self.assertEqual(document['report_type'], 'chatbot')
+        # Counted over the whole day, not just its first hour
+        self.assertEqual(summary['total_interactions'], interactions.count())
+        self.assertEqual(summary['successful_interactions'], interactions.filter(confidence_score__gte=0.7).count())
+        self.assertEqual(summary['handoffs'], interactions.filter(needs_handoff=True).count())
+        self.assertEqual(document['raw_rows']['columns'][:2], ['date', 'timestamp'])
+        self.assertEqual(
+            len(document['raw_rows']['rows']),
+            ChatbotInteraction.objects.filter(timestamp__date=self.day).count()
+        )
+
+    def test_gzipped_ndjson_has_one_record_per_line(self):
+        records = [json.loads(line) for line in self.generate('conversation', 'ndjson', gzip=True).splitlines()]
+
+        self.assertEqual(records[0]['record'], 'report')
+        self.assertEqual(
+            {record['channel'] for record in records if record['record'] == 'channel_totals'},
+            {channel.name for channel in self.channels[:3]}
+        )
+        self.assertTrue(all('conversation_id' in record for record in records if record['record'] == 'raw'))
+
+    def test_csv_for_every_report_type(self):
+        for report_type in ['email', 'whatsapp', 'chatbot', 'conversation']:
+            rows = list(csv.reader(io.StringIO(self.generate(report_type, 'csv', gzip=True).decode())))
+            self.assertIn(['Raw Rows'], rows, report_type)
+
+    def test_differently_named_reports_get_their_own_files(self):
+        reports = []
+        for name in ['Alpha report', 'Beta report']:
+            report = Report.objects.create(
+                name=name, type='chatbot', format='json', date_from=self.day, date_to=self.day
+            )
+            reports.append(ReportingService.generate_report(report.id))
+
+        self.assertNotEqual(reports[0].file.name, reports[1].file.name)
+        self.assertEqual(ReportArtifact.objects.count(), 2)
+        for report in reports:
+            self.assertIn(report.name.lower().replace(' ', '_'), report.file.name)
+            with report.file.open('rb') as file:
+                self.assertEqual(json.load(file)['report_name'], report.name)
+
+    def test_identical_reports_share_one_artifact(self):
+        first = self.generate('conversation', 'json')
+        second = self.generate('conversation', 'json')
+
+        self.assertEqual(first, second)
+        self.assertEqual(ReportArtifact.objects.count(), 1)
+        self.assertEqual(len({report.file.name for report in Report.objects.all()}), 1)
+
+    def test_waits_for_a_render_claimed_elsewhere(self):
+        report = Report.objects.create(name='Chatbot', type='chatbot', format='json', date_from=self.day, date_to=self.day)
+        artifact = ReportArtifact.objects.create(
+            fingerprint=ReportingService.fingerprint(report),
+            rendering_until=timezone.now() + timedelta(minutes=5)
+        )
+
+        def other_worker_finishes(seconds):
+            artifact.file.save('other.json', ContentFile(b'{}'))
+            ReportArtifact.objects.filter(id=artifact.id).update(rendering_until=None)
+
+        with mock.patch('reporting.services.time.sleep', side_effect=other_worker_finishes) as sleep:
+            with mock.patch.object(ReportingService, '_render_report') as render:
+                report = ReportingService.generate_report(report.id)
+
+        sleep.assert_called_once()
+        render.assert_not_called()
+        self.assertEqual(report.file.name, artifact.file.name)
+
+    def test_failed_render_releases_its_claim(self):
+        report = Report.objects.create(name='Chatbot', type='chatbot', format='json', date_from=self.day, date_to=self.day)
+
+        with mock.patch.object(ReportingService, '_render_report', side_effect=ValueError('template missing')):
+            with self.assertRaises(ValueError):
+                ReportingService.generate_report(report.id)
+
+        self.assertIsNone(ReportArtifact.objects.get().rendering_until)
+
+
+class FakeHTML:
+    def __init__(self, string, base_url=None):
+        self.string = string
+
+    def write_pdf(self, stylesheets, font_config):
+        if 'broken' in self.string:
+            raise ValueError('layout failed')
+        return self.string.encode()
+
+
+class PdfRendererTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.renderer = PdfRenderer(concurrency=2, timeout=0.3)
+        self.renderer._state = {'HTML': FakeHTML, 'font_config': None, 'stylesheets': []}
+
+    def test_renders_in_process_and_frees_its_slot(self):
+        self.assertEqual(self.renderer.render('<p>a</p>'), b'<p>a</p>')
+        self.assertIsNone(cache.get('pdf-render-slot:0'))
+
+    def test_slots_cap_renders_across_processes(self):
+        # Both slots held by renders in other processes
+        cache.add('pdf-render-slot:0', 'other')
+        cache.add('pdf-render-slot:1', 'other')
+        with self.assertRaises(PdfRenderTimeout):
+            self.renderer.render('<p>a</p>')
+
+        cache.delete('pdf-render-slot:1')
+        self.assertEqual(self.renderer.render('<p>b</p>'), b'<p>b</p>')
+        self.assertEqual(cache.get('pdf-render-slot:0'), 'other')
+
+    def test_failed_render_frees_its_slot(self):
+        with self.assertRaises(ValueError):
+            self.renderer.render('<p>broken</p>')
+        self.assertIsNone(cache.get('pdf-render-slot:0'))
+
+    def test_long_render_keeps_its_slot(self):
+        renderer = PdfRenderer(concurrency=1, timeout=0.3, slot_ttl=0.3)
+        renderer._state = self.renderer._state
+
+        def slow_write(state, html, base_url=None):
+            # Twice the slot's TTL, so only refreshes keep it
+            time.sleep(0.6)
+            return cache.get('pdf-render-slot:0')
+
+        with mock.patch.object(PdfRenderer, '_write', side_effect=slow_write):
+            self.assertIsNotNone(renderer.render('<p>a</p>'))
+        self.assertIsNone(cache.get('pdf-render-slot:0'))
+
+    def test_only_the_owner_releases_or_refreshes_a_slot(self):
+        # Our lease lapsed and another render took the slot
+        cache.set('pdf-render-slot:0', 'other')
+
+        self.assertFalse(self.renderer._refresh_slot('pdf-render-slot:0', 'ours'))
+        self.assertFalse(self.renderer._release_slot('pdf-render-slot:0', 'ours'))
+        self.assertEqual(cache.get('pdf-render-slot:0'), 'other')
+
+    def test_redis_slots_are_released_by_compare_and_delete(self):
+        redis_cache = RedisCache('redis://localhost:6379', {})
+        redis_cache.__dict__['_cache'] = client = mock.Mock()
+        client.get_client.return_value.eval.return_value = 1
+
+        with mock.patch('reporting.pdf.caches', {'default': redis_cache}):
+            self.assertTrue(self.renderer._release_slot('pdf-render-slot:0', 'ours'))
+
+        client.get_client.return_value.eval.assert_called_once_with(
+            RELEASE_SLOT_SCRIPT, 1, ':1:pdf-render-slot:0', client._serializer.dumps.return_value
+        )
+        client._serializer.dumps.assert_called_once_with('ours')
+
+    def test_warms_once_per_process(self):
+        weasyprint = mock.Mock()
+        modules = {
+            'weasyprint': weasyprint,
+            'weasyprint.text': weasyprint.text,
+            'weasyprint.text.fonts': weasyprint.text.fonts,
+        }
+        renderer = PdfRenderer(timeout=0.3)
+        with mock.patch.dict(sys.modules, modules):
+            renderer.render('<p>a</p>')
+            renderer.render('<p>b</p>')
+
+        weasyprint.text.fonts.FontConfiguration.assert_called_once()
+        self.assertEqual(
+            [call.kwargs['string'] for call in weasyprint.HTML.call_args_list],
+            ['<p></p>', '<p>a</p>', '<p>b</p>']
+        )
+
+    def test_new_worker_processes_are_warmed(self):
+        with mock.patch('reporting.pdf.PDF_RENDER_WARM_WORKERS', True):
+            with mock.patch('reporting.pdf.pdf_renderer.warm') as warm:
+                # Sent in every prefork child, including those replacing retired ones
+                worker_process_init.send(sender=None)
+
+        warm.assert_called_once()
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class WhatsappServiceConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'whatsapp_service'
+
+    def ready(self):
+        # Reload the account/channel registry when accounts or channels change
+        from whatsapp_service import registry  # noqa: F401
@@ -19,6 +19,11 @@ class WhatsAppMessage(models.Model):
     media_type = models.CharField(max_length=50, blank=True)
     twilio_message_id = models.CharField(max_length=255, blank=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['twilio_message_id'], name='whatsapp_twilio_message_idx'),
+        ]
+    
     def __str__(self):
         return f"WhatsApp: {self.message.recipient}"
 
@@ -0,0 +1,115 @@
+# whatsapp_service/registry.py
+import threading
+import time
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from communications.models import Channel
+from whatsapp_service.models import WhatsAppAccount
+
+# Seconds before the registry reloads on its own, to pick up changes made by other processes
+WHATSAPP_REGISTRY_TTL = getattr(settings, 'WHATSAPP_REGISTRY_TTL', 300)
+
+# Seconds after a load during which unknown ids are answered from memory instead of reloading
+WHATSAPP_REGISTRY_MISS_TTL = getattr(settings, 'WHATSAPP_REGISTRY_MISS_TTL', 5)
+
+
+class WhatsAppRegistry:
+    """Process-local map of WhatsApp account <-> channel, with account credentials and clients
+
+    Loaded in bulk and kept in memory, so resolving the account and channel
+    of a message costs no queries. Saving or deleting a Channel or
+    WhatsAppAccount reloads it in the process that made the change; other
+    processes reload after WHATSAPP_REGISTRY_TTL seconds, or when asked for
+    an id they do not know yet. Such a reload happens at most once every
+    WHATSAPP_REGISTRY_MISS_TTL seconds, so a stream of unknown ids cannot
+    turn every lookup into a full reload.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._accounts = {}
+        self._channels = {}
+        self._accounts_by_channel = {}
+        self._clients = {}
+        self._loaded_at = None
+
+    def load(self):
+        accounts = {account.id: account for account in WhatsAppAccount.objects.all()}
+
+        # The account link lives in the channel's JSON configuration; it is
+        # read here once instead of being filtered on for every message
+        channels, accounts_by_channel = {}, {}
+        for channel_id, configuration in Channel.objects.filter(type='whatsapp').values_list('id', 'configuration'):
+            account_id = configuration.get('account_id')
+            if account_id is not None:
+                channels.setdefault(int(account_id), channel_id)
+                accounts_by_channel[channel_id] = int(account_id)
+
+        with self._lock:
+            self._accounts = accounts
+            self._channels = channels
+            self._accounts_by_channel = accounts_by_channel
+            self._clients = {}
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _ensure_loaded(self):
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > WHATSAPP_REGISTRY_TTL:
+            self.load()
+
+    def _lookup(self, mapping, key):
+        self._ensure_loaded()
+        value = getattr(self, mapping).get(key)
+        loaded_at = self._loaded_at
+        if value is None and (loaded_at is None or time.monotonic() - loaded_at > WHATSAPP_REGISTRY_MISS_TTL):
+            # Possibly created by another process since the last load
+            self.load()
+            value = getattr(self, mapping).get(key)
+        return value
+
+    def account(self, account_id):
+        """The WhatsAppAccount with this id"""
+        account = self._lookup('_accounts', int(account_id))
+        if account is None:
+            raise WhatsAppAccount.DoesNotExist(f"WhatsApp account {account_id} does not exist")
+        return account
+
+    def channel_id(self, account_id):
+        """Id of the WhatsApp channel configured for an account"""
+        channel_id = self._lookup('_channels', int(account_id))
+        if channel_id is None:
+            raise Channel.DoesNotExist(f"No WhatsApp channel for account {account_id}")
+        return channel_id
+
+    def account_for_channel(self, channel_id):
+        """The WhatsAppAccount a channel sends through"""
+        account_id = self._lookup('_accounts_by_channel', channel_id)
+        if account_id is None:
+            raise WhatsAppAccount.DoesNotExist(f"No WhatsApp account for channel {channel_id}")
+        return self.account(account_id)
+
+    def client(self, account_id):
+        """Twilio client for an account, reused across messages"""
+        # Imported here so the registry's signal receivers load without Twilio
+        from twilio.rest import Client
+
+        account = self.account(account_id)
+        with self._lock:
+            client = self._clients.get(account.id)
+            if client is None:
+                client = self._clients[account.id] = Client(account.twilio_account_sid, account.twilio_auth_token)
+        return client
+
+
+registry = WhatsAppRegistry()
+
+
+@receiver([post_save, post_delete], sender=Channel)
+@receiver([post_save, post_delete], sender=WhatsAppAccount)
+def invalidate_registry(sender, **kwargs):
+    registry.invalidate()
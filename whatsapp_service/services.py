@@ -1,23 +1,50 @@
 
+import logging
 from datetime import datetime
 from django.template import Template as DjangoTemplate, Context
 from django.conf import settings
+from django.db import transaction
 from celery import shared_task
-from twilio.rest import Client
-from communications.models import Channel, Template, Message, Conversation, ConversationMessage
-from whatsapp_service.models import WhatsAppAccount, WhatsAppMessage, AutoReply
+from communications.models import Template, Message, Conversation, ConversationMessage
+from communications.services import OutboxService
+from communications.suppression import SuppressionService
+from whatsapp_service.models import WhatsAppMessage, AutoReply
+from whatsapp_service.registry import registry
+
+logger = logging.getLogger(__name__)
 
 class WhatsAppService:
     @staticmethod
     def get_twilio_client(account):
         """Get configured Twilio client for WhatsApp account"""
-        return Client(account.twilio_account_sid, account.twilio_auth_token)
+        return registry.client(account.id)
     
     @staticmethod
     def send_message(account_id, recipient, content, media_url=None, template_id=None):
         """Send a WhatsApp message to a recipient"""
-        account = WhatsAppAccount.objects.get(id=account_id)
-        channel = Channel.objects.get(type='whatsapp', configuration__account_id=account_id)
+        return WhatsAppService._create_messages(account_id, [recipient], content, media_url, template_id)[0]
+    
+    @staticmethod
+    def send_broadcast(account_id, recipients, content, media_url=None, template_id=None):
+        """Send WhatsApp message to multiple recipients"""
+        # Skip bounced, opted-out and non-consenting recipients in one pass
+        recipients = list(recipients)
+        suppressed = SuppressionService.suppressed('whatsapp', recipients)
+        
+        return WhatsAppService._create_messages(
+            account_id,
+            [recipient for recipient in recipients if recipient not in suppressed],
+            content,
+            media_url,
+            template_id
+        )
+    
+    @staticmethod
+    def _create_messages(account_id, recipients, content, media_url=None, template_id=None):
+        """Create pending messages for recipients and queue them through the outbox"""
+        # Resolved from the in-memory registry, without queries
+        account = registry.account(account_id)
+        channel_id = registry.channel_id(account_id)
         
         # Get template if provided
         template = None
@@ -29,53 +56,41 @@ class WhatsAppService:
                 django_template = DjangoTemplate(template.content)
                 content = django_template.render(Context({}))  # In real use, variables would be passed
         
-        # Create message record
-        message = Message.objects.create(
-            channel=channel,
-            template=template,
-            recipient=recipient,
-            content=content,
-            status='pending'
-        )
-        
-        # Create WhatsApp specific details
-        whatsapp_message = WhatsAppMessage.objects.create(
-            message=message,
-            account=account,
-            media_url=media_url or '',
-            media_type=media_url.split('.')[-1] if media_url else '' if media_url else ''
-        )
-        
-        # Queue actual sending
-        send_whatsapp_message.delay(whatsapp_message.id)
-        
-        return message
-    
-    @staticmethod
-    def send_broadcast(account_id, recipients, content, media_url=None, template_id=None):
-        """Send WhatsApp message to multiple recipients"""
-        messages = []
-        for recipient in recipients:
-            message = WhatsAppService.send_message(
-                account_id, 
-                recipient, 
-                content, 
-                media_url, 
-                template_id
-            )
-            messages.append(message)
+        with transaction.atomic():
+            # Create message records
+            messages = Message.objects.bulk_create([
+                Message(
+                    channel_id=channel_id,
+                    template=template,
+                    recipient=recipient,
+                    content=content,
+                    status='pending'
+                ) for recipient in recipients
+            ])
+            
+            # Create WhatsApp specific details
+            WhatsAppMessage.objects.bulk_create([
+                WhatsAppMessage(
+                    message=message,
+                    account=account,
+                    media_url=media_url or '',
+                    media_type=media_url.split('.')[-1] if media_url else ''
+                ) for message in messages
+            ])
+            
+            # Queue actual sending, committed together with the messages
+            OutboxService.record(messages, 'whatsapp')
         
         return messages
     
     @staticmethod
     def process_incoming_message(account_id, from_number, message_content, media_url=None, twilio_message_id=None):
         """Process an incoming WhatsApp message"""
-        account = WhatsAppAccount.objects.get(id=account_id)
-        channel = Channel.objects.get(type='whatsapp', configuration__account_id=account_id)
+        channel_id = registry.channel_id(account_id)
         
         # Find or create conversation
         conversation, created = Conversation.objects.get_or_create(
-            channel=channel,
+            channel_id=channel_id,
             external_id=from_number,
             defaults={
                 'metadata': {'account_id': account_id}
@@ -145,11 +160,15 @@ class WhatsAppService:
 @shared_task
 def send_whatsapp_message(whatsapp_message_id):
     """Send a WhatsApp message via Twilio"""
-    whatsapp_message = WhatsAppMessage.objects.get(id=whatsapp_message_id)
+    whatsapp_message = WhatsAppMessage.objects.select_related('message').get(id=whatsapp_message_id)
     message = whatsapp_message.message
-    account = whatsapp_message.account
+    
+    # Already handled by an earlier delivery of this task
+    if message.status != 'pending':
+        return False
     
     try:
+        account = registry.account(whatsapp_message.account_id)
         client = WhatsAppService.get_twilio_client(account)
         
         # Format WhatsApp number with proper prefix
@@ -187,13 +206,29 @@ def send_whatsapp_message(whatsapp_message_id):
         return False
 
 
+@shared_task
+def send_whatsapp_messages(whatsapp_message_ids):
+    """Send a chunk of WhatsApp messages handed over by the outbox dispatcher"""
+    sent = 0
+    for whatsapp_message_id in whatsapp_message_ids:
+        try:
+            sent += send_whatsapp_message(whatsapp_message_id)
+        except Exception as e:
+            # The outbox entries of the chunk are gone, so one bad message must not strand the rest
+            logger.exception('Sending WhatsApp message %s failed', whatsapp_message_id)
+            Message.objects.filter(whatsapp_details__id=whatsapp_message_id, status='pending').update(
+                status='failed', metadata={'error': str(e)}
+            )
+    return sent
+
+
 @shared_task
 def update_message_status():
     """Update delivery status for WhatsApp messages"""
     # Get recent messages that are sent but not confirmed delivered
     recent_messages = WhatsAppMessage.objects.filter(
         message__status='sent'
-    ).select_related('message', 'account')
+    ).select_related('message')
     
     for whatsapp_message in recent_messages:
         try:
@@ -202,8 +237,7 @@ def update_message_status():
                 continue
                 
             message = whatsapp_message.message
-            account = whatsapp_message.account
-            client = WhatsAppService.get_twilio_client(account)
+            client = registry.client(whatsapp_message.account_id)
             
             # Fetch message status from Twilio
             twilio_message = client.messages(whatsapp_message.twilio_message_id).fetch()
@@ -218,6 +252,8 @@ def update_message_status():
                 message.read_at = datetime.now()
             elif twilio_message.status in ['failed', 'undelivered']:
                 message.status = 'failed'
+                # Reported by the carrier, so it counts towards suppressing the number
+                message.metadata = {**message.metadata, 'bounce': True, 'error': twilio_message.error_code}
                 
             message.save()
             
@@ -1,3 +1,61 @@
+from unittest import mock
 from django.test import TestCase
+from communications.models import Channel
+from whatsapp_service.models import WhatsAppAccount
+from whatsapp_service.registry import WhatsAppRegistry, registry
 
-# Create your tests here.
+
+class WhatsAppRegistryTests(TestCase):
+
+    def setUp(self):
+        self.account = WhatsAppAccount.objects.create(
+            name='Support', phone_number='+15550001', twilio_account_sid='AC1', twilio_auth_token='secret'
+        )
+        self.channel = Channel.objects.create(
+            name='WhatsApp Support', type='whatsapp', configuration={'account_id': self.account.id}
+        )
+        self.registry = WhatsAppRegistry()
+
+    def test_resolves_without_queries_once_loaded(self):
+        with self.assertNumQueries(2):
+            self.registry.load()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.registry.channel_id(self.account.id), self.channel.id)
+            self.assertEqual(self.registry.account(self.account.id).phone_number, '+15550001')
+            self.assertEqual(self.registry.account_for_channel(self.channel.id).id, self.account.id)
+
+    def test_reloads_when_accounts_or_channels_change(self):
+        self.assertEqual(registry.channel_id(self.account.id), self.channel.id)
+
+        replacement = Channel.objects.create(name='WhatsApp New', type='whatsapp', configuration={})
+        self.channel.configuration = {}
+        self.channel.save()
+        replacement.configuration = {'account_id': self.account.id}
+        replacement.save()
+        self.assertEqual(registry.channel_id(self.account.id), replacement.id)
+
+        self.account.phone_number = '+15550002'
+        self.account.save()
+        self.assertEqual(registry.account(self.account.id).phone_number, '+15550002')
+
+    def test_unknown_ids_raise(self):
+        self.registry.load()
+        with self.assertRaises(WhatsAppAccount.DoesNotExist):
+            self.registry.account(self.account.id + 100)
+        with self.assertRaises(Channel.DoesNotExist):
+            self.registry.channel_id(self.account.id + 100)
+
+    def test_unknown_ids_reload_at_most_once_per_miss_ttl(self):
+        self.registry.load()
+        with self.assertNumQueries(0):
+            for offset in range(100, 110):
+                with self.assertRaises(WhatsAppAccount.DoesNotExist):
+                    self.registry.account(self.account.id + offset)
+
+        later = self.registry._loaded_at + 10
+        with mock.patch('whatsapp_service.registry.time.monotonic', return_value=later):
+            with self.assertNumQueries(2):
+                for offset in range(100, 110):
+                    with self.assertRaises(WhatsAppAccount.DoesNotExist):
+                        self.registry.account(self.account.id + offset)